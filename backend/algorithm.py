@@ -1,50 +1,247 @@
 import random
 import json
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from content_generator import ContentGenerator
-from quality_scorer import QualityScorer
+from calendar_model import Comment, Post, to_minutes
+from content_generator import ContentGenerator, extract_company_name, cache_scope
+from llm_usage import UsageMeter, metered
+from near_duplicates import calendar_texts
+from quality_scorer import QualityScorer, IncrementalQualityScorer
+from telemetry import traced
 
 class RedditCalendarGenerator:
     """
     Core algorithm for generating Reddit content calendars
     """
     
-    def __init__(self, api_key):
-        self.content_gen = ContentGenerator(api_key)
+    THREAD_MODES = ('per_call', 'single_call')
+    
+    # Posts scored before min_score can stop a calendar early
+    MIN_POSTS_BEFORE_STOP = 3
+    
+    def __init__(self, api_key, max_concurrency=1, thread_mode='per_call', cache=None,
+                 transport=None, stream=False):
+        if thread_mode not in self.THREAD_MODES:
+            raise ValueError(f"Unknown thread_mode: {thread_mode}")
+        
+        self.content_gen = ContentGenerator(api_key, cache=cache, transport=transport)
         self.quality_scorer = QualityScorer()
+        # Max posts generated in parallel (1 = serial)
+        self.max_concurrency = max(1, max_concurrency)
+        # 'per_call': one LLM call per post/comment
+        # 'single_call': post and whole comment thread from one call
+        self.thread_mode = thread_mode
+        # Stream per-call posts/comments so ones that name the company
+        # where they shouldn't are cut off early instead of paid for in full
+        self.stream = stream
         
     def generate_calendar(self, company_info, personas, subreddits, keywords, 
-                         posts_per_week, week_number=1, previous_calendar=None):
+                         posts_per_week, week_number=1, previous_calendar=None,
+                         max_concurrency=None, seed=None, lexicons=None, on_post=None,
+                         min_score=None, used_keywords=None, near_duplicates=None):
         """
         Generate a complete content calendar for a week
+        
+        Passing a seed makes every random choice (assignments, personas, timing,
+        thread shape) reproducible, so recorded transcripts replay exactly.
+        Only seeded runs use the LLM cache (keyed on the seed, week and post).
+        lexicons optionally overrides the quality scorer's phrase lists.
+        on_post(post, metrics) is called as each post finishes, with live
+        quality metrics; if min_score is set, generation stops once the live
+        score drops below it. used_keywords (e.g. from the campaign store)
+        replaces the keywords taken from previous_calendar. A near_duplicates
+        index (e.g. the campaign's past weeks) flags posts and comments that
+        nearly copy earlier content as they arrive (the duplication score).
         """
         
+        rng = random.Random(seed)
+        
         # Calculate week dates
         start_date = datetime.now() + timedelta(days=7 * (week_number - 1))
-        end_date = start_date + timedelta(days=6)
         
         # Step 1: Select topics and subreddits for posts
         post_assignments = self._assign_posts_to_subreddits(
-            subreddits, keywords, posts_per_week, previous_calendar
+            subreddits, keywords, posts_per_week, previous_calendar, rng, used_keywords
         )
         
-        # Step 2: Generate posts with comments
-        posts = []
-        for i, assignment in enumerate(post_assignments):
-            post = self._generate_post_with_comments(
+        # Step 2: Plan every post up front (all random choices happen here,
+        # in order, so parallel generation gives the same calendar as serial)
+        post_plans = [
+            self._plan_post(
                 assignment=assignment,
                 personas=personas,
-                company_info=company_info,
                 post_number=i + 1,
                 start_date=start_date,
-                week_number=week_number
+                week_number=week_number,
+                rng=rng
             )
-            posts.append(post)
+            for i, assignment in enumerate(post_assignments)
+        ]
+        
+        # Step 3: Generate posts with comments, scoring them as they arrive
+        live_scorer = IncrementalQualityScorer(
+            personas,
+            scorer=self.quality_scorer,
+            company_names=[extract_company_name(company_info)],
+            lexicons=lexicons,
+            near_duplicates=near_duplicates
+        )
+        finished = {}
+        next_to_score = 0
+        stopped_early = False
+        usage = UsageMeter()
+        
+        post_stream = self._iter_posts(post_plans, company_info, max_concurrency,
+                                       meters=[usage] * len(post_plans), seed=seed)
+        for index, post in post_stream:
+            finished[index] = post
+            
+            # Score in calendar order so the result matches a full re-score
+            while next_to_score in finished:
+                live_scorer.add_post(finished[next_to_score])
+                next_to_score += 1
+            
+            if on_post is None and min_score is None:
+                continue
+            
+            live_metrics = live_scorer.metrics()
+            if on_post is not None:
+                on_post(post, live_metrics)
+            
+            if (min_score is not None and live_scorer.num_posts >= self.MIN_POSTS_BEFORE_STOP
+                    and live_metrics['overall_score'] < min_score):
+                stopped_early = True
+                post_stream.close()
+                break
+        
+        # Step 4: Score quality (posts after a gap left by an early stop)
+        for index in sorted(finished):
+            if index >= next_to_score:
+                live_scorer.add_post(finished[index])
+        quality_metrics = live_scorer.metrics()
+        quality_metrics['usage'] = usage.totals()
+        posts = [finished[index] for index in sorted(finished)]
+        
+        calendar = self._build_calendar(week_number, start_date, posts, quality_metrics)
+        
+        if stopped_early:
+            calendar['stopped_early'] = True
+        
+        return calendar
+    
+    def generate_campaign(self, company_info, personas, subreddits, keywords, posts_per_week,
+                          weeks, start_week=1, previous_calendar=None, used_keywords=None,
+                          max_concurrency=None, seed=None, lexicons=None, on_week=None,
+                          near_duplicates=None):
+        """
+        Generate several consecutive weeks in one pipelined run
+        
+        A week's assignments only need the previous week's keywords, which
+        are known before any text is written, so every week is planned up
+        front and all weeks' posts then share one pool of max_concurrency
+        workers. on_week(calendar) is called as each week completes, in week
+        order; returns the calendars. previous_calendar / used_keywords only
+        apply to the first week. Each finished week's texts are added to the
+        near_duplicates index (if given), so later weeks are checked against it.
+        """
+        
+        # Step 1: Plan every week (each one avoids the keywords of the week before)
+        week_plans = self._plan_weeks(personas, subreddits, keywords, posts_per_week, weeks,
+                                      start_week, previous_calendar, used_keywords, seed)
+        
+        # Step 2: Generate all weeks' posts through one shared pool
+        owners = [(w, i) for w, (_, _, plans) in enumerate(week_plans) for i in range(len(plans))]
+        all_plans = [plan for _, _, plans in week_plans for plan in plans]
+        finished = [{} for _ in week_plans]
+        calendars = [None] * len(week_plans)
+        company_names = [extract_company_name(company_info)]
+        usage = [UsageMeter() for _ in week_plans]
+        
+        def finish_week(w):
+            week_number, start_date, plans = week_plans[w]
+            posts = [finished[w][i] for i in range(len(plans))]
+            calendars[w] = self._finish_week(week_number, start_date, posts, personas, company_names,
+                                             lexicons, near_duplicates, usage[w])
+            if on_week is not None:
+                on_week(calendars[w])
+        
+        # Weeks are finished in order, so each is checked against all earlier weeks
+        next_week = 0
+        def finish_ready_weeks():
+            nonlocal next_week
+            while next_week < len(week_plans) and len(finished[next_week]) == len(week_plans[next_week][2]):
+                finish_week(next_week)
+                next_week += 1
+        
+        finish_ready_weeks()
+        meters = [usage[w] for w, _ in owners]
+        for index, post in self._iter_posts(all_plans, company_info, max_concurrency, meters=meters, seed=seed):
+            w, i = owners[index]
+            finished[w][i] = post
+            finish_ready_weeks()
+        
+        return calendars
+    
+    def _plan_weeks(self, personas, subreddits, keywords, posts_per_week, weeks, start_week=1,
+                    previous_calendar=None, used_keywords=None, seed=None):
+        """
+        Plan consecutive weeks: a list of (week_number, start_date, post_plans)
+        
+        Each week avoids the keywords of the week before; previous_calendar /
+        used_keywords only apply to the first week.
+        """
         
-        # Step 3: Score quality
-        quality_metrics = self.quality_scorer.score_calendar(posts, personas)
+        rng = random.Random(seed)
+        now = datetime.now()
         
-        calendar = {
+        week_plans = []
+        for week_number in range(start_week, start_week + weeks):
+            start_date = now + timedelta(days=7 * (week_number - 1))
+            assignments = self._assign_posts_to_subreddits(
+                subreddits, keywords, posts_per_week, previous_calendar, rng, used_keywords
+            )
+            plans = [
+                self._plan_post(
+                    assignment=assignment,
+                    personas=personas,
+                    post_number=i + 1,
+                    start_date=start_date,
+                    week_number=week_number,
+                    rng=rng
+                )
+                for i, assignment in enumerate(assignments)
+            ]
+            week_plans.append((week_number, start_date, plans))
+            previous_calendar = {"posts": [{"keyword_ids": a['keywords']} for a in assignments]}
+            used_keywords = None
+        
+        return week_plans
+    
+    def _finish_week(self, week_number, start_date, posts, personas, company_names, lexicons,
+                     near_duplicates, usage):
+        """
+        Score a campaign week's posts and build its calendar
+        
+        The week's texts are then added to the near_duplicates index (if
+        given), so later weeks are checked against it.
+        """
+        
+        quality_metrics = self.quality_scorer.score_calendar(
+            posts, personas, company_names=company_names, lexicons=lexicons,
+            near_duplicates=near_duplicates
+        )
+        quality_metrics['usage'] = usage.totals()
+        calendar = self._build_calendar(week_number, start_date, posts, quality_metrics)
+        if near_duplicates is not None:
+            for item_id, text in calendar_texts(posts):
+                near_duplicates.add_text(f"{item_id} (week {week_number})", text)
+        return calendar
+    
+    def _build_calendar(self, week_number, start_date, posts, quality_metrics):
+        end_date = start_date + timedelta(days=6)
+        return {
             "week": week_number,
             "start_date": start_date.strftime("%Y-%m-%d"),
             "end_date": end_date.strftime("%Y-%m-%d"),
@@ -52,28 +249,31 @@ class RedditCalendarGenerator:
             "quality_score": quality_metrics['overall_score'],
             "metrics": quality_metrics
         }
-        
-        return calendar
     
-    def _assign_posts_to_subreddits(self, subreddits, keywords, posts_per_week, previous_calendar):
+    @traced('assign_posts')
+    def _assign_posts_to_subreddits(self, subreddits, keywords, posts_per_week, previous_calendar,
+                                    rng=random, used_keywords=None):
         """
         Intelligently assign posts to subreddits
         """
         
         # Track recent topics if we have previous calendar
-        used_keywords = set()
-        if previous_calendar and 'posts' in previous_calendar:
-            for post in previous_calendar['posts']:
-                used_keywords.update(post.get('keyword_ids', []))
+        if used_keywords is None:
+            used_keywords = set()
+            if previous_calendar and 'posts' in previous_calendar:
+                for post in previous_calendar['posts']:
+                    used_keywords.update(post.get('keyword_ids', []))
         
         # Filter out recently used keywords
-        available_keywords = [k for k in keywords if k not in used_keywords or random.random() > 0.7]
+        available_keywords = [k for k in keywords if k not in used_keywords or rng.random() > 0.7]
         if len(available_keywords) < posts_per_week:
-            available_keywords = keywords
+            available_keywords = list(keywords)
         
-        # Shuffle for variety
-        random.shuffle(available_keywords)
-        random.shuffle(subreddits)
+        # Shuffle for variety (copies, so a seeded run doesn't depend on the
+        # order a previous run left the caller's lists in)
+        subreddits = list(subreddits)
+        rng.shuffle(available_keywords)
+        rng.shuffle(subreddits)
         
         assignments = []
         subreddit_usage = {sub: 0 for sub in subreddits}
@@ -87,7 +287,7 @@ class RedditCalendarGenerator:
             if not available_subs:
                 available_subs = subreddits
             
-            subreddit = random.choice(available_subs)
+            subreddit = rng.choice(available_subs)
             subreddit_usage[subreddit] += 1
             
             assignments.append({
@@ -98,95 +298,130 @@ class RedditCalendarGenerator:
         
         return assignments
     
+    def _iter_posts(self, post_plans, company_info, max_concurrency=None, meters=None, seed=None):
+        """
+        Generate all planned posts over a bounded thread pool, yielding
+        (index, post) as each one finishes
+        
+        meters optionally gives each post a UsageMeter for its LLM calls;
+        seed (the generation's) scopes each post's cached completions.
+        Posts and their comments share one budget of max_concurrency LLM
+        calls in flight.
+        """
+        
+        limit = max(1, max_concurrency or self.max_concurrency)
+        budget = threading.BoundedSemaphore(limit)
+        workers = max(1, min(limit, len(post_plans)))
+        
+        def render(index):
+            plan = post_plans[index]
+            with cache_scope(seed, plan['week_number'], plan['post_id']):
+                if meters is None:
+                    return self._render_post(plan, company_info, limit, budget)
+                with metered(meters[index]):
+                    return self._render_post(plan, company_info, limit, budget)
+        
+        if workers == 1:
+            for index in range(len(post_plans)):
+                yield index, render(index)
+            return
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Each task runs in a copy of this context, so usage meters follow it
+            futures = {
+                executor.submit(contextvars.copy_context().run, render, index): index
+                for index in range(len(post_plans))
+            }
+            try:
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+            finally:
+                # Stopped early (or failed): drop posts that haven't started
+                for future in futures:
+                    future.cancel()
+    
     def _generate_post_with_comments(self, assignment, personas, company_info, 
-                                    post_number, start_date, week_number):
+                                    post_number, start_date, week_number, rng=random):
         """
         Generate a single post with its comment thread
         """
         
+        plan = self._plan_post(
+            assignment=assignment,
+            personas=personas,
+            post_number=post_number,
+            start_date=start_date,
+            week_number=week_number,
+            rng=rng
+        )
+        return self._render_post(plan, company_info)
+    
+    def _plan_post(self, assignment, personas, post_number, start_date, week_number, rng=random):
+        """
+        Make all random choices for a post and its comment thread (no LLM calls)
+        """
+        
         # Distribute posts across the week
         days_offset = [0, 2, 4, 6, 1, 3, 5]
         day_offset = days_offset[post_number % len(days_offset)]
         
         post_time = start_date + timedelta(
             days=day_offset,
-            hours=random.randint(9, 18),
-            minutes=random.randint(0, 59)
+            hours=rng.randint(9, 18),
+            minutes=rng.randint(0, 59)
         )
         
         # Select personas for this thread
-        primary_persona = random.choice(personas)
+        primary_persona = rng.choice(personas)
         
         # Secondary personas (reply)
         other_personas = [p for p in personas if p['username'] != primary_persona['username']]
-        num_commenters = min(random.randint(2, 4), len(other_personas))
-        commenting_personas = random.sample(other_personas, num_commenters)
-        
-        # Generate post content
-        post_data = self.content_gen.generate_post(
-            subreddit=assignment['subreddit'],
-            keywords=assignment['keywords'],
-            persona=primary_persona,
-            company_info=company_info
-        )
+        num_commenters = min(rng.randint(2, 4), len(other_personas))
+        commenting_personas = rng.sample(other_personas, num_commenters)
         
         # Generate post ID
         post_id = f"P{week_number}{post_number}"
         
-        # Generate comments with realistic timing
-        comments = self._generate_comment_thread(
-            post_id=post_id,
-            post_content=post_data['body'],
+        comment_plan = self._plan_comment_thread(
             commenting_personas=commenting_personas,
-            company_info=company_info,
             post_time=post_time,
             week_number=week_number,
-            post_number=post_number
+            post_number=post_number,
+            rng=rng
         )
         
-        post = {
+        return {
             "post_id": post_id,
-            "subreddit": assignment['subreddit'],
-            "title": post_data['title'],
-            "body": post_data['body'],
-            "author_username": primary_persona['username'],
-            "timestamp": post_time.strftime("%Y-%m-%d %H:%M"),
-            "keyword_ids": assignment['keywords'],
-            "comments": comments
+            "week_number": week_number,
+            "assignment": assignment,
+            "persona": primary_persona,
+            "post_time": post_time,
+            "comments": comment_plan
         }
-        
-        return post
     
-    def _generate_comment_thread(self, post_id, post_content, commenting_personas, 
-                                 company_info, post_time, week_number, post_number):
+    def _plan_comment_thread(self, commenting_personas, post_time, week_number, post_number,
+                             rng=random):
         """
-        Generate a natural comment thread with nested replies
+        Plan a natural comment thread: who comments, when, and what they reply to
         """
         
-        comments = []
+        plan = []
         current_time = post_time
         
         # First comment: Natural response, may mention company
-        first_commenter = commenting_personas[0]
-        delay_minutes = random.randint(15, 90)
+        delay_minutes = rng.randint(15, 90)
         current_time += timedelta(minutes=delay_minutes)
         
-        first_comment = self.content_gen.generate_comment(
-            post_content=post_content,
-            persona=first_commenter,
-            company_info=company_info,
-            is_first_comment=True,
-            should_mention_product=random.random() > 0.4  # 60% chance to mention
-        )
-        
         comment_id = f"C{week_number}{post_number}1"
-        comments.append({
+        plan.append({
             "comment_id": comment_id,
-            "post_id": post_id,
+            "persona": commenting_personas[0],
             "parent_comment_id": None,
-            "comment_text": first_comment,
-            "username": first_commenter['username'],
-            "timestamp": current_time.strftime("%Y-%m-%d %H:%M"),
+            "depends_on": None,
+            "is_first_comment": True,
+            "is_reply": False,
+            "should_mention_product": rng.random() > 0.4,  # 60% chance to mention
+            "time": current_time,
             "delay_minutes": delay_minutes
         })
         
@@ -194,34 +429,196 @@ class RedditCalendarGenerator:
         parent_comment_id = comment_id
         
         for i, persona in enumerate(commenting_personas[1:], start=2):
-            delay_minutes = random.randint(10, 120)
+            delay_minutes = rng.randint(10, 120)
             current_time += timedelta(minutes=delay_minutes)
             
             # Decide if this is a reply or new top-level comment
-            is_reply = random.random() > 0.3  # 70% chance it's a reply
-            
-            comment = self.content_gen.generate_comment(
-                post_content=post_content,
-                persona=persona,
-                company_info=company_info,
-                is_first_comment=False,
-                should_mention_product=False,
-                previous_comment=comments[-1]['comment_text'] if is_reply else None
-            )
+            is_reply = rng.random() > 0.3  # 70% chance it's a reply
             
             comment_id = f"C{week_number}{post_number}{i}"
-            comments.append({
+            plan.append({
                 "comment_id": comment_id,
-                "post_id": post_id,
+                "persona": persona,
                 "parent_comment_id": parent_comment_id if is_reply else None,
-                "comment_text": comment,
-                "username": persona['username'],
-                "timestamp": current_time.strftime("%Y-%m-%d %H:%M"),
+                # Replies are written against the comment right before them
+                "depends_on": len(plan) - 1 if is_reply else None,
+                "is_first_comment": False,
+                "is_reply": is_reply,
+                "should_mention_product": False,
+                "time": current_time,
                 "delay_minutes": delay_minutes
             })
             
             # Sometimes update parent for nested threads
-            if is_reply and random.random() > 0.5:
+            if is_reply and rng.random() > 0.5:
                 parent_comment_id = comment_id
         
+        return plan
+    
+    @traced('render_post')
+    def _render_post(self, plan, company_info, max_concurrency=1, budget=None):
+        """
+        Generate the text for a planned post and its comment thread
+        
+        budget is a semaphore held for every LLM call (shared with the
+        calendar's other posts); by default the thread gets its own.
+        """
+        
+        assignment = plan['assignment']
+        prewritten = None
+        budget = budget or threading.BoundedSemaphore(max_concurrency)
+        
+        # Generate post content
+        if self.thread_mode == 'single_call':
+            with budget:
+                post_data = self.content_gen.generate_thread(
+                    subreddit=assignment['subreddit'],
+                    keywords=assignment['keywords'],
+                    persona=plan['persona'],
+                    company_info=company_info,
+                    commenters=self._thread_commenters(plan)
+                )
+            prewritten = post_data['comments']
+        else:
+            with budget:
+                post_data = self.content_gen.generate_post(
+                    subreddit=assignment['subreddit'],
+                    keywords=assignment['keywords'],
+                    persona=plan['persona'],
+                    company_info=company_info,
+                    stream=self.stream
+                )
+        
+        # Generate comments with realistic timing
+        comments = self._generate_comment_thread(
+            post_id=plan['post_id'],
+            post_content=post_data['body'],
+            comment_plan=plan['comments'],
+            company_info=company_info,
+            max_concurrency=max_concurrency,
+            prewritten=prewritten,
+            budget=budget
+        )
+        
+        return self._post_record(plan, post_data, comments)
+    
+    def _thread_commenters(self, plan):
+        """
+        generate_thread's commenters list for a planned post
+        """
+        return [
+            {
+                "persona": slot['persona'],
+                "reply_to": slot['depends_on'],
+                "mention_product": slot['should_mention_product']
+            }
+            for slot in plan['comments']
+        ]
+    
+    def _post_record(self, plan, post_data, comments):
+        """
+        The calendar entry for a planned post, given its text and comments
+        """
+        
+        assignment = plan['assignment']
+        return Post(
+            post_id=plan['post_id'],
+            subreddit=assignment['subreddit'],
+            title=post_data['title'],
+            body=post_data['body'],
+            author_username=plan['persona']['username'],
+            minutes=to_minutes(plan['post_time']),
+            keyword_ids=assignment['keywords'],
+            comments=comments
+        )
+    
+    @traced('comment_thread')
+    def _generate_comment_thread(self, post_id, post_content, comment_plan, company_info,
+                                 max_concurrency=1, prewritten=None, budget=None):
+        """
+        Generate a natural comment thread with nested replies
+        
+        prewritten holds comment texts that already exist (e.g. from a
+        single-call thread); only the missing ones are generated. Each
+        comment's LLM call holds budget (a semaphore of max_concurrency
+        calls by default).
+        """
+        
+        texts = list(prewritten) if prewritten else [None] * len(comment_plan)
+        budget = budget or threading.BoundedSemaphore(max_concurrency)
+        
+        def write(index):
+            inputs = self._comment_inputs(comment_plan[index], texts, post_content, company_info)
+            with budget:
+                texts[index] = self.content_gen.generate_comment(**inputs, stream=self.stream)
+        
+        # Run the thread wave by wave: each wave holds every comment whose
+        # input (the post, or the comment it replies to) is already written
+        waves = [[index for index in wave if texts[index] is None] for wave in self._comment_waves(comment_plan)]
+        waves = [wave for wave in waves if wave]
+        workers = min(max_concurrency, max(map(len, waves), default=0))
+        if workers <= 1:
+            for wave in waves:
+                for index in wave:
+                    write(index)
+            return self._comment_records(post_id, comment_plan, texts)
+        
+        # One pool for every wave (the budget, not the pool, bounds the calls in flight)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for wave in waves:
+                futures = [executor.submit(contextvars.copy_context().run, write, index) for index in wave]
+                for future in futures:
+                    future.result()
+        
+        return self._comment_records(post_id, comment_plan, texts)
+    
+    def _comment_records(self, post_id, comment_plan, texts):
+        """
+        The calendar entries for a planned comment thread, given its texts
+        """
+        
+        comments = []
+        for slot, comment in zip(comment_plan, texts):
+            comments.append(Comment(
+                comment_id=slot['comment_id'],
+                post_id=post_id,
+                parent_comment_id=slot['parent_comment_id'],
+                comment_text=comment,
+                username=slot['persona']['username'],
+                minutes=to_minutes(slot['time']),
+                delay_minutes=slot['delay_minutes']
+            ))
+        
         return comments
+    
+    def _comment_inputs(self, slot, texts, post_content, company_info):
+        """
+        generate_comment arguments for a planned comment (its parent's text must be written)
+        """
+        
+        previous = slot['depends_on']
+        return {
+            "post_content": post_content,
+            "persona": slot['persona'],
+            "company_info": company_info,
+            "is_first_comment": slot['is_first_comment'],
+            "should_mention_product": slot['should_mention_product'],
+            "previous_comment": texts[previous] if previous is not None else None
+        }
+    
+    def _comment_waves(self, comment_plan):
+        """
+        Group planned comments into dependency levels of the thread DAG
+        """
+        
+        levels = []
+        waves = []
+        for index, slot in enumerate(comment_plan):
+            previous = slot['depends_on']
+            level = levels[previous] + 1 if previous is not None else 0
+            levels.append(level)
+            if level == len(waves):
+                waves.append([])
+            waves[level].append(index)
+        
+        return waves
@@ -1,82 +1,304 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+from werkzeug.http import generate_etag
 import os
 from dotenv import load_dotenv
-from algorithm import RedditCalendarGenerator
+from calendar_model import CalendarJSONProvider, json_default, packb, wants_msgpack
+from coalescing import ResultCache, SingleFlight
+from calendar_service import (
+    CAMPAIGN_FIELDS, CalendarService,
+    create_cache, create_campaign_store, create_generator, error_status
+)
+from job_queue import queue_from_env
+from serving import Drain
+from telemetry import REGISTRY, RESULT_REQUESTS, SharedMetrics
 import json
 
 load_dotenv()
 
 app = Flask(__name__)
+app.json = CalendarJSONProvider(app)
 CORS(app)
 
+# LLM response cache (memory LRU, plus SQLite when LLM_CACHE_PATH is set)
+llm_cache = create_cache()
+
 # Initialize the calendar generator
-generator = RedditCalendarGenerator(api_key=os.getenv('OPENAI_API_KEY'))
+generator = create_generator(llm_cache)
+
+# Server-side campaign history, so clients only send a campaign_id
+campaign_store = create_campaign_store()
+
+# Weeks of keyword history avoided when generating a campaign week
+CAMPAIGN_LOOKBACK_WEEKS = int(os.getenv('CAMPAIGN_LOOKBACK_WEEKS', 4))
+
+calendar_service = CalendarService(generator, campaign_store, lookback_weeks=CAMPAIGN_LOOKBACK_WEEKS)
+
+# Durable queue drained by worker.py (async generation)
+job_queue = queue_from_env()
+
+# With several server processes (gunicorn sets METRICS_DIR), /api/metrics sums them all
+shared_metrics = SharedMetrics(os.environ['METRICS_DIR']) if os.getenv('METRICS_DIR') else None
+
+# Identical generation requests share one run while it is in flight, and
+# finished calendars are served again for RESULT_CACHE_TTL seconds
+result_cache = ResultCache(
+    max_entries=int(os.getenv('RESULT_CACHE_SIZE', 256)),
+    ttl_seconds=int(os.getenv('RESULT_CACHE_TTL', 600))
+)
+single_flight = SingleFlight()
+
+# In-flight generations, waited for before a web worker exits (see gunicorn.conf.py)
+drain = Drain()
+
+def shutting_down():
+    """
+    503 for a generation that reaches a worker after it started shutting down
+    """
+    return jsonify({"error": "Server is shutting down, please retry"}), 503
+
+def respond(payload, status=200, rendered=None):
+    """
+    A calendar response: MessagePack if the Accept header asks for it, JSON otherwise
+    
+    The response carries an ETag of its body; a request whose If-None-Match
+    already holds it gets an empty 304. rendered ({mimetype: (body, etag)})
+    keeps the bodies of a result that is served many times.
+    """
+    mimetype = 'application/msgpack' if wants_msgpack(request.accept_mimetypes) else 'application/json'
+    if rendered is None:
+        rendered = {}
+    if mimetype not in rendered:
+        body = packb(payload) if mimetype == 'application/msgpack' else app.json.response(payload).get_data()
+        rendered[mimetype] = (body, generate_etag(body))
+    body, etag = rendered[mimetype]
+    
+    if status == 200 and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, status=status, mimetype=mimetype)
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    return response
+
+def coalesced_generate(kind, data):
+    """
+    The result of a generation request, shared with identical requests
+    
+    Returns {"payload", "rendered"}. A cached result is reused unless the
+    request sends Cache-Control: no-cache; otherwise the request joins an
+    identical one in flight or runs the generation itself.
+    """
+    key, cacheable = calendar_service.request_key(kind, data)
+    if cacheable and not request.cache_control.no_cache:
+        result = result_cache.get(key)
+        if result is not None:
+            RESULT_REQUESTS.inc(outcome='cached')
+            return result
+    
+    def generate():
+        result = {"payload": calendar_service.generate(kind, data), "rendered": {}}
+        if cacheable:
+            result_cache.set(key, result)
+        return result
+    
+    result, shared = single_flight.do(key, generate)
+    RESULT_REQUESTS.inc(outcome='coalesced' if shared else 'generated')
+    return result
+
+def run_calendar_request(kind):
+    """
+    Run a generate-calendar / generate-next-week / generate-campaign request synchronously
+    """
+    if drain.draining:
+        return shutting_down()
+    
+    with drain.track():
+        try:
+            result = coalesced_generate(kind, request.json)
+            return respond(result['payload'], rendered=result['rendered'])
+        except Exception as e:
+            return jsonify({"error": str(e)}), error_status(e)
+
+def format_sse(event, payload):
+    """
+    One Server-Sent Events message
+    """
+    return f"event: {event}\ndata: {json.dumps(payload, default=json_default)}\n\n"
+
+def stream_calendar_request(kind):
+    """
+    Run a calendar request as an SSE stream: a `post` event per finished
+    post, then `quality_metrics`, then `calendar` (the usual response body);
+    campaigns send a `week` event per finished week, then `campaign`
+    """
+    if drain.draining:
+        return shutting_down()
+    
+    data = request.json
+    try:
+        # Report bad input as a normal error response, before the stream starts
+        calendar_service.prepare(kind, dict(data))
+    except Exception as e:
+        return jsonify({"error": str(e)}), error_status(e)
+    
+    def events():
+        for event, payload in calendar_service.stream(kind, data):
+            yield format_sse(event, payload)
+    
+    response = Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # don't let proxies buffer the stream
+    })
+    # In flight until the stream is closed (finished or disconnected)
+    drain.enter()
+    response.call_on_close(drain.exit)
+    return response
 
 @app.route('/api/health', methods=['GET'])
 def health():
-    """Health check endpoint"""
+    """Health check endpoint (503 while the worker drains, so load balancers move on)"""
+    if drain.draining:
+        return jsonify({"status": "draining", **drain.stats()}), 503
     return jsonify({"status": "healthy"})
 
-@app.route('/api/generate-calendar', methods=['POST'])
-def generate_calendar():
-    """Generate initial content calendar"""
+@app.route('/api/cache-stats', methods=['GET'])
+def cache_stats():
+    """LLM cache hit/miss counters (and the generation result cache under "results")"""
+    return jsonify({**llm_cache.stats(), "results": {**result_cache.stats(), "coalesced": single_flight.shared}})
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Stage latencies and counters in the Prometheus text format (summed over the server's workers)"""
+    text = shared_metrics.render() if shared_metrics is not None else REGISTRY.render()
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/campaigns', methods=['POST'])
+def create_campaign():
+    """Store campaign inputs server-side and return a campaign ID"""
     try:
         data = request.json
         
-        # Validate input
-        required_fields = ['company_info', 'personas', 'subreddits', 'keywords', 'posts_per_week']
-        for field in required_fields:
+        for field in CAMPAIGN_FIELDS:
             if field not in data:
                 return jsonify({"error": f"Missing required field: {field}"}), 400
         
-        # Validate personas (at least 2)
         if len(data['personas']) < 2:
             return jsonify({"error": "At least 2 personas required"}), 400
         
-        # Generate calendar
-        calendar = generator.generate_calendar(
-            company_info=data['company_info'],
-            personas=data['personas'],
-            subreddits=data['subreddits'],
-            keywords=data['keywords'],
-            posts_per_week=data['posts_per_week'],
-            week_number=1
-        )
-        
-        return jsonify(calendar)
-        
+        campaign_id = campaign_store.create_campaign({field: data[field] for field in CAMPAIGN_FIELDS})
+        return jsonify({"campaign_id": campaign_id}), 201
+    
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/campaigns/<campaign_id>', methods=['GET'])
+def get_campaign(campaign_id):
+    """Campaign inputs, saved weeks and usage history"""
+    config = campaign_store.get_campaign(campaign_id)
+    if config is None:
+        return jsonify({"error": f"Unknown campaign: {campaign_id}"}), 404
+    
+    return jsonify({
+        "campaign_id": campaign_id,
+        "config": config,
+        "weeks": campaign_store.list_weeks(campaign_id),
+        "keyword_last_used": campaign_store.keyword_last_used(campaign_id),
+        "subreddit_usage": campaign_store.subreddit_usage(campaign_id),
+        "persona_activity": campaign_store.persona_activity(campaign_id)
+    })
+
+@app.route('/api/campaigns/<campaign_id>/weeks/<int:week>', methods=['GET'])
+def get_campaign_week(campaign_id, week):
+    """A saved campaign week"""
+    calendar = campaign_store.get_week(campaign_id, week)
+    if calendar is None:
+        return jsonify({"error": f"Week {week} not found"}), 404
+    return respond(calendar)
+
+@app.route('/api/generate-calendar', methods=['POST'])
+def generate_calendar():
+    """Generate initial content calendar"""
+    return run_calendar_request('generate-calendar')
+
 @app.route('/api/generate-next-week', methods=['POST'])
 def generate_next_week():
     """Generate content calendar for subsequent weeks"""
+    return run_calendar_request('generate-next-week')
+
+@app.route('/api/generate-calendar/stream', methods=['POST'])
+def generate_calendar_stream():
+    """Generate initial content calendar, streaming posts as they finish"""
+    return stream_calendar_request('generate-calendar')
+
+@app.route('/api/generate-next-week/stream', methods=['POST'])
+def generate_next_week_stream():
+    """Generate next week's calendar, streaming posts as they finish"""
+    return stream_calendar_request('generate-next-week')
+
+@app.route('/api/generate-campaign', methods=['POST'])
+def generate_campaign():
+    """Generate several consecutive weeks in one pipelined run"""
+    return run_calendar_request('generate-campaign')
+
+@app.route('/api/generate-campaign/stream', methods=['POST'])
+def generate_campaign_stream():
+    """Generate several weeks, streaming each week's calendar as it completes"""
+    return stream_calendar_request('generate-campaign')
+
+@app.route('/api/regenerate', methods=['POST'])
+def regenerate():
+    """Rewrite only the posts and comments behind a calendar's quality warnings"""
+    if drain.draining:
+        return shutting_down()
+    
+    with drain.track():
+        try:
+            return respond(calendar_service.regenerate(request.json))
+        except Exception as e:
+            return jsonify({"error": str(e)}), error_status(e)
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """Queue a calendar generation and return its job ID right away"""
     try:
-        data = request.json
-        
-        # Validate input
-        required_fields = ['company_info', 'personas', 'subreddits', 'keywords', 'posts_per_week', 'week_number']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({"error": f"Missing required field: {field}"}), 400
-        
-        # Generate next week
-        calendar = generator.generate_calendar(
-            company_info=data['company_info'],
-            personas=data['personas'],
-            subreddits=data['subreddits'],
-            keywords=data['keywords'],
-            posts_per_week=data['posts_per_week'],
-            week_number=data['week_number'],
-            previous_calendar=data.get('previous_calendar')
-        )
+        data = dict(request.json)
+        kind = data.pop('type', 'generate-calendar')
+        tenant = request.headers.get('X-Tenant-ID') or data.pop('tenant', None) or 'default'
         
-        return jsonify(calendar)
+        # Reject bad input now rather than in the worker
+        calendar_service.prepare(kind, dict(data))
         
+        job_id = job_queue.submit(kind, data, tenant=tenant)
+        return jsonify({
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": f"/api/jobs/{job_id}",
+            "result_url": f"/api/jobs/{job_id}/result"
+        }), 202
+    
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Job status"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    return jsonify(job)
 
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """The generated calendar once the job has succeeded (202 while it is pending)"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    if job['status'] == 'failed':
+        return jsonify({"error": job['error'], "job_id": job_id}), 500
+    if job['status'] != 'succeeded':
+        return jsonify(job), 202
+    return respond(job_queue.result(job_id))
 
 if __name__ == '__main__':
     import os
@@ -0,0 +1,350 @@
+"""
+Generate campaigns offline through the OpenAI Batch API
+
+Usage:
+    python batch_generation.py campaigns.jsonl -o calendars.jsonl
+    python batch_generation.py campaigns.jsonl --local        # offline run with synthetic replies
+
+Each input line is a generate-campaign request body (a campaign_id fills
+missing fields from the campaign store, and the generated weeks are saved
+to it). All campaigns are written together, one batch per phase: the
+posts first, then each level of comment replies. Batches take up to 24
+hours and cost half as much as live calls, which suits overnight bulk runs.
+
+Writes one JSON line per input line, in input order: {"weeks": [...]} (plus
+"campaign_id") or {"error"} for a request that could not be run.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from calendar_model import json_default
+from calendar_service import CalendarService, create_campaign_store, create_generator
+from content_generator import MODEL, extract_company_name
+from llm_transport import BATCH_DONE_STATUSES, LocalBatchTransport, OpenAIBatchTransport, TransportError
+from llm_usage import UsageMeter, metered, record_usage
+from near_duplicates import NearDuplicateIndex
+from telemetry import traced
+
+# Seconds between status checks of a running batch
+POLL_INTERVAL = 60
+
+# Batches a failing request is submitted in before it is sent live instead
+MAX_ATTEMPTS = 3
+
+class BatchCampaignGenerator:
+    """
+    Generates campaigns through a batch transport instead of live calls
+
+    Campaigns are planned exactly as generate_campaign plans them (the same
+    seed gives the same posts, personas and timing), and every request uses
+    the prompt live generation would send. The text is then written in
+    phases, each one batch shared by all campaigns: every post (or whole
+    thread, in single_call mode) first, then the comments level by level,
+    since a reply's prompt includes the comment it replies to.
+    """
+    
+    def __init__(self, generator, batch_transport, work_dir=None, poll_interval=POLL_INTERVAL,
+                 max_attempts=MAX_ATTEMPTS, sleep=time.sleep):
+        self.generator = generator
+        self.content_gen = generator.content_gen
+        self.batch_transport = batch_transport
+        # Batch input files are kept here (one per submitted batch)
+        self.work_dir = work_dir or os.getenv('BATCH_DIR', 'batches')
+        self.poll_interval = poll_interval
+        self.max_attempts = max(1, max_attempts)
+        self.sleep = sleep
+    
+    def generate_campaign(self, **campaign):
+        """
+        Generate one campaign (generate_campaign's arguments); returns its calendars
+        """
+        return self.generate_campaigns([campaign])[0]
+    
+    def generate_campaigns(self, campaigns):
+        """
+        Generate several campaigns in shared batches; returns each one's calendars
+
+        campaigns is a list of generate_campaign keyword dicts: company_info,
+        personas, subreddits, keywords, posts_per_week, weeks and optionally
+        start_week, previous_calendar, used_keywords, seed, lexicons and
+        near_duplicates.
+        """
+        
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        
+        # Step 1: Plan every week of every campaign (no LLM calls)
+        week_plans = []
+        threads = []
+        for k, campaign in enumerate(campaigns):
+            plans_by_week = self.generator._plan_weeks(
+                campaign['personas'], campaign['subreddits'], campaign['keywords'],
+                campaign['posts_per_week'], campaign['weeks'], campaign.get('start_week', 1),
+                campaign.get('previous_calendar'), campaign.get('used_keywords'), campaign.get('seed')
+            )
+            meters = [UsageMeter() for _ in plans_by_week]
+            week_plans.append((plans_by_week, meters))
+            for w, (_, _, plans) in enumerate(plans_by_week):
+                for i, plan in enumerate(plans):
+                    threads.append({
+                        "id": f"{k}-{w}-{i}",
+                        "plan": plan,
+                        "company_info": campaign['company_info'],
+                        "meter": meters[w],
+                        "post": None,
+                        "texts": [None] * len(plan['comments'])
+                    })
+        
+        # Step 2: Write every post (or whole thread)
+        requests = {}
+        for thread in threads:
+            plan = thread['plan']
+            assignment = plan['assignment']
+            if self.generator.thread_mode == 'single_call':
+                requests[thread['id']] = self.content_gen.thread_request(
+                    assignment['subreddit'], assignment['keywords'], plan['persona'],
+                    thread['company_info'], self.generator._thread_commenters(plan)
+                )
+            else:
+                requests[thread['id']] = self.content_gen.post_request(
+                    assignment['subreddit'], assignment['keywords'], plan['persona'], thread['company_info']
+                )
+        replies = self.run_batch(requests, f"{run_id}-posts")
+        
+        for thread in threads:
+            keywords = thread['plan']['assignment']['keywords']
+            content = self._reply(thread, replies)
+            if self.generator.thread_mode == 'single_call':
+                thread_data = self.content_gen.parse_thread(content, keywords, len(thread['texts']))
+                thread['texts'] = thread_data['comments']
+                thread['post'] = thread_data
+            else:
+                thread['post'] = self.content_gen.parse_post(content, keywords)
+        
+        # Step 3: Write the comments one level of the thread DAGs at a time
+        # (only the ones still missing: a single call may have written them)
+        waves = [self.generator._comment_waves(thread['plan']['comments']) for thread in threads]
+        for level in range(max((len(w) for w in waves), default=0)):
+            requests = {}
+            for thread, thread_waves in zip(threads, waves):
+                if level >= len(thread_waves):
+                    continue
+                for index in thread_waves[level]:
+                    if thread['texts'][index] is None:
+                        inputs = self.generator._comment_inputs(
+                            thread['plan']['comments'][index], thread['texts'],
+                            thread['post']['body'], thread['company_info']
+                        )
+                        requests[f"{thread['id']}-{index}"] = self.content_gen.comment_request(**inputs)
+            if not requests:
+                continue
+            
+            replies = self.run_batch(requests, f"{run_id}-comments{level + 1}")
+            for thread, thread_waves in zip(threads, waves):
+                if level >= len(thread_waves):
+                    continue
+                for index in thread_waves[level]:
+                    custom_id = f"{thread['id']}-{index}"
+                    if custom_id in replies:
+                        thread['texts'][index] = self.content_gen.parse_comment(
+                            self._reply(thread, replies, custom_id)
+                        )
+        
+        # Step 4: Build and score the calendars, week by week
+        results = []
+        position = 0
+        for campaign, (plans_by_week, meters) in zip(campaigns, week_plans):
+            company_names = [extract_company_name(campaign['company_info'])]
+            calendars = []
+            for (week_number, start_date, plans), meter in zip(plans_by_week, meters):
+                posts = []
+                for thread in threads[position:position + len(plans)]:
+                    plan = thread['plan']
+                    comments = self.generator._comment_records(plan['post_id'], plan['comments'], thread['texts'])
+                    posts.append(self.generator._post_record(plan, thread['post'], comments))
+                position += len(plans)
+                calendars.append(self.generator._finish_week(
+                    week_number, start_date, posts, campaign['personas'], company_names,
+                    campaign.get('lexicons'), campaign.get('near_duplicates'), meter
+                ))
+            results.append(calendars)
+        
+        return results
+    
+    @traced('batch_phase')
+    def run_batch(self, requests, name):
+        """
+        Run {custom_id: request} (from the *_request builders) as a batch
+
+        Returns {custom_id: {"content", "usage"}}. Requests that fail (or are
+        left over by an expired batch) are resubmitted in a new batch, up to
+        max_attempts batches, then sent live through the generator's transport.
+        """
+        
+        replies = {}
+        pending = dict(requests)
+        for attempt in range(1, self.max_attempts + 1):
+            if not pending:
+                break
+            path = self._write_batch(pending, f"{name}-{attempt}")
+            batch_id = self.batch_transport.submit(path)
+            status = self._wait(batch_id)
+            if status == 'failed':
+                # The whole input was rejected: resubmitting it would fail the same way
+                raise TransportError(f"Batch {batch_id} failed (input file {path})")
+            
+            for line in self.batch_transport.results(batch_id):
+                custom_id = line.get('custom_id')
+                reply = _parse_result(line)
+                if custom_id in pending and reply is not None:
+                    replies[custom_id] = reply
+                    del pending[custom_id]
+        
+        for custom_id, request in pending.items():
+            params = dict(request)
+            messages = params.pop('messages')
+            temperature = params.pop('temperature')
+            response = self.content_gen.transport.complete(MODEL, messages, temperature, **params)
+            replies[custom_id] = {"content": response['content'], "usage": response.get('usage')}
+        
+        return replies
+    
+    def _wait(self, batch_id):
+        """
+        Poll a batch until it has finished; returns its final status
+        """
+        while True:
+            status = self.batch_transport.poll(batch_id)
+            if status in BATCH_DONE_STATUSES:
+                return status
+            self.sleep(self.poll_interval)
+    
+    def _write_batch(self, requests, name):
+        """
+        Compile requests into a Batch API input file; returns its path
+        """
+        os.makedirs(self.work_dir, exist_ok=True)
+        path = os.path.join(self.work_dir, f"{name}.jsonl")
+        with open(path, 'w', encoding='utf-8') as f:
+            for custom_id, request in requests.items():
+                line = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {"model": MODEL, **request}
+                }
+                f.write(json.dumps(line, ensure_ascii=False) + '\n')
+        return path
+    
+    def _reply(self, thread, replies, custom_id=None):
+        """
+        A reply's text, with its usage added to the thread's week
+        """
+        reply = replies[custom_id or thread['id']]
+        with metered(thread['meter']):
+            record_usage(reply['usage'])
+        return reply['content']
+
+def _parse_result(line):
+    """
+    {"content", "usage"} from a batch result line, or None for a failed request
+    """
+    response = line.get('response') or {}
+    if line.get('error') or response.get('status_code') != 200:
+        return None
+    body = response.get('body') or {}
+    try:
+        content = body['choices'][0]['message']['content']
+    except (KeyError, IndexError, TypeError):
+        return None
+    return {"content": (content or '').strip(), "usage": body.get('usage')}
+
+def run_requests(service, batch_generator, requests):
+    """
+    Run generate-campaign request bodies as one batch job; returns one result per request
+    """
+    
+    results = [None] * len(requests)
+    campaigns = []
+    owners = []
+    for position, data in enumerate(requests):
+        try:
+            data, campaign_id, used_keywords = service.prepare('generate-campaign', dict(data))
+        except (ValueError, LookupError) as e:
+            results[position] = {"error": str(e)}
+            continue
+        
+        if campaign_id:
+            near_duplicates = service.campaign_store.near_duplicate_index(
+                campaign_id, before_week=data.get('week_number', 1)
+            )
+        else:
+            near_duplicates = NearDuplicateIndex()
+        campaigns.append({
+            "company_info": data['company_info'],
+            "personas": data['personas'],
+            "subreddits": data['subreddits'],
+            "keywords": data['keywords'],
+            "posts_per_week": data['posts_per_week'],
+            "weeks": data['weeks'],
+            "start_week": data.get('week_number', 1),
+            "previous_calendar": data.get('previous_calendar'),
+            "used_keywords": used_keywords,
+            "seed": data.get('seed'),
+            "lexicons": data.get('lexicons'),
+            "near_duplicates": near_duplicates
+        })
+        owners.append((position, campaign_id))
+    
+    for (position, campaign_id), calendars in zip(owners, batch_generator.generate_campaigns(campaigns)):
+        result = {"weeks": calendars}
+        if campaign_id:
+            for calendar in calendars:
+                service.campaign_store.save_week(campaign_id, calendar)
+            result['campaign_id'] = campaign_id
+        results[position] = result
+    
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('requests', help="JSONL file of generate-campaign requests ('-' for stdin)")
+    parser.add_argument('-o', '--output', default='-', help="JSONL output file ('-' for stdout)")
+    parser.add_argument('--local', action='store_true', help='run batches offline with synthetic replies')
+    parser.add_argument('--work-dir', default=None, help='where batch input files are kept (default: BATCH_DIR or batches/)')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL, help='seconds between batch status checks')
+    args = parser.parse_args(argv)
+    
+    source = sys.stdin if args.requests == '-' else open(args.requests, encoding='utf-8')
+    try:
+        requests = [json.loads(line) for line in source if line.strip()]
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    
+    if args.local:
+        batch_transport = LocalBatchTransport()
+    else:
+        batch_transport = OpenAIBatchTransport(os.getenv('OPENAI_API_KEY'))
+    service = CalendarService(create_generator(), create_campaign_store())
+    batch_generator = BatchCampaignGenerator(service.generator, batch_transport, args.work_dir,
+                                             poll_interval=args.poll_interval)
+    results = run_requests(service, batch_generator, requests)
+    
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        for result in results:
+            output.write(json.dumps(result, ensure_ascii=False, default=json_default) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    
+    errors = sum('error' in result for result in results)
+    print(f"📦 Generated {len(results) - errors} campaigns ({errors} errors)", file=sys.stderr)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
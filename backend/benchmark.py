@@ -0,0 +1,244 @@
+"""
+Performance benchmarks for the generation pipeline and QualityScorer
+
+Usage:
+    python benchmark.py                      # run, write results, compare to baseline
+    python benchmark.py --quick              # smaller sizes (for CI)
+    python benchmark.py --update-baseline    # store this run as the new baseline
+
+Exits with status 1 when any benchmark is slower than the baseline by more
+than the tolerance.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from algorithm import RedditCalendarGenerator
+from llm_transport import SyntheticTransport
+from quality_scorer import QualityScorer
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, 'results.json')
+
+# Differences smaller than this are timer noise, not regressions
+NOISE_FLOOR_SECONDS = 0.002
+
+SCORER_SIZES = [5, 50, 500, 5000, 50000]
+QUICK_SCORER_SIZES = [5, 50, 500, 5000]
+
+WORDS = ['deck', 'slides', 'workflow', 'template', 'tool', 'design', 'pitch', 'client',
+         'format', 'hours', 'team', 'startup', 'notes', 'font', 'chart', 'export']
+OPENERS = ['yeah', 'lol same', 'tbh', 'ngl', 'honestly', 'imo', 'totally', "i've been using"]
+
+
+def make_personas(count):
+    return [{"username": f"user_{i}", "info": f"Persona number {i}"} for i in range(count)]
+
+
+def make_calendar_posts(num_posts, personas, seed=0):
+    """
+    Build a synthetic calendar with the same shape generate_calendar returns
+    """
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 6, 9, 0)
+    posts = []
+    for n in range(num_posts):
+        post_time = start + timedelta(minutes=rng.randint(0, 7 * 24 * 60))
+        author = rng.choice(personas)
+        post_id = f"P1{n + 1}"
+        comments = []
+        current = post_time
+        for c in range(rng.randint(2, 4)):
+            delay = rng.randint(10, 120)
+            current += timedelta(minutes=delay)
+            text = f"{rng.choice(OPENERS)} " + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 30)))
+            if rng.random() < 0.2:
+                text += '!'
+            comments.append({
+                "comment_id": f"C1{n + 1}{c + 1}",
+                "post_id": post_id,
+                "parent_comment_id": None if c == 0 else f"C1{n + 1}{c}",
+                "comment_text": text,
+                "username": rng.choice(personas)['username'],
+                "timestamp": current.strftime("%Y-%m-%d %H:%M"),
+                "delay_minutes": delay
+            })
+        posts.append({
+            "post_id": post_id,
+            "subreddit": f"r/sub{rng.randint(0, 20)}",
+            "title": ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 10))).capitalize(),
+            "body": ' '.join(rng.choice(WORDS) for _ in range(rng.randint(10, 40))),
+            "author_username": author['username'],
+            "timestamp": post_time.strftime("%Y-%m-%d %H:%M"),
+            "keyword_ids": [f"K{rng.randint(1, 200)}"],
+            "comments": comments
+        })
+    return posts
+
+
+def time_call(fn, repeat):
+    """
+    Median wall time of fn over repeat runs
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {"seconds": statistics.median(samples), "min_seconds": min(samples), "runs": repeat}
+
+
+def peak_memory_kb(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def bench_scorer(sizes):
+    results = {}
+    scorer = QualityScorer()
+    personas = make_personas(8)
+    for size in sizes:
+        posts = make_calendar_posts(size, personas)
+        run = lambda: scorer.score_calendar(posts, personas)
+        result = time_call(run, 5 if size <= 5000 else 2)
+        result['peak_kb'] = peak_memory_kb(run)
+        results[f"score_calendar[{size}]"] = result
+    return results
+
+
+def bench_assignment(quick):
+    generator = RedditCalendarGenerator(api_key=None, transport=SyntheticTransport())
+    results = {}
+    cases = [(50, 500, 50), (500, 5000, 200)] if quick else [(50, 500, 50), (500, 5000, 200), (2000, 20000, 1000)]
+    for num_subs, num_keywords, posts_per_week in cases:
+        subreddits = [f"r/sub{i}" for i in range(num_subs)]
+        keywords = [f"keyword {i}" for i in range(num_keywords)]
+        previous = {"posts": [{"keyword_ids": [k]} for k in keywords[::3]]}
+        run = lambda: generator._assign_posts_to_subreddits(
+            subreddits, keywords, posts_per_week, previous, random.Random(0)
+        )
+        results[f"assign[subs={num_subs},keywords={num_keywords},posts={posts_per_week}]"] = time_call(run, 5)
+    return results
+
+
+def bench_end_to_end(quick):
+    """
+    generate_calendar against the synthetic backend with injected latency
+    """
+    latency = 0.02
+    personas = make_personas(5)
+    subreddits = [f"r/sub{i}" for i in range(6)]
+    keywords = [f"keyword {i}" for i in range(20)]
+    posts_per_week = 5 if quick else 10
+
+    modes = [
+        ("serial", {"max_concurrency": 1}),
+        ("concurrent[4]", {"max_concurrency": 4}),
+        ("concurrent[8]", {"max_concurrency": 8}),
+        ("single_call[4]", {"max_concurrency": 4, "thread_mode": "single_call"}),
+    ]
+
+    results = {}
+    for name, options in modes:
+        transport = SyntheticTransport(latency=latency, seed=0)
+        generator = RedditCalendarGenerator(api_key=None, transport=transport, **options)
+        run = lambda: generator.generate_calendar(
+            "SlideForge - AI presentation tool", personas, subreddits, keywords,
+            posts_per_week, seed=0
+        )
+        result = time_call(run, 1)
+        result['llm_calls'] = transport.calls
+        result['injected_latency'] = latency
+        results[f"generate_calendar.{name}[posts={posts_per_week}]"] = result
+    return results
+
+
+def run_benchmarks(quick=False):
+    results = {}
+    results.update(bench_scorer(QUICK_SCORER_SIZES if quick else SCORER_SIZES))
+    results.update(bench_assignment(quick))
+    results.update(bench_end_to_end(quick))
+    return {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": quick
+        },
+        "results": results
+    }
+
+
+def compare(report, baseline, tolerance):
+    """
+    Return a list of regressions (benchmarks slower than baseline * (1 + tolerance))
+    """
+    regressions = []
+    for name, result in report['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        limit = base['seconds'] * (1 + tolerance)
+        ratio = result['seconds'] / base['seconds'] if base['seconds'] else 1.0
+        result['baseline_seconds'] = base['seconds']
+        result['ratio'] = round(ratio, 3)
+        if result['seconds'] > limit and result['seconds'] - base['seconds'] > NOISE_FLOOR_SECONDS:
+            regressions.append(f"{name}: {result['seconds']:.4f}s vs baseline {base['seconds']:.4f}s ({ratio:.2f}x)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, skips the largest cases')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='where to write JSON results')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown (0.25 = 25%%)')
+    parser.add_argument('--update-baseline', action='store_true', help='save this run as the baseline')
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(quick=args.quick)
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+    report['regressions'] = regressions
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({"meta": report['meta'], "results": report['results']}, f, indent=2)
+        print(f"📌 Baseline updated: {args.baseline}")
+
+    for name, result in report['results'].items():
+        ratio = f"  ({result['ratio']:.2f}x baseline)" if 'ratio' in result else ''
+        print(f"  • {name}: {result['seconds'] * 1000:.2f} ms{ratio}")
+
+    if regressions:
+        print("\n❌ Performance regressions:")
+        for regression in regressions:
+            print(f"  • {regression}")
+        return 1
+
+    print(f"\n✅ Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+import json
+import re
+from collections.abc import Mapping
+from datetime import datetime, timedelta
+from functools import lru_cache
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Optional: without orjson responses go through the json module
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # Optional: without msgpack every response is JSON
+    msgpack = None
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M"
+
+_EPOCH = datetime(1970, 1, 1)
+
+def to_minutes(moment):
+    """
+    A (naive) datetime as whole minutes since 1970-01-01
+    """
+    return (moment - _EPOCH) // timedelta(minutes=1)
+
+def format_minutes(minutes):
+    """
+    The calendar's timestamp string for a to_minutes() value
+    """
+    days, minutes = divmod(minutes, 1440)
+    return _format_day(days) + _CLOCK[minutes]
+
+# " HH:MM" for every minute of a day
+_CLOCK = [f" {minute // 60:02d}:{minute % 60:02d}" for minute in range(1440)]
+
+@lru_cache(maxsize=1024)
+def _format_day(days):
+    return (_EPOCH + timedelta(days=days)).strftime("%Y-%m-%d")
+
+class Record(Mapping):
+    """
+    Base of the compact calendar records: slots instead of a dict, read like one
+    
+    Records support post['title'], .get(), dict(post), comparison with plain
+    dicts and item assignment, so code written for the dict schema works
+    unchanged. The timestamp is kept as an integer (minutes) and only
+    formatted when it is read or serialized.
+    """
+    
+    __slots__ = ('minutes',)
+    
+    # Keys of the dict schema, in output order
+    FIELDS = ()
+    
+    @property
+    def timestamp(self):
+        return format_minutes(self.minutes)
+    
+    @timestamp.setter
+    def timestamp(self, value):
+        self.minutes = to_minutes(datetime.strptime(value, TIMESTAMP_FORMAT)) if isinstance(value, str) else value
+    
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+    
+    def __iter__(self):
+        return iter(self.FIELDS)
+    
+    def __len__(self):
+        return len(self.FIELDS)
+    
+    def __repr__(self):
+        return f"{type(self).__name__}({self.as_dict()!r})"
+    
+    def as_dict(self):
+        """
+        The record in the dict schema (nested records are left as they are)
+        """
+        return {key: getattr(self, key) for key in self.FIELDS}
+
+class Comment(Record):
+    """
+    One comment of a calendar post
+    """
+    
+    __slots__ = ('comment_id', 'post_id', 'parent_comment_id', 'comment_text', 'username', 'delay_minutes')
+    
+    FIELDS = ('comment_id', 'post_id', 'parent_comment_id', 'comment_text', 'username', 'timestamp', 'delay_minutes')
+    
+    def __init__(self, comment_id, post_id, parent_comment_id, comment_text, username, minutes, delay_minutes):
+        self.comment_id = comment_id
+        self.post_id = post_id
+        self.parent_comment_id = parent_comment_id
+        self.comment_text = comment_text
+        self.username = username
+        self.minutes = minutes
+        self.delay_minutes = delay_minutes
+    
+    def as_dict(self):
+        return {
+            "comment_id": self.comment_id,
+            "post_id": self.post_id,
+            "parent_comment_id": self.parent_comment_id,
+            "comment_text": self.comment_text,
+            "username": self.username,
+            "timestamp": format_minutes(self.minutes),
+            "delay_minutes": self.delay_minutes
+        }
+
+class Post(Record):
+    """
+    One calendar post with its comments
+    """
+    
+    __slots__ = ('post_id', 'subreddit', 'title', 'body', 'author_username', 'keyword_ids', 'comments')
+    
+    FIELDS = ('post_id', 'subreddit', 'title', 'body', 'author_username', 'timestamp', 'keyword_ids', 'comments')
+    
+    def __init__(self, post_id, subreddit, title, body, author_username, minutes, keyword_ids, comments):
+        self.post_id = post_id
+        self.subreddit = subreddit
+        self.title = title
+        self.body = body
+        self.author_username = author_username
+        self.minutes = minutes
+        self.keyword_ids = keyword_ids
+        self.comments = comments
+    
+    def as_dict(self):
+        return {
+            "post_id": self.post_id,
+            "subreddit": self.subreddit,
+            "title": self.title,
+            "body": self.body,
+            "author_username": self.author_username,
+            "timestamp": format_minutes(self.minutes),
+            "keyword_ids": self.keyword_ids,
+            "comments": self.comments
+        }
+
+# Exact-type checks: isinstance against the Mapping ABC is slow per item
+RECORD_TYPES = frozenset((Post, Comment))
+
+def json_default(obj):
+    """
+    default= hook for json.dumps / orjson / msgpack: records become dicts
+    """
+    if type(obj) in RECORD_TYPES or isinstance(obj, Record):
+        return obj.as_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# Datetimes and dataclasses go through default= as they do with the json module
+# (non-string keys make orjson raise, so those payloads fall back as well)
+_ORJSON_OPTIONS = orjson and (orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                              | orjson.OPT_PASSTHROUGH_DATACLASS)
+
+# json.dumps(ensure_ascii=True) escapes everything outside printable ASCII
+_NON_ASCII = re.compile('[\x7f-\U0010ffff]')
+
+def _escape(match):
+    code = ord(match.group())
+    if code > 0xFFFF:
+        code -= 0x10000
+        return '\\u%04x\\u%04x' % (0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF))
+    return '\\u%04x' % code
+
+_NO_FLOATS = RECORD_TYPES | {str, int, bool, type(None)}
+
+def _floats_match(obj):
+    """
+    True if orjson writes every float in obj the way json does
+    
+    They differ outside 1e-4 <= |x| < 1e16 (exponents, and orjson writes
+    nan/inf as null). Records hold no floats, so only the structure around
+    them is walked.
+    """
+    if isinstance(obj, float):
+        return obj == 0.0 or 1e-4 <= abs(obj) < 1e16
+    if isinstance(obj, dict):
+        obj = obj.values()
+    elif not isinstance(obj, (list, tuple)):
+        return True
+    for value in obj:
+        if type(value) not in _NO_FLOATS and not _floats_match(value):
+            return False
+    return True
+
+def fast_dumps(obj, default=json_default):
+    """
+    Compact JSON with sorted keys and ASCII escapes, byte-for-byte what Flask's jsonify writes
+    
+    Uses orjson when installed and the json module otherwise (or when the
+    payload holds a float the two would write differently).
+    """
+    if orjson is not None and _floats_match(obj):
+        try:
+            text = orjson.dumps(obj, default=default, option=_ORJSON_OPTIONS).decode()
+        except TypeError:
+            # Integers past 64 bits and the like
+            text = None
+        if text is not None:
+            if text.isascii() and '\x7f' not in text:
+                return text
+            return _NON_ASCII.sub(_escape, text)
+    return json.dumps(obj, default=default, ensure_ascii=True, sort_keys=True, separators=(',', ':'))
+
+def packb(obj):
+    """
+    MessagePack bytes for a response body (requires msgpack)
+    """
+    return msgpack.packb(obj, default=json_default, use_bin_type=True)
+
+def wants_msgpack(accept_mimetypes):
+    """
+    True if the request's Accept header prefers MessagePack over JSON (and msgpack is installed)
+    """
+    if msgpack is None:
+        return False
+    return accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES) in MSGPACK_MIMETYPES
+
+class CalendarJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that serializes calendar records, through fast_dumps for compact responses
+    """
+    
+    def dumps(self, obj, **kwargs):
+        default = kwargs.pop('default', self.default)
+        
+        def encode(o):
+            if type(o) in RECORD_TYPES or isinstance(o, Record):
+                return o.as_dict()
+            return default(o)
+        
+        compact = kwargs == {"separators": (",", ":")}
+        if compact and self.sort_keys and self.ensure_ascii:
+            return fast_dumps(obj, encode)
+        kwargs.setdefault('ensure_ascii', self.ensure_ascii)
+        kwargs.setdefault('sort_keys', self.sort_keys)
+        return json.dumps(obj, default=encode, **kwargs)
@@ -0,0 +1,321 @@
+import contextvars
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+from content_generator import extract_company_name
+from llm_usage import UsageMeter, metered
+from quality_scorer import get_lexicon
+from telemetry import traced
+
+# Score a repair stops at
+DEFAULT_TARGET_SCORE = 9.0
+
+# Rewrite rounds before giving up on the target
+MAX_ROUNDS = 3
+
+class Repairs:
+    """
+    What to rewrite in a calendar: whole posts, single comments and comment persona swaps
+
+    Each rewrite carries notes on what the earlier version got wrong, which
+    go into the rewrite's prompt.
+    """
+    
+    def __init__(self):
+        # post index -> notes (a rewritten post gets all its comments rewritten too)
+        self.posts = {}
+        # (post index, comment index) -> notes
+        self.comments = {}
+        # (post index, comment index) -> persona now writing the comment
+        self.personas = {}
+        # Comments flagged for mentioning the company (rewritten without a mention)
+        self.no_mention = set()
+    
+    def __bool__(self):
+        return bool(self.posts or self.comments or self.personas)
+    
+    def rewrite_post(self, index, note):
+        self.posts.setdefault(index, []).append(note)
+    
+    def rewrite_comment(self, index, note):
+        self.comments.setdefault(index, []).append(note)
+    
+    def post_indices(self):
+        return sorted(set(self.posts) | {p for p, _ in self.comments} | {p for p, _ in self.personas})
+
+def find_repairs(posts, features, personas, lexicon):
+    """
+    Map a calendar's warnings back to the posts and comments behind them
+
+    Mirrors the QualityScorer checks: for every flagged count, the items
+    past the allowed number (the later ones) are marked for a rewrite.
+    Overused or unused personas move comments to other personas. Timing,
+    keyword and length warnings come from the plan, not the text, and are
+    left alone.
+    """
+    
+    repairs = Repairs()
+    
+    # Step 1: What each comment contains, in calendar order
+    comments = []
+    for p, post in enumerate(posts):
+        for c, comment in enumerate(post['comments']):
+            text = comment['comment_text'].lower()
+            words = text.split()
+            comments.append({
+                "index": (p, c),
+                "username": comment['username'],
+                "hits": lexicon.comment_matcher.find(text),
+                "openers": lexicon.opener_matcher.find(' '.join(words[:15])),
+                "exclamation": '!' in text
+            })
+    
+    # Step 2: Anti-spam counts (rewrite everything past the allowance)
+    for opener, count in features.opener_counts.items():
+        if count > 2:
+            flagged = [info for info in comments if opener in info['openers']]
+            for info in flagged[2:]:
+                repairs.rewrite_comment(info['index'], f'don\'t start with "{opener}"')
+    
+    if features.promo_count > 2:
+        seen = 0
+        for info in comments:
+            promo = sorted(info['hits'] & lexicon.promo_words)
+            if promo:
+                seen += len(promo)
+                if seen > 2:
+                    repairs.rewrite_comment(info['index'], f"no promotional words ({', '.join(promo)})")
+    
+    allowances = (
+        (lambda info: not info['hits'].isdisjoint(lexicon.disclaimers),
+         features.not_perfect_count, int(features.num_comments * 0.4), 'don\'t add a disclaimer like "not perfect"'),
+        (lambda info: info['exclamation'],
+         features.exclamation_count, int(features.num_comments * 0.7), "no exclamation marks")
+    )
+    for matches, count, allowed, note in allowances:
+        if count > allowed:
+            flagged = [info for info in comments if matches(info)]
+            for info in flagged[allowed:]:
+                repairs.rewrite_comment(info['index'], note)
+    
+    allowed = features.num_posts * 2
+    if features.company_mentions > allowed:
+        flagged = [info for info in comments if not info['hits'].isdisjoint(lexicon.company_names)]
+        for info in flagged[allowed:]:
+            repairs.rewrite_comment(info['index'], "don't mention the company")
+            repairs.no_mention.add(info['index'])
+    
+    # Step 3: Naturalness and near-duplicates (whichever text has the problem)
+    bad_phrases = sorted(features.unnatural_counts)
+    if features.formal_count:
+        bad_phrases += sorted(lexicon.formal_words)
+    if bad_phrases:
+        for p, post in enumerate(posts):
+            found = [phrase for phrase in bad_phrases if phrase in (post['title'] + ' ' + post['body']).lower()]
+            if found:
+                repairs.rewrite_post(p, f"don't use {', '.join(repr(phrase) for phrase in found)}")
+            for c, comment in enumerate(post['comments']):
+                found = [phrase for phrase in bad_phrases if phrase in comment['comment_text'].lower()]
+                if found:
+                    repairs.rewrite_comment((p, c), f"don't use {', '.join(repr(phrase) for phrase in found)}")
+    
+    duplicated = {item_id for item_id, _, _ in features.duplicates}
+    for p, post in enumerate(posts):
+        if post['post_id'] in duplicated:
+            repairs.rewrite_post(p, "write something new, not a variation of an earlier post")
+        for c, comment in enumerate(post['comments']):
+            if comment['comment_id'] in duplicated:
+                repairs.rewrite_comment((p, c), "say something new, not a variation of an earlier comment")
+    
+    # Step 4: Repeated title words (keep the first two titles using each word)
+    for word in sorted(features.repeated_title_words, key=features.repeated_title_words.get):
+        titled = [p for p, post in enumerate(posts) if word in re.findall(r'\w+', post['title'].lower())]
+        for p in titled[2:]:
+            repairs.rewrite_post(p, f'don\'t use the word "{word}" in the title')
+    
+    # Step 5: Persona variety (move comments from overused personas to the least used ones)
+    _rebalance_personas(posts, features, personas, repairs)
+    
+    return repairs
+
+def _rebalance_personas(posts, features, personas, repairs):
+    counts = dict(features.persona_counts)
+    total = sum(counts.values())
+    if not total:
+        return
+    by_name = {persona['username']: persona for persona in personas}
+    for username in by_name:
+        counts.setdefault(username, 0)
+    
+    def move_one(username, to=None):
+        # The latest comment by username whose thread the new persona isn't in yet
+        for p in reversed(range(len(posts))):
+            post = posts[p]
+            in_thread = {post['author_username']} | {
+                repairs.personas.get((p, c), {}).get('username', comment['username'])
+                for c, comment in enumerate(post['comments'])
+            }
+            for c in reversed(range(len(post['comments']))):
+                current = repairs.personas.get((p, c), {}).get('username', post['comments'][c]['username'])
+                if current != username:
+                    continue
+                candidates = [to] if to else sorted(
+                    (name for name in by_name if name != username), key=lambda name: counts[name]
+                )
+                for name in candidates:
+                    if name not in in_thread:
+                        repairs.personas[(p, c)] = by_name[name]
+                        counts[username] -= 1
+                        counts[name] += 1
+                        return True
+        return False
+    
+    # Every persona gets at least one interaction
+    for username in by_name:
+        if counts[username] == 0:
+            donor = max(counts, key=counts.get)
+            move_one(donor, to=username)
+    
+    # No persona above 40% of the interactions
+    for username in list(counts):
+        excess = math.ceil(counts[username] - total * 0.4)
+        while excess > 0 and counts[username] / total > 0.4 and move_one(username):
+            excess -= 1
+
+@traced('repair_calendar')
+def repair_calendar(generator, calendar, company_info, personas, target_score=DEFAULT_TARGET_SCORE,
+                    max_rounds=MAX_ROUNDS, lexicons=None, near_duplicates=None, max_concurrency=None):
+    """
+    Regenerate only the posts and comments behind a calendar's warnings
+
+    Each round maps the warnings back to the items responsible (see
+    find_repairs), rewrites them with notes on what to avoid, and re-scores
+    by swapping the new posts into the scorer's features in place of the
+    old ones instead of scoring the whole calendar again. Stops at
+    target_score, after max_rounds, when nothing more can be repaired, or
+    when a round makes the score worse (that round is undone). The result
+    has metrics['regeneration'] with the rounds run, the items rewritten,
+    the score before and the usage of the rewrites.
+    """
+    
+    # Step 1: Score the calendar as it is
+    posts = list(calendar['posts'])
+    lexicon = get_lexicon(lexicons, [extract_company_name(company_info)])
+    scorer = generator.quality_scorer
+    features = scorer.extract_features(posts, lexicon, near_duplicates)
+    metrics = scorer.score_features(features, personas)
+    score_before = metrics['overall_score']
+    usage = UsageMeter()
+    rounds = rewritten_posts = rewritten_comments = 0
+    
+    # Step 2: Rewrite flagged items until the target is reached
+    while rounds < max_rounds and metrics['overall_score'] < target_score:
+        repairs = find_repairs(posts, features, personas, lexicon)
+        if not repairs:
+            break
+        rounds += 1
+        
+        rewritten = _rewrite_posts(generator, posts, repairs, company_info, personas, lexicon,
+                                   usage, max_concurrency)
+        
+        # Step 3: Delta re-score
+        for index, (post, _) in rewritten.items():
+            features.remove_post(posts[index], index)
+            features.add_post(post, index)
+        new_metrics = scorer.score_features(features, personas)
+        
+        if new_metrics['overall_score'] < metrics['overall_score']:
+            for index, (post, _) in rewritten.items():
+                features.remove_post(post, index)
+                features.add_post(posts[index], index)
+            break
+        
+        for index, (post, num_comments) in rewritten.items():
+            posts[index] = post
+            rewritten_posts += index in repairs.posts
+            rewritten_comments += num_comments
+        metrics = new_metrics
+    
+    usage_before = (calendar.get('metrics') or {}).get('usage')
+    if usage_before is not None:
+        metrics['usage'] = usage_before
+    metrics['regeneration'] = {
+        "rounds": rounds,
+        "rewritten_posts": rewritten_posts,
+        "rewritten_comments": rewritten_comments,
+        "score_before": score_before,
+        "usage": usage.totals()
+    }
+    return {**calendar, "posts": posts, "quality_score": metrics['overall_score'], "metrics": metrics}
+
+def _rewrite_posts(generator, posts, repairs, company_info, personas, lexicon, usage, max_concurrency=None):
+    """
+    Rewrite every post with repairs (in parallel); returns {index: (new post, comments rewritten)}
+    """
+    
+    indices = repairs.post_indices()
+    by_name = {persona['username']: persona for persona in personas}
+    
+    def rewrite(index):
+        with metered(usage):
+            return _rewrite_post(generator, posts[index], index, repairs, company_info, by_name, lexicon)
+    
+    workers = max(1, min(max_concurrency or generator.max_concurrency, len(indices)))
+    if workers == 1:
+        return {index: rewrite(index) for index in indices}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {index: executor.submit(contextvars.copy_context().run, rewrite, index) for index in indices}
+        return {index: future.result() for index, future in futures.items()}
+
+def _rewrite_post(generator, post, p, repairs, company_info, by_name, lexicon):
+    content_gen = generator.content_gen
+    post = dict(post)
+    comments = [dict(comment) for comment in post['comments']]
+    
+    def persona(username):
+        return by_name.get(username) or {"username": username, "info": ""}
+    
+    if p in repairs.posts:
+        post_data = content_gen.generate_post(
+            subreddit=post['subreddit'],
+            keywords=post['keyword_ids'],
+            persona=persona(post['author_username']),
+            company_info=company_info,
+            avoid=repairs.posts[p]
+        )
+        post['title'] = post_data['title']
+        post['body'] = post_data['body']
+        # Every comment answers the post body, so they are all rewritten
+        to_rewrite = set(range(len(comments)))
+    else:
+        to_rewrite = {c for q, c in list(repairs.comments) + list(repairs.personas) if q == p}
+    
+    # A reply is written against the comment right before it, so rewriting
+    # a comment rewrites the chain of replies that follows it
+    for c in range(1, len(comments)):
+        if c - 1 in to_rewrite and comments[c]['parent_comment_id'] is not None:
+            to_rewrite.add(c)
+    
+    for c in sorted(to_rewrite):
+        comment = comments[c]
+        # A first comment keeps (or drops) its product mention as before,
+        # unless it was flagged for mentioning the company
+        mentioned = (
+            (p, c) not in repairs.no_mention
+            and not lexicon.comment_matcher.find(comment['comment_text'].lower()).isdisjoint(lexicon.company_names)
+        )
+        notes = repairs.comments.get((p, c))
+        writer = repairs.personas.get((p, c)) or persona(comment['username'])
+        comment['comment_text'] = content_gen.generate_comment(
+            post_content=post['body'],
+            persona=writer,
+            company_info=company_info,
+            is_first_comment=c == 0,
+            should_mention_product=mentioned,
+            previous_comment=comments[c - 1]['comment_text'] if comment['parent_comment_id'] is not None else None,
+            avoid=notes
+        )
+        comment['username'] = writer['username']
+    
+    post['comments'] = comments
+    return post, len(to_rewrite)
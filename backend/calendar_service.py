@@ -0,0 +1,345 @@
+import os
+import queue
+import threading
+from algorithm import RedditCalendarGenerator
+from calendar_repair import DEFAULT_TARGET_SCORE, MAX_ROUNDS, repair_calendar
+from campaign_store import CampaignStore
+from coalescing import request_key
+from llm_cache import LLMCache
+from llm_transport import TransportError, transport_from_env
+from near_duplicates import NearDuplicateIndex
+from telemetry import Cancelled, collect_timings, span
+
+CAMPAIGN_FIELDS = ['company_info', 'personas', 'subreddits', 'keywords', 'posts_per_week']
+
+REQUIRED_FIELDS = {
+    'generate-calendar': CAMPAIGN_FIELDS,
+    'generate-next-week': CAMPAIGN_FIELDS + ['week_number'],
+    'generate-campaign': CAMPAIGN_FIELDS + ['weeks']
+}
+
+# Upper bound on weeks generated by one generate-campaign request
+MAX_CAMPAIGN_WEEKS = int(os.getenv('MAX_CAMPAIGN_WEEKS', 52))
+
+class RequestError(ValueError):
+    """
+    Invalid calendar request (the API answers 400)
+    """
+
+class StreamClosed(Cancelled):
+    """
+    The client stopped reading a calendar stream
+    """
+
+def error_status(error):
+    """
+    HTTP status for an exception raised while handling a calendar request
+    """
+    if isinstance(error, RequestError):
+        return 400
+    if isinstance(error, LookupError):
+        return 404
+    if isinstance(error, TransportError) and error.status_code == 429:
+        return 503  # still rate limited after every retry
+    return 500
+
+def create_cache():
+    """
+    LLM response cache (memory LRU, plus SQLite when LLM_CACHE_PATH is set)
+    """
+    return LLMCache(
+        max_entries=int(os.getenv('LLM_CACHE_SIZE', 2048)),
+        path=os.getenv('LLM_CACHE_PATH'),
+        disk_max_entries=int(os.getenv('LLM_CACHE_DISK_SIZE', 50000)),
+        ttl_seconds=int(os.getenv('LLM_CACHE_TTL', 7 * 24 * 3600))
+    )
+
+def create_generator(cache=None):
+    """
+    Calendar generator configured from the environment
+    """
+    return RedditCalendarGenerator(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        max_concurrency=int(os.getenv('MAX_CONCURRENT_POSTS', 4)),
+        thread_mode=os.getenv('THREAD_MODE', 'per_call'),
+        cache=cache,
+        transport=transport_from_env(os.getenv('OPENAI_API_KEY')),
+        stream=os.getenv('LLM_STREAM', '').lower() in ('1', 'true', 'yes')
+    )
+
+def create_campaign_store():
+    return CampaignStore(os.getenv('CAMPAIGN_DB_PATH', 'campaigns.db'))
+
+class CalendarService:
+    """
+    Runs generate-calendar / generate-next-week requests
+
+    Shared by the HTTP endpoints and the job workers, so a queued job does
+    exactly what the synchronous endpoint would have done.
+    """
+    
+    KINDS = tuple(REQUIRED_FIELDS)
+    
+    def __init__(self, generator, campaign_store, lookback_weeks=4):
+        self.generator = generator
+        self.campaign_store = campaign_store
+        self.lookback_weeks = lookback_weeks
+    
+    def load_campaign(self, data):
+        """
+        Fill missing request fields from the stored campaign (if a campaign_id is given)
+
+        Returns (data, campaign_id); raises LookupError for an unknown campaign.
+        """
+        campaign_id = data.get('campaign_id')
+        if not campaign_id:
+            return data, None
+        
+        config = self.campaign_store.get_campaign(campaign_id)
+        if config is None:
+            raise LookupError(f"Unknown campaign: {campaign_id}")
+        
+        return {**config, **data}, campaign_id
+    
+    def prepare(self, kind, data):
+        """
+        Validate a request and resolve its campaign history
+
+        Returns (data, campaign_id, used_keywords). Raises RequestError for
+        invalid input and LookupError for an unknown campaign.
+        """
+        if kind not in REQUIRED_FIELDS:
+            raise RequestError(f"Unknown request type: {kind}")
+        
+        data, campaign_id = self.load_campaign(data)
+        
+        # Campaign weeks follow the last saved week and avoid keywords from
+        # the stored history instead of a client-supplied previous_calendar
+        used_keywords = None
+        if campaign_id and kind in ('generate-next-week', 'generate-campaign'):
+            data.setdefault('week_number', self.campaign_store.latest_week(campaign_id) + 1)
+            used_keywords = self.campaign_store.recent_keywords(
+                campaign_id,
+                before_week=data['week_number'],
+                weeks=data.get('lookback_weeks', self.lookback_weeks)
+            )
+        
+        for field in REQUIRED_FIELDS[kind]:
+            if field not in data:
+                raise RequestError(f"Missing required field: {field}")
+        
+        # Validate personas (at least 2)
+        if kind in ('generate-calendar', 'generate-campaign') and len(data['personas']) < 2:
+            raise RequestError("At least 2 personas required")
+        
+        if kind == 'generate-campaign':
+            if not isinstance(data['weeks'], int) or not 1 <= data['weeks'] <= MAX_CAMPAIGN_WEEKS:
+                raise RequestError(f"weeks must be between 1 and {MAX_CAMPAIGN_WEEKS}")
+        
+        return data, campaign_id, used_keywords
+    
+    def request_key(self, kind, data):
+        """
+        Identify what a request would generate, for coalescing identical requests
+        
+        Returns (key, cacheable). The key hashes the resolved request, so a
+        campaign's next week (and its keyword history) is part of it and a
+        repeat after the week is saved gets a new key. Campaign requests
+        save what they generate, so only requests without a campaign_id are
+        cacheable once finished.
+        """
+        data, campaign_id, used_keywords = self.prepare(kind, dict(data))
+        return request_key(kind, data, used_keywords), campaign_id is None
+    
+    def generate(self, kind, data, **options):
+        """
+        Generate (and, for a campaign, save) one week's calendar
+
+        Extra options (on_post, ...) are passed to generate_calendar.
+        generate-campaign requests return {"weeks": [calendar, ...]} instead.
+        With "include_timing": true in data, the result gets a "timing"
+        breakdown (calls and seconds per pipeline stage). Posts and comments
+        are checked for near-duplicates of the calendar's own earlier texts
+        and, for a campaign, of every earlier week.
+        """
+        data, campaign_id, used_keywords = self.prepare(kind, dict(data))
+        with collect_timings() as timings, span(kind):
+            if campaign_id:
+                near_duplicates = self.campaign_store.near_duplicate_index(
+                    campaign_id, before_week=data.get('week_number', 1)
+                )
+            else:
+                near_duplicates = NearDuplicateIndex()
+            
+            if kind == 'generate-campaign':
+                result = self._generate_campaign(data, campaign_id, used_keywords, near_duplicates, **options)
+            else:
+                result = self._generate_calendar(kind, data, campaign_id, used_keywords, near_duplicates, **options)
+        
+        if data.get('include_timing'):
+            result['timing'] = timings.summary()
+        return result
+    
+    def _generate_calendar(self, kind, data, campaign_id, used_keywords, near_duplicates, **options):
+        """
+        Generate one week's calendar, saving it to its campaign (if any)
+        """
+        calendar = self.generator.generate_calendar(
+            company_info=data['company_info'],
+            personas=data['personas'],
+            subreddits=data['subreddits'],
+            keywords=data['keywords'],
+            posts_per_week=data['posts_per_week'],
+            week_number=data['week_number'] if kind == 'generate-next-week' else 1,
+            previous_calendar=data.get('previous_calendar') if kind == 'generate-next-week' else None,
+            seed=data.get('seed'),
+            lexicons=data.get('lexicons'),
+            min_score=data.get('min_score'),
+            used_keywords=used_keywords,
+            near_duplicates=near_duplicates,
+            **options
+        )
+        
+        # Auto-repair: rewrite just the flagged posts/comments up to the target score
+        if data.get('target_score') is not None and calendar['quality_score'] < data['target_score']:
+            calendar = repair_calendar(
+                self.generator, calendar, data['company_info'], data['personas'],
+                target_score=data['target_score'],
+                max_rounds=data.get('max_rounds', MAX_ROUNDS),
+                lexicons=data.get('lexicons'),
+                near_duplicates=near_duplicates
+            )
+        
+        if campaign_id:
+            self.campaign_store.save_week(campaign_id, calendar)
+            calendar['campaign_id'] = campaign_id
+        
+        return calendar
+    
+    def regenerate(self, data):
+        """
+        Repair a calendar by regenerating only the posts and comments behind its warnings
+        
+        data holds the "calendar" (or a campaign_id and "week" to repair a
+        saved week), company_info and personas (taken from the campaign when
+        there is one), and optionally target_score, max_rounds, lexicons and
+        include_timing. A repaired campaign week is saved again.
+        """
+        data, campaign_id = self.load_campaign(dict(data))
+        
+        calendar = data.get('calendar')
+        if calendar is None and campaign_id and 'week' in data:
+            calendar = self.campaign_store.get_week(campaign_id, data['week'])
+            if calendar is None:
+                raise LookupError(f"Week {data['week']} not found")
+        if not isinstance(calendar, dict) or not isinstance(calendar.get('posts'), list):
+            raise RequestError("Missing required field: calendar")
+        for field in ('company_info', 'personas'):
+            if field not in data:
+                raise RequestError(f"Missing required field: {field}")
+        
+        with collect_timings() as timings, span('regenerate'):
+            if campaign_id:
+                near_duplicates = self.campaign_store.near_duplicate_index(
+                    campaign_id, before_week=calendar.get('week', 1)
+                )
+            else:
+                near_duplicates = NearDuplicateIndex()
+            
+            result = repair_calendar(
+                self.generator, calendar, data['company_info'], data['personas'],
+                target_score=data.get('target_score', DEFAULT_TARGET_SCORE),
+                max_rounds=data.get('max_rounds', MAX_ROUNDS),
+                lexicons=data.get('lexicons'),
+                near_duplicates=near_duplicates
+            )
+        
+        if campaign_id:
+            self.campaign_store.save_week(campaign_id, result)
+            result['campaign_id'] = campaign_id
+        if data.get('include_timing'):
+            result['timing'] = timings.summary()
+        return result
+    
+    def _generate_campaign(self, data, campaign_id, used_keywords, near_duplicates, on_week=None):
+        """
+        Generate data['weeks'] consecutive weeks in one pipelined run
+        """
+        def week_done(calendar):
+            # Save each week as soon as it is complete
+            if campaign_id:
+                self.campaign_store.save_week(campaign_id, calendar)
+            if on_week is not None:
+                on_week(calendar)
+        
+        calendars = self.generator.generate_campaign(
+            company_info=data['company_info'],
+            personas=data['personas'],
+            subreddits=data['subreddits'],
+            keywords=data['keywords'],
+            posts_per_week=data['posts_per_week'],
+            weeks=data['weeks'],
+            start_week=data.get('week_number', 1),
+            previous_calendar=data.get('previous_calendar'),
+            used_keywords=used_keywords,
+            seed=data.get('seed'),
+            lexicons=data.get('lexicons'),
+            on_week=week_done,
+            near_duplicates=near_duplicates
+        )
+        
+        result = {"weeks": calendars}
+        if campaign_id:
+            result['campaign_id'] = campaign_id
+        return result
+    
+    def stream(self, kind, data):
+        """
+        Run generate() in the background and yield (event, payload) pairs
+        
+        Yields ('post', {"post", "metrics"}) as each post finishes (metrics are
+        the live scores so far), then ('quality_metrics', metrics) and finally
+        ('calendar', calendar), the same calendar generate() returns. A
+        generate-campaign request yields ('week', calendar) as each week
+        completes and then ('campaign', summary), the result with each week
+        reduced to {"week", "quality_score"}. Failures are yielded as
+        ('error', {"error", "status"}). Closing the iterator stops generation
+        once the posts already running finish.
+        """
+        events = queue.Queue()
+        closed = threading.Event()
+        
+        def emit(event, payload):
+            if closed.is_set():
+                raise StreamClosed()
+            events.put((event, payload))
+        
+        if kind == 'generate-campaign':
+            options = {"on_week": lambda calendar: emit('week', calendar)}
+        else:
+            options = {"on_post": lambda post, metrics: emit('post', {"post": post, "metrics": metrics})}
+        
+        def run():
+            try:
+                result = self.generate(kind, data, **options)
+                if kind == 'generate-campaign':
+                    weeks = [{"week": c['week'], "quality_score": c['quality_score']} for c in result['weeks']]
+                    events.put(('campaign', {**result, "weeks": weeks}))
+                else:
+                    events.put(('quality_metrics', result['metrics']))
+                    events.put(('calendar', result))
+            except StreamClosed:
+                pass
+            except Exception as e:
+                events.put(('error', {"error": str(e), "status": error_status(e)}))
+            events.put(None)
+        
+        threading.Thread(target=run, daemon=True).start()
+        try:
+            while True:
+                event = events.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            closed.set()
@@ -0,0 +1,270 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from array import array
+from collections import Counter
+from calendar_model import json_default
+from near_duplicates import NearDuplicateIndex, calendar_texts, signature
+
+class CampaignStore:
+    """
+    Server-side history of multi-week campaigns (SQLite)
+
+    Every saved week is also broken down into keyword, subreddit and persona
+    usage rows, indexed by campaign and week, so questions like "keywords used
+    in the last N weeks" are index range scans instead of walking old calendars.
+    MinHash signatures of every post and comment are stored too, so the
+    near-duplicate index of a campaign loads without re-reading its texts.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS campaigns (
+            campaign_id TEXT PRIMARY KEY,
+            config TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS campaign_weeks (
+            campaign_id TEXT NOT NULL,
+            week INTEGER NOT NULL,
+            calendar TEXT NOT NULL,
+            quality_score REAL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (campaign_id, week)
+        );
+        CREATE TABLE IF NOT EXISTS keyword_usage (
+            campaign_id TEXT NOT NULL,
+            week INTEGER NOT NULL,
+            keyword TEXT NOT NULL,
+            posts INTEGER NOT NULL,
+            PRIMARY KEY (campaign_id, week, keyword)
+        );
+        CREATE INDEX IF NOT EXISTS idx_keyword_usage_keyword ON keyword_usage (campaign_id, keyword, week);
+        CREATE TABLE IF NOT EXISTS subreddit_usage (
+            campaign_id TEXT NOT NULL,
+            week INTEGER NOT NULL,
+            subreddit TEXT NOT NULL,
+            posts INTEGER NOT NULL,
+            PRIMARY KEY (campaign_id, week, subreddit)
+        );
+        CREATE INDEX IF NOT EXISTS idx_subreddit_usage_subreddit ON subreddit_usage (campaign_id, subreddit, week);
+        CREATE TABLE IF NOT EXISTS persona_usage (
+            campaign_id TEXT NOT NULL,
+            week INTEGER NOT NULL,
+            subreddit TEXT NOT NULL,
+            username TEXT NOT NULL,
+            posts INTEGER NOT NULL,
+            comments INTEGER NOT NULL,
+            PRIMARY KEY (campaign_id, week, subreddit, username)
+        );
+        CREATE INDEX IF NOT EXISTS idx_persona_usage_subreddit ON persona_usage (campaign_id, subreddit, username);
+        CREATE INDEX IF NOT EXISTS idx_persona_usage_username ON persona_usage (campaign_id, username, week);
+        CREATE TABLE IF NOT EXISTS content_signatures (
+            campaign_id TEXT NOT NULL,
+            week INTEGER NOT NULL,
+            item_id TEXT NOT NULL,
+            signature BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_content_signatures_week ON content_signatures (campaign_id, week);
+    """
+    
+    def __init__(self, path='campaigns.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        
+        with self._lock:
+            conn = self._connect()
+            conn.executescript(self.SCHEMA)
+            conn.commit()
+    
+    def _connect(self):
+        # SQLite connections must not cross a fork: reopen in each process
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._conn
+    
+    def create_campaign(self, config, campaign_id=None):
+        """
+        Store a campaign's inputs (company_info, personas, subreddits, ...) and return its ID
+        """
+        campaign_id = campaign_id or uuid.uuid4().hex
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO campaigns (campaign_id, config, created_at) VALUES (?, ?, ?)",
+                (campaign_id, json.dumps(config), time.time())
+            )
+            conn.commit()
+        return campaign_id
+    
+    def get_campaign(self, campaign_id):
+        """
+        The campaign's stored config, or None if it doesn't exist
+        """
+        row = self._query_one("SELECT config FROM campaigns WHERE campaign_id = ?", (campaign_id,))
+        return json.loads(row[0]) if row else None
+    
+    def save_week(self, campaign_id, calendar):
+        """
+        Store a generated week and index its keyword, subreddit and persona usage
+
+        Saving a week again replaces it.
+        """
+        week = calendar['week']
+        keywords = Counter()
+        subreddits = Counter()
+        personas = Counter()
+        for post in calendar['posts']:
+            subreddit = post['subreddit']
+            keywords.update(post.get('keyword_ids', []))
+            subreddits[subreddit] += 1
+            personas[(subreddit, post['author_username'], 'posts')] += 1
+            for comment in post['comments']:
+                personas[(subreddit, comment['username'], 'comments')] += 1
+        
+        persona_rows = {}
+        for (subreddit, username, kind), count in personas.items():
+            row = persona_rows.setdefault((subreddit, username), {'posts': 0, 'comments': 0})
+            row[kind] += count
+        
+        signatures = []
+        for item_id, text in calendar_texts(calendar['posts']):
+            sig = signature(text)
+            if sig is not None:
+                signatures.append((campaign_id, week, item_id, sig.tobytes()))
+        
+        with self._lock:
+            conn = self._connect()
+            for table in ('campaign_weeks', 'keyword_usage', 'subreddit_usage', 'persona_usage', 'content_signatures'):
+                conn.execute(f"DELETE FROM {table} WHERE campaign_id = ? AND week = ?", (campaign_id, week))
+            
+            conn.execute(
+                "INSERT INTO campaign_weeks (campaign_id, week, calendar, quality_score, created_at) VALUES (?, ?, ?, ?, ?)",
+                (campaign_id, week, json.dumps(calendar, default=json_default), calendar.get('quality_score'), time.time())
+            )
+            conn.executemany(
+                "INSERT INTO keyword_usage (campaign_id, week, keyword, posts) VALUES (?, ?, ?, ?)",
+                [(campaign_id, week, keyword, count) for keyword, count in keywords.items()]
+            )
+            conn.executemany(
+                "INSERT INTO subreddit_usage (campaign_id, week, subreddit, posts) VALUES (?, ?, ?, ?)",
+                [(campaign_id, week, subreddit, count) for subreddit, count in subreddits.items()]
+            )
+            conn.executemany(
+                "INSERT INTO persona_usage (campaign_id, week, subreddit, username, posts, comments) VALUES (?, ?, ?, ?, ?, ?)",
+                [(campaign_id, week, subreddit, username, row['posts'], row['comments'])
+                 for (subreddit, username), row in persona_rows.items()]
+            )
+            conn.executemany(
+                "INSERT INTO content_signatures (campaign_id, week, item_id, signature) VALUES (?, ?, ?, ?)",
+                signatures
+            )
+            conn.commit()
+    
+    def get_week(self, campaign_id, week):
+        row = self._query_one(
+            "SELECT calendar FROM campaign_weeks WHERE campaign_id = ? AND week = ?", (campaign_id, week)
+        )
+        return json.loads(row[0]) if row else None
+    
+    def latest_week(self, campaign_id):
+        """
+        Highest saved week number (0 if none)
+        """
+        row = self._query_one("SELECT MAX(week) FROM campaign_weeks WHERE campaign_id = ?", (campaign_id,))
+        return row[0] or 0
+    
+    def list_weeks(self, campaign_id):
+        """
+        [{"week", "quality_score"}] for every saved week
+        """
+        rows = self._query(
+            "SELECT week, quality_score FROM campaign_weeks WHERE campaign_id = ? ORDER BY week", (campaign_id,)
+        )
+        return [{"week": week, "quality_score": score} for week, score in rows]
+    
+    def recent_keywords(self, campaign_id, before_week, weeks):
+        """
+        Keywords used in the `weeks` weeks before `before_week`
+        """
+        rows = self._query(
+            "SELECT DISTINCT keyword FROM keyword_usage WHERE campaign_id = ? AND week >= ? AND week < ?",
+            (campaign_id, before_week - weeks, before_week)
+        )
+        return {keyword for (keyword,) in rows}
+    
+    def keyword_last_used(self, campaign_id):
+        """
+        {keyword: last week it was used}
+        """
+        rows = self._query(
+            "SELECT keyword, MAX(week) FROM keyword_usage WHERE campaign_id = ? GROUP BY keyword", (campaign_id,)
+        )
+        return dict(rows)
+    
+    def subreddit_usage(self, campaign_id, before_week=None, weeks=None):
+        """
+        {subreddit: posts}, optionally limited to the `weeks` weeks before `before_week`
+        """
+        sql, params = self._week_filter(
+            "SELECT subreddit, SUM(posts) FROM subreddit_usage WHERE campaign_id = ?", campaign_id, before_week, weeks
+        )
+        return dict(self._query(sql + " GROUP BY subreddit", params))
+    
+    def persona_activity(self, campaign_id, subreddit=None, before_week=None, weeks=None):
+        """
+        {subreddit: {username: {"posts", "comments"}}} (just one subreddit if given)
+        """
+        sql, params = self._week_filter(
+            "SELECT subreddit, username, SUM(posts), SUM(comments) FROM persona_usage WHERE campaign_id = ?",
+            campaign_id, before_week, weeks
+        )
+        if subreddit is not None:
+            sql += " AND subreddit = ?"
+            params.append(subreddit)
+        
+        activity = {}
+        for sub, username, posts, comments in self._query(sql + " GROUP BY subreddit, username", params):
+            activity.setdefault(sub, {})[username] = {"posts": posts, "comments": comments}
+        return activity
+    
+    def near_duplicate_index(self, campaign_id, before_week=None, weeks=None):
+        """
+        NearDuplicateIndex of the campaign's posts and comments, labelled like "C213 (week 2)"
+
+        Optionally limited to the `weeks` weeks before `before_week`.
+        """
+        sql, params = self._week_filter(
+            "SELECT week, item_id, signature FROM content_signatures WHERE campaign_id = ?",
+            campaign_id, before_week, weeks
+        )
+        index = NearDuplicateIndex()
+        for week, item_id, blob in self._query(sql + " ORDER BY week, rowid", params):
+            sig = array('I')
+            sig.frombytes(blob)
+            index.add(f"{item_id} (week {week})", sig)
+        return index
+    
+    def _week_filter(self, sql, campaign_id, before_week, weeks):
+        params = [campaign_id]
+        if before_week is not None:
+            sql += " AND week < ?"
+            params.append(before_week)
+            if weeks is not None:
+                sql += " AND week >= ?"
+                params.append(before_week - weeks)
+        return sql, params
+    
+    def _query(self, sql, params):
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+    
+    def _query_one(self, sql, params):
+        with self._lock:
+            return self._connect().execute(sql, params).fetchone()
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from calendar_model import json_default
+
+def request_key(*parts):
+    """
+    Stable hash of a request: key order and set order don't matter
+    """
+    payload = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=_normalize)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _normalize(obj):
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    return json_default(obj)
+
+class ResultCache:
+    """
+    Finished results by request key: LRU bounded to max_entries, each kept ttl_seconds
+    """
+    
+    def __init__(self, max_entries=256, ttl_seconds=600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def set(self, key, value):
+        if not self.max_entries or self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._data[key] = (self.clock() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def stats(self):
+        return {"entries": len(self._data), "hits": self.hits, "misses": self.misses}
+
+class SingleFlight:
+    """
+    One call per key at a time: concurrent callers with the same key share the running call's result
+    
+    A caller that arrives while a call is in flight waits for it instead of
+    starting its own, and gets its result (or its exception).
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+    
+    def do(self, key, fn):
+        """
+        Run fn() unless a call with this key is in flight; returns (result, shared)
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.shared += 1
+        
+        if not leader:
+            return future.result(), True
+        
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+    
+    def in_flight(self):
+        return len(self._calls)
@@ -1,32 +1,28 @@
-from openai import OpenAI
+import contextvars
 import json
+from contextlib import contextmanager
+from functools import lru_cache
+from json_stream import JSONFieldStream
+from llm_cache import make_cache_key
+from llm_transport import create_transport, stream_completion
+from llm_usage import estimated_usage, record_usage
+from telemetry import FALLBACKS, STREAM_ABORTS, Cancelled, span, traced
 
-class ContentGenerator:
-    """
-    Uses OpenAI to generate natural Reddit posts and comments with high variety
-    """
-    
-    def __init__(self, api_key):
-        self.client = OpenAI(api_key=api_key)
-        
-    def generate_post(self, subreddit, keywords, persona, company_info):
-        """
-        Generate a natural Reddit post
-        """
-        
-        # Extract company name from company_info
-        company_name = self._extract_company_name(company_info)
-        
-        prompt = f"""You are {persona['username']}, a real Reddit user with this background:
+MODEL = "gpt-4o-mini"
 
-{persona['info']}
+# Prompts are laid out static-first: the rules and examples (identical for
+# every call) make up the system message, then come the company, the persona
+# and finally the per-call details, so the provider's prompt cache can reuse
+# the longest possible prefix between calls.
 
-Generate a NATURAL Reddit post for {subreddit} related to these keywords: {', '.join(keywords)}.
+POST_SYSTEM_PROMPT = """You are a Reddit content expert who writes authentic, natural posts.
+
+You'll be given a company, a persona, a subreddit and keywords. Generate a NATURAL Reddit post written as that persona.
 
 CRITICAL RULES:
 1. Write like a REAL Reddit user asking a genuine question or starting a discussion
 2. Be casual, conversational, natural - use Reddit language (lol, tbh, etc when appropriate)
-3. DO NOT mention {company_name} in the post - you're asking a question, not promoting
+3. DO NOT mention the company in the post - you're asking a question, not promoting
 4. Keep it short (2-4 sentences max)
 5. Show you've put thought into it (mention what you've tried, your situation, etc)
 6. Match your persona's voice and background
@@ -35,70 +31,14 @@ BAD example: "What's the best AI tool for presentations? Looking for recommendat
 GOOD example: "Anyone else drowning in deck formatting? I spend more time fixing alignment than actually presenting lol. What's your workflow?"
 
 Return ONLY a JSON object with this structure:
-{{
+{
     "title": "The post title (short, Reddit-style)",
     "body": "The post body (2-4 sentences)"
-}}"""
-
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are a Reddit content expert who writes authentic, natural posts."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.9
-        )
-        
-        content = response.choices[0].message.content.strip()
-        
-        # Parse JSON response
-        try:
-            # Remove markdown code blocks if present
-            if content.startswith("```"):
-                content = content.split("```")[1]
-                if content.startswith("json"):
-                    content = content[4:]
-            
-            post_data = json.loads(content.strip())
-            return post_data
-        except:
-            # Fallback if JSON parsing fails
-            return {
-                "title": f"Looking for advice on {keywords[0]}",
-                "body": "Has anyone had experience with this? Would love to hear your thoughts."
-            }
-    
-    def generate_comment(self, post_content, persona, company_info, is_first_comment, 
-                        should_mention_product, previous_comment=None):
-        """
-        Generate a natural Reddit comment with high variety
-        """
-        
-        company_name = self._extract_company_name(company_info)
-        
-        # Build prompt based on context
-        if is_first_comment and should_mention_product:
-            product_instruction = f"""You should naturally mention {company_name} as something you've used/tried, but:
-- Make it casual, not promotional
-- VARY how you mention it (don't always say "I've been using...")
-- Sometimes be direct, sometimes add disclaimers, sometimes be skeptical
-- Mix it up: "been using X", "tried X recently", "X works for this", "heard good things about X"
-- DON'T always say "it's not perfect" - vary your qualifiers
-- Use your persona's voice"""
-        else:
-            product_instruction = f"DO NOT mention {company_name}. Just be helpful and conversational."
-        
-        context = f"Original post: {post_content}"
-        if previous_comment:
-            context += f"\n\nYou're replying to: {previous_comment}"
-        
-        prompt = f"""You are {persona['username']}, a real Reddit user with this background:
+}"""
 
-{persona['info']}
-
-{context}
+COMMENT_SYSTEM_PROMPT = """You are a Reddit user writing natural, varied comments. Never be formulaic or repetitive.
 
-Write a NATURAL Reddit comment with HIGH VARIETY.
+You'll be given a product instruction, a persona and the post (or comment) being replied to. Write a NATURAL Reddit comment with HIGH VARIETY, as that persona.
 
 CRITICAL VARIETY RULES:
 - DON'T start with "Totally" or "I feel you" every time
@@ -112,8 +52,6 @@ CRITICAL VARIETY RULES:
 - Mix direct answers with personal anecdotes
 - Don't be overly helpful - sometimes be brief or casual
 
-{product_instruction}
-
 EXAMPLES OF VARIETY (good vs bad):
 
 ❌ Bad (repetitive): "Totally feel you! I've been using Tool X. It's not perfect but helps."
@@ -133,32 +71,484 @@ EXAMPLES OF VARIETY (good vs bad):
 
 Return ONLY the comment text, no JSON, no markdown."""
 
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are a Reddit user writing natural, varied comments. Never be formulaic or repetitive."},
+THREAD_SYSTEM_PROMPT = """You are a Reddit content expert who writes authentic, natural threads. Never be formulaic or repetitive.
+
+You'll be given a company, a subreddit, keywords, the post author's persona and a numbered list of commenters. Write the post, then one comment for each commenter, in that order.
+
+POST RULES:
+1. Write like a REAL Reddit user asking a genuine question or starting a discussion
+2. Be casual, conversational, natural - use Reddit language (lol, tbh, etc when appropriate)
+3. DO NOT mention the company in the post - you're asking a question, not promoting
+4. Keep it short (2-4 sentences max)
+5. Show you've put thought into it (mention what you've tried, your situation, etc)
+
+COMMENT RULES:
+- Each comment is in that commenter's own voice
+- DON'T start with "Totally" or "I feel you"
+- MIX comment lengths: some 1 sentence, some 2-3, occasionally 4
+- VARY openers: "yeah", "lol same", "tbh", "ngl", "+1", "this", "honestly", "imo", "fwiw", "same here"
+- NOT every comment needs "!" - mix periods, no punctuation, casual tone
+- DON'T always acknowledge limitations and DON'T always say "it's not perfect"
+- Some comments can be SHORT: "this", "same lol", "saved"
+- Replies respond to the comment they reply to, not just the post
+
+Return ONLY a JSON object with this structure:
+{
+    "title": "The post title (short, Reddit-style)",
+    "body": "The post body (2-4 sentences)",
+    "comments": [
+        {"index": 0, "reply_to": null, "text": "The comment text"}
+    ]
+}"""
+
+# Streamed generations that break a rule (e.g. name the company in a post)
+# are cut off and retried this many times in total
+STREAM_ATTEMPTS = 2
+
+# Generation (seed and post) that the calls in this context belong to (see cache_scope)
+_cache_scope = contextvars.ContextVar('cache_scope', default=None)
+
+@contextmanager
+def cache_scope(seed, *identity):
+    """
+    Key cached completions on the generation making the calls inside the block
+
+    seed is the generation's seed and identity names the post being written
+    (e.g. its week and post ID), so only a rerun of the same post with the
+    same seed reads back its completions; other weeks, campaigns and seeds
+    get fresh text. With seed=None the calls bypass the cache.
+    """
+    token = _cache_scope.set(None if seed is None else [seed, *identity])
+    try:
+        yield
+    finally:
+        _cache_scope.reset(token)
+
+class GenerationAborted(Cancelled):
+    """
+    A streamed generation was cut off because its text broke a rule
+    """
+
+class ContentGenerator:
+    """
+    Uses OpenAI to generate natural Reddit posts and comments with high variety
+    """
+    
+    def __init__(self, api_key, cache=None, transport=None):
+        # Live OpenAI behind the shared rate limiter by default; record/replay/
+        # synthetic transports plug in here
+        self.transport = transport or create_transport('live', api_key)
+        # Optional LLMCache; seeded reruns of a post reuse its completions
+        self.cache = cache
+        
+    @traced('generate_post')
+    def generate_post(self, subreddit, keywords, persona, company_info, stream=False, on_text=None,
+                      avoid=None):
+        """
+        Generate a natural Reddit post
+        
+        With stream=True the reply is streamed: on_text(field, text) gets each
+        piece of the title and body as it arrives, and a reply that names the
+        company is cut off and retried (on_text('restart', '') tells the
+        listener to discard the partial text), then replaced by a generic post.
+        avoid lists what a rewrite must not do (see rewrite_notes).
+        """
+        
+        request = self.post_request(subreddit, keywords, persona, company_info, avoid)
+        
+        if stream:
+            company_name = self._extract_company_name(company_info)
+            return self._stream_post(request['messages'], keywords, company_name, on_text)
+        
+        return self.parse_post(self._complete(**request), keywords)
+    
+    def post_request(self, subreddit, keywords, persona, company_info, avoid=None):
+        """
+        The chat request behind generate_post: {"messages", "temperature"}
+        """
+        
+        # Extract company name from company_info
+        company_name = self._extract_company_name(company_info)
+        
+        prompt = f"""{company_intro(company_name)}
+
+{persona_intro(persona['username'], persona['info'])}
+
+Generate a NATURAL Reddit post for {subreddit} related to these keywords: {', '.join(keywords)}.{rewrite_notes(avoid)}"""
+        
+        return {
+            "messages": [
+                {"role": "system", "content": POST_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
-            temperature=1.1  # Increased for more variety
-        )
+            "temperature": 0.9
+        }
+    
+    def parse_post(self, content, keywords):
+        """
+        Turn a post reply into {"title", "body"} (a generic post if it isn't valid JSON)
+        """
+        try:
+            return self._parse_json(content)
+        except:
+            # Fallback if JSON parsing fails
+            FALLBACKS.inc(kind='post')
+            return self._fallback_post(keywords)
+    
+    @traced('generate_comment')
+    def generate_comment(self, post_content, persona, company_info, is_first_comment, 
+                        should_mention_product, previous_comment=None, stream=False, on_text=None,
+                        avoid=None):
+        """
+        Generate a natural Reddit comment with high variety
         
-        comment = response.choices[0].message.content.strip()
+        With stream=True, on_text('text', piece) gets the comment as it is
+        written; a comment that names the company when it shouldn't is cut off
+        and retried (on_text('restart', '') first), the last try unchecked.
+        avoid lists what a rewrite must not do (see rewrite_notes).
+        """
+        
+        request = self.comment_request(post_content, persona, company_info, is_first_comment,
+                                       should_mention_product, previous_comment, avoid)
         
-        # Clean up any markdown or quotes
-        comment = comment.strip('"').strip("'")
+        if stream:
+            company_name = self._extract_company_name(company_info)
+            forbidden = None if is_first_comment and should_mention_product else company_name
+            comment = self._stream_comment(request['messages'], forbidden, on_text)
+        else:
+            comment = self._complete(**request)
         
-        return comment
+        return self.parse_comment(comment)
+    
+    def comment_request(self, post_content, persona, company_info, is_first_comment,
+                        should_mention_product, previous_comment=None, avoid=None):
+        """
+        The chat request behind generate_comment: {"messages", "temperature"}
+        """
+        
+        company_name = self._extract_company_name(company_info)
+        
+        # Build prompt based on context
+        context = f"Original post: {post_content}"
+        if previous_comment:
+            context += f"\n\nYou're replying to: {previous_comment}"
+        
+        prompt = f"""{product_instruction(company_name, is_first_comment and should_mention_product)}
+
+{persona_intro(persona['username'], persona['info'])}
+
+{context}{rewrite_notes(avoid)}"""
+        
+        return {
+            "messages": [
+                {"role": "system", "content": COMMENT_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 1.1  # Increased for more variety
+        }
+    
+    def parse_comment(self, content):
+        """
+        Clean up any markdown or quotes around a comment reply
+        """
+        return content.strip('"').strip("'")
+    
+    @traced('generate_thread')
+    def generate_thread(self, subreddit, keywords, persona, company_info, commenters):
+        """
+        Generate a post and its whole comment thread in one structured call
+        
+        commenters is a list of {"persona", "reply_to", "mention_product"} dicts,
+        where reply_to is the index of the earlier comment being replied to (or None).
+        Returns {"title", "body", "comments"}; a comment that comes back malformed
+        is None so the caller can regenerate just that one.
+        """
+        
+        request = self.thread_request(subreddit, keywords, persona, company_info, commenters)
+        return self.parse_thread(self._complete(**request), keywords, len(commenters))
+    
+    def thread_request(self, subreddit, keywords, persona, company_info, commenters):
+        """
+        The chat request behind generate_thread: {"messages", "temperature", "response_format"}
+        """
+        
+        company_name = self._extract_company_name(company_info)
+        
+        commenter_lines = []
+        for i, commenter in enumerate(commenters):
+            if commenter['reply_to'] is None:
+                role = "top-level comment on the post"
+            else:
+                role = f"reply to comment {commenter['reply_to']}"
+            if commenter['mention_product']:
+                mention = f"naturally mentions {company_name} as something they've used/tried (casual, not promotional)"
+            else:
+                mention = f"does NOT mention {company_name}"
+            commenter_lines.append(
+                f"{i}. {commenter['persona']['username']} ({commenter['persona']['info']}) - {role}, {mention}"
+            )
+        commenter_block = '\n'.join(commenter_lines)
+        
+        prompt = f"""{company_intro(company_name)}
+
+Write a Reddit thread for {subreddit} related to these keywords: {', '.join(keywords)}.
+
+The post is written by {persona['username']}, a real Reddit user with this background:
+
+{persona['info']}
+
+Commenters:
+
+{commenter_block}"""
+        
+        return {
+            "messages": [
+                {"role": "system", "content": THREAD_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 1.0,
+            "response_format": {"type": "json_object"}
+        }
+    
+    def parse_thread(self, content, keywords, num_commenters):
+        """
+        Turn a thread reply into {"title", "body", "comments"}, falling back field by field
+        """
+        
+        try:
+            thread_data = self._parse_json(content)
+            if not isinstance(thread_data, dict):
+                thread_data = {}
+        except:
+            thread_data = {}
+        
+        # Fall back field by field so one bad value doesn't lose the thread
+        fallback = self._fallback_post(keywords)
+        title = thread_data.get('title')
+        body = thread_data.get('body')
+        
+        for field, value in (('title', title), ('body', body)):
+            if not (isinstance(value, str) and value.strip()):
+                FALLBACKS.inc(kind=f"thread_{field}")
+        
+        comments = [None] * num_commenters
+        raw_comments = thread_data.get('comments')
+        if isinstance(raw_comments, list):
+            for position, raw in enumerate(raw_comments):
+                if not isinstance(raw, dict):
+                    continue
+                index = raw.get('index', position)
+                text = raw.get('text')
+                if not isinstance(index, int) or not 0 <= index < len(comments):
+                    continue
+                if isinstance(text, str) and text.strip():
+                    comments[index] = text.strip().strip('"').strip("'")
+        FALLBACKS.inc(comments.count(None), kind='thread_comment')
+        
+        return {
+            "title": title.strip() if isinstance(title, str) and title.strip() else fallback['title'],
+            "body": body.strip() if isinstance(body, str) and body.strip() else fallback['body'],
+            "comments": comments
+        }
+    
+    def _complete(self, messages, temperature, stream=False, on_delta=None, **params):
+        """
+        Run a chat completion (through the cache when one is configured and
+        the call runs in a seeded cache_scope)
+        
+        With stream=True the reply is streamed and on_delta(piece) is called
+        for every piece (once with the whole text on a cache hit). If on_delta
+        raises, the stream is closed, which stops generation, and nothing is cached.
+        """
+        
+        key = None
+        scope = _cache_scope.get()
+        if self.cache is not None and scope is not None:
+            key = make_cache_key(MODEL, messages, temperature, scope, **params)
+            cached = self.cache.get(key)
+            if cached is not None:
+                record_usage(cache_hit=True)
+                if stream and on_delta is not None:
+                    on_delta(cached)
+                return cached
+        
+        # Only requests that reach the transport are timed; an abort counts as cancelled
+        with span('llm_request'):
+            if stream:
+                pieces = []
+                usage = []
+                deltas = stream_completion(self.transport, MODEL, messages, temperature,
+                                           on_usage=usage.append, **params)
+                try:
+                    for piece in deltas:
+                        pieces.append(piece)
+                        if on_delta is not None:
+                            on_delta(piece)
+                finally:
+                    deltas.close()
+                    # A stream cut off (or ending) without a usage chunk was still
+                    # a billed request: record an estimate once it has produced text
+                    if usage:
+                        record_usage(usage[0])
+                    elif pieces:
+                        record_usage(estimated_usage(messages, ''.join(pieces)))
+                content = ''.join(pieces).strip()
+            else:
+                response = self.transport.complete(MODEL, messages, temperature, **params)
+                record_usage(response.get('usage'))
+                content = response['content']
+        
+        if key is not None:
+            self.cache.set(key, content)
+        
+        return content
+    
+    def _stream_post(self, messages, keywords, company_name, on_text=None):
+        """
+        Streamed generate_post: forwards title/body text and aborts on a company mention
+        """
+        
+        for attempt in range(STREAM_ATTEMPTS):
+            if attempt:
+                self._notify(on_text, 'restart', '')
+            parser = JSONFieldStream()
+            
+            def on_delta(piece):
+                for field, text in parser.feed(piece):
+                    if self._mentions(parser.fields[field], text, company_name):
+                        raise GenerationAborted(f"Post mentions {company_name}")
+                    if field in ('title', 'body'):
+                        self._notify(on_text, field, text)
+            
+            try:
+                content = self._complete(messages, 0.9, stream=True, on_delta=on_delta)
+            except GenerationAborted:
+                STREAM_ABORTS.inc(kind='post')
+                continue
+            
+            try:
+                return self._parse_json(content)
+            except:
+                FALLBACKS.inc(kind='post')
+                return self._fallback_post(keywords)
+        
+        FALLBACKS.inc(kind='post')
+        return self._fallback_post(keywords)
+    
+    def _stream_comment(self, messages, forbidden, on_text=None):
+        """
+        Streamed generate_comment: aborts on a forbidden company mention
+        """
+        
+        for attempt in range(STREAM_ATTEMPTS):
+            if attempt:
+                self._notify(on_text, 'restart', '')
+            # The last attempt isn't checked: there is no generic comment to fall back on
+            check = forbidden if attempt < STREAM_ATTEMPTS - 1 else None
+            written = []
+            
+            def on_delta(piece):
+                written.append(piece)
+                if self._mentions(''.join(written), piece, check):
+                    raise GenerationAborted(f"Comment mentions {check}")
+                self._notify(on_text, 'text', piece)
+            
+            try:
+                return self._complete(messages, 1.1, stream=True, on_delta=on_delta)
+            except GenerationAborted:
+                STREAM_ABORTS.inc(kind='comment')
+                continue
+    
+    def _mentions(self, text, piece, name):
+        """
+        True if the newest piece of text completes a mention of name
+        """
+        if not name:
+            return False
+        # Only the new piece (plus enough context for a name split across pieces) can add a mention
+        return name.lower() in text[-(len(piece) + len(name)):].lower()
+    
+    def _notify(self, on_text, field, text):
+        if on_text is not None:
+            on_text(field, text)
+    
+    def _parse_json(self, content):
+        """
+        Parse a JSON reply, removing markdown code blocks if present
+        """
+        if content.startswith("```"):
+            content = content.split("```")[1]
+            if content.startswith("json"):
+                content = content[4:]
+        
+        return json.loads(content.strip())
+    
+    def _fallback_post(self, keywords):
+        """
+        Generic post used when the model's JSON can't be parsed
+        """
+        return {
+            "title": f"Looking for advice on {keywords[0]}",
+            "body": "Has anyone had experience with this? Would love to hear your thoughts."
+        }
     
     def _extract_company_name(self, company_info):
         """
         Extract company name from company info string
         """
-        # Try to get the first word/phrase before a dash or comma
-        if '-' in company_info:
-            return company_info.split('-')[0].strip()
-        elif ',' in company_info:
-            return company_info.split(',')[0].strip()
-        else:
-            # Take first few words
-            words = company_info.split()
-            return ' '.join(words[:2]) if len(words) > 1 else words[0]
\ No newline at end of file
+        return extract_company_name(company_info)
+
+@lru_cache(maxsize=1024)
+def company_intro(company_name):
+    """
+    The company line that starts every user prompt (built once per company)
+    """
+    return f"Company (never mention it in the post): {company_name}"
+
+@lru_cache(maxsize=1024)
+def persona_intro(username, info):
+    """
+    The persona block of a user prompt (built once per persona)
+    """
+    return f"""You are {username}, a real Reddit user with this background:
+
+{info}"""
+
+@lru_cache(maxsize=1024)
+def product_instruction(company_name, mention_product):
+    """
+    The comment prompt's company-specific part (built once per company)
+    """
+    if mention_product:
+        return f"""You should naturally mention {company_name} as something you've used/tried, but:
+- Make it casual, not promotional
+- VARY how you mention it (don't always say "I've been using...")
+- Sometimes be direct, sometimes add disclaimers, sometimes be skeptical
+- Mix it up: "been using X", "tried X recently", "X works for this", "heard good things about X"
+- DON'T always say "it's not perfect" - vary your qualifiers
+- Use your persona's voice"""
+    return f"DO NOT mention {company_name}. Just be helpful and conversational."
+
+def rewrite_notes(avoid):
+    """
+    The end of a rewrite's prompt: what the earlier version got wrong (empty for a first try)
+    """
+    if not avoid:
+        return ''
+    notes = '\n'.join(f"- {note}" for note in avoid)
+    return f"\n\nThis rewrites an earlier version that was flagged. This time:\n{notes}"
+
+@lru_cache(maxsize=1024)
+def extract_company_name(company_info):
+    """
+    Extract company name from company info string
+    """
+    # Try to get the first word/phrase before a dash or comma
+    if '-' in company_info:
+        return company_info.split('-')[0].strip()
+    elif ',' in company_info:
+        return company_info.split(',')[0].strip()
+    else:
+        # Take first few words
+        words = company_info.split()
+        return ' '.join(words[:2]) if len(words) > 1 else words[0]
@@ -0,0 +1,88 @@
+"""
+gunicorn settings for the production web server
+
+Usage (from backend/, where gunicorn picks this file up on its own):
+    gunicorn app:app
+
+Workers are forked from a master that has already imported the app, so they
+start almost instantly; each opens its own OpenAI client and SQLite
+connections on first use. On SIGTERM a worker stops accepting connections,
+answers /api/health with 503 and new generations with 503, and waits up to
+WEB_GRACEFUL_TIMEOUT seconds for the generations in flight.
+
+The workers split the OpenAI rate limits between them (OPENAI_RATE_SHARES)
+and sum their metrics through METRICS_DIR, so /api/metrics covers the whole
+server whichever worker answers.
+"""
+
+import os
+import shutil
+import signal
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5001)}"
+
+# Worker processes (each with its own rate limiter, cache and metrics)
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+
+# Each worker paces its calls to its share of OPENAI_RPM / OPENAI_TPM /
+# OPENAI_MAX_CONCURRENCY (set before the app is imported)
+os.environ.setdefault('OPENAI_RATE_SHARES', str(workers))
+
+# Workers write their metrics here and /api/metrics adds them up
+# (a temporary directory unless one is configured)
+_temporary_metrics_dir = 'METRICS_DIR' not in os.environ
+if _temporary_metrics_dir:
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='mastermind-metrics-')
+
+# Requests served at once per worker; generations mostly wait on the API
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', 8))
+
+# Import the app once in the master instead of once per worker
+preload_app = os.getenv('WEB_PRELOAD', '1').lower() in ('1', 'true', 'yes')
+
+# Seconds without a heartbeat before a worker is restarted (requests run
+# in threads, so a long generation doesn't count against it)
+timeout = int(os.getenv('WEB_TIMEOUT', 120))
+
+# Seconds a stopping worker waits for in-flight generations
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 120))
+
+# Seconds an idle client connection is kept open
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+
+accesslog = '-'
+
+def on_starting(server):
+    # Counters start from zero with every server run
+    from telemetry import SharedMetrics
+    SharedMetrics.clear(os.environ['METRICS_DIR'])
+
+def post_worker_init(worker):
+    from app import drain, shared_metrics
+    if shared_metrics is not None:
+        shared_metrics.start()
+    
+    # Mark the app as draining the moment SIGTERM arrives, then let gunicorn
+    # stop accepting connections as usual
+    handle_exit = worker.handle_exit
+    
+    def drain_and_exit(signum, frame):
+        drain.start()
+        handle_exit(signum, frame)
+    
+    signal.signal(signal.SIGTERM, drain_and_exit)
+    signal.siginterrupt(signal.SIGTERM, False)
+
+def worker_exit(server, worker):
+    # gunicorn waited for open connections; make sure no generation is left
+    from app import drain, shared_metrics
+    if not drain.wait(graceful_timeout):
+        server.log.warning("Worker %s exiting with %d generations in flight", worker.pid, drain.active)
+    if shared_metrics is not None:
+        shared_metrics.stop()
+
+def on_exit(server):
+    if _temporary_metrics_dir:
+        shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
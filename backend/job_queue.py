@@ -0,0 +1,232 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from calendar_model import json_default
+
+class JobQueue:
+    """
+    Durable queue of calendar generation jobs (SQLite)
+
+    The API process submits jobs and reads their status; worker processes
+    claim them. A claim is a lease: the worker renews it while the job runs,
+    and a job whose lease runs out (worker crashed, host restarted) goes
+    back to the queue, so in-flight work survives restarts. Claims respect a
+    per-tenant limit on running jobs, so one tenant can't occupy every worker.
+    """
+    
+    STATUSES = ('queued', 'running', 'succeeded', 'failed')
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            tenant TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker_id TEXT,
+            lease_expires REAL,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs (status, tenant, created_at);
+        CREATE INDEX IF NOT EXISTS idx_jobs_lease ON jobs (status, lease_expires);
+    """
+    
+    def __init__(self, path='jobs.db', lease_seconds=60, max_attempts=3, tenant_limit=2, tenant_limits=None):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.tenant_limit = tenant_limit
+        self.tenant_limits = dict(tenant_limits or {})
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        
+        with self._lock:
+            self._connect().executescript(self.SCHEMA)
+    
+    def submit(self, kind, payload, tenant='default'):
+        """
+        Queue a job and return its ID
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO jobs (job_id, tenant, kind, payload, status, created_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                (job_id, tenant, kind, json.dumps(payload), time.time())
+            )
+        return job_id
+    
+    def claim(self, worker_id):
+        """
+        Lease the oldest queued job whose tenant is under its running limit
+
+        Returns the job (with its payload) or None if nothing can run now.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            # Step 1: take the write lock so concurrent workers claim one at a time
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeue_expired(conn, now)
+                
+                # Step 2: pick the tenant with the oldest queued job that has a free slot
+                running = dict(conn.execute(
+                    "SELECT tenant, COUNT(*) FROM jobs WHERE status = 'running' GROUP BY tenant"
+                ).fetchall())
+                candidates = conn.execute(
+                    "SELECT tenant, MIN(created_at) AS oldest FROM jobs WHERE status = 'queued' GROUP BY tenant ORDER BY oldest"
+                ).fetchall()
+                tenant = next((t for t, _ in candidates if running.get(t, 0) < self.limit_for(t)), None)
+                if tenant is None:
+                    conn.execute("COMMIT")
+                    return None
+                
+                # Step 3: lease that tenant's oldest job
+                row = conn.execute(
+                    "SELECT job_id FROM jobs WHERE status = 'queued' AND tenant = ? ORDER BY created_at, rowid LIMIT 1",
+                    (tenant,)
+                ).fetchone()
+                conn.execute(
+                    """UPDATE jobs SET status = 'running', worker_id = ?, attempts = attempts + 1,
+                       lease_expires = ?, started_at = ? WHERE job_id = ?""",
+                    (worker_id, now + self.lease_seconds, now, row[0])
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        
+        job = self.get(row[0])
+        job['payload'] = json.loads(self._fetch(row[0], 'payload'))
+        return job
+    
+    def heartbeat(self, job_id, worker_id):
+        """
+        Renew a running job's lease; False if the worker no longer holds it
+        """
+        with self._lock:
+            cursor = self._connect().execute(
+                "UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND worker_id = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, job_id, worker_id)
+            )
+        return cursor.rowcount == 1
+    
+    def complete(self, job_id, worker_id, result):
+        """
+        Store a job's result; False if the lease was lost (the job was handed to another worker)
+        """
+        return self._finish(job_id, worker_id, 'succeeded', result=json.dumps(result, default=json_default))
+    
+    def fail(self, job_id, worker_id, error):
+        return self._finish(job_id, worker_id, 'failed', error=error)
+    
+    def get(self, job_id):
+        """
+        Job status (without payload or result), or None if it doesn't exist
+        """
+        with self._lock:
+            cursor = self._connect().execute(
+                """SELECT job_id, tenant, kind, status, error, attempts, created_at, started_at, finished_at
+                   FROM jobs WHERE job_id = ?""",
+                (job_id,)
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+    
+    def result(self, job_id):
+        """
+        A succeeded job's result, or None
+        """
+        result = self._fetch(job_id, 'result')
+        return json.loads(result) if result else None
+    
+    def counts(self):
+        """
+        {status: jobs}
+        """
+        with self._lock:
+            rows = self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: dict(rows).get(status, 0) for status in self.STATUSES}
+    
+    def purge(self, max_age_seconds):
+        """
+        Delete finished jobs older than max_age_seconds; returns how many were removed
+        """
+        with self._lock:
+            cursor = self._connect().execute(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND finished_at < ?",
+                (time.time() - max_age_seconds,)
+            )
+        return cursor.rowcount
+    
+    def limit_for(self, tenant):
+        return self.tenant_limits.get(tenant, self.tenant_limit)
+    
+    def _requeue_expired(self, conn, now):
+        # Jobs whose worker disappeared run again, up to max_attempts
+        conn.execute(
+            """UPDATE jobs SET status = 'failed', error = 'Worker lost the job too many times',
+               worker_id = NULL, finished_at = ?
+               WHERE status = 'running' AND lease_expires < ? AND attempts >= ?""",
+            (now, now, self.max_attempts)
+        )
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', worker_id = NULL WHERE status = 'running' AND lease_expires < ?",
+            (now,)
+        )
+    
+    def _finish(self, job_id, worker_id, status, result=None, error=None):
+        with self._lock:
+            cursor = self._connect().execute(
+                """UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_expires = NULL
+                   WHERE job_id = ? AND worker_id = ? AND status = 'running'""",
+                (status, result, error, time.time(), job_id, worker_id)
+            )
+        return cursor.rowcount == 1
+    
+    def _fetch(self, job_id, column):
+        with self._lock:
+            row = self._connect().execute(f"SELECT {column} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+    
+    def _connect(self):
+        # SQLite connections must not cross a fork: reopen in each process
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._conn
+
+def parse_tenant_limits(value):
+    """
+    Parse "tenant=limit,tenant=limit" into {tenant: limit}
+    """
+    limits = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            tenant, limit = item.split('=', 1)
+            limits[tenant.strip()] = int(limit)
+    return limits
+
+def queue_from_env():
+    """
+    Job queue configured from JOB_DB_PATH / JOB_LEASE_SECONDS / JOB_TENANT_* settings
+    """
+    return JobQueue(
+        os.getenv('JOB_DB_PATH', 'jobs.db'),
+        lease_seconds=int(os.getenv('JOB_LEASE_SECONDS', 60)),
+        max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', 3)),
+        tenant_limit=int(os.getenv('JOB_TENANT_CONCURRENCY', 2)),
+        tenant_limits=parse_tenant_limits(os.getenv('JOB_TENANT_LIMITS'))
+    )
@@ -0,0 +1,157 @@
+class JSONFieldStream:
+    """
+    Incremental parser for the top-level string fields of a streamed JSON object
+
+    feed() takes raw chunks as they arrive and returns [(field, text)] for
+    every piece of decoded string value completed so far, so the title of a
+    {"title": ..., "body": ...} reply can be shown before the body is written.
+    Escapes split across chunks (including \\uXXXX surrogate pairs) are
+    handled; text before the first "{" (e.g. a ```json fence) is skipped, and
+    non-string values (numbers, nested lists/objects) are skipped whole.
+    """
+    
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+    
+    def __init__(self):
+        self.fields = {}
+        self.done = False
+        self._state = 'start'
+        self._key = []
+        self._field = None
+        self._escape = None  # None, '' (after a backslash) or collected \u hex digits
+        self._high_surrogate = None
+        self._depth = 0
+        self._in_nested_string = False
+        self._nested_escape = False
+    
+    def feed(self, chunk):
+        """
+        Consume a chunk and return the [(field, text)] pieces it completed
+        """
+        events = []
+        text = []
+        for char in chunk:
+            if self._state == 'value':
+                piece = self._value_char(char)
+                if piece is None:
+                    # Closing quote: flush the finished value
+                    self._emit(events, text)
+                    self._state = 'after_value'
+                elif piece:
+                    text.append(piece)
+                continue
+            
+            if self._state == 'start':
+                if char == '{':
+                    self._state = 'key_or_end'
+            elif self._state == 'key_or_end':
+                if char == '"':
+                    self._key = []
+                    self._state = 'key'
+                elif char == '}':
+                    self._state = 'end'
+                    self.done = True
+            elif self._state == 'key':
+                if self._escape is not None:
+                    self._key.append(self.ESCAPES.get(char, char))
+                    self._escape = None
+                elif char == '\\':
+                    self._escape = ''
+                elif char == '"':
+                    self._state = 'colon'
+                else:
+                    self._key.append(char)
+            elif self._state == 'colon':
+                if char == ':':
+                    self._state = 'value_start'
+            elif self._state == 'value_start':
+                if char == '"':
+                    self._field = ''.join(self._key)
+                    self.fields.setdefault(self._field, '')
+                    self._state = 'value'
+                elif not char.isspace():
+                    # Number, literal, list or object: skip it
+                    self._depth = 1 if char in '[{' else 0
+                    self._state = 'skip'
+                    if self._depth == 0:
+                        self._skip_char(char)
+            elif self._state == 'skip':
+                self._skip_char(char)
+            elif self._state == 'after_value':
+                if char == ',':
+                    self._state = 'key_or_end'
+                elif char == '}':
+                    self._state = 'end'
+                    self.done = True
+        
+        self._emit(events, text)
+        return events
+    
+    def _value_char(self, char):
+        # Decoded text for one character of a string value ('' if nothing
+        # yet, None for the closing quote)
+        if self._escape is None:
+            if char == '\\':
+                self._escape = ''
+                return ''
+            if char == '"':
+                return None
+            return self._join_surrogate(char)
+        
+        if self._escape == '':
+            if char == 'u':
+                self._escape = 'u'
+                return ''
+            self._escape = None
+            return self._join_surrogate(self.ESCAPES.get(char, char))
+        
+        self._escape += char
+        if len(self._escape) < 5:
+            return ''
+        code = int(self._escape[1:], 16)
+        self._escape = None
+        if 0xD800 <= code < 0xDC00:
+            self._high_surrogate = code
+            return ''
+        return self._join_surrogate(chr(code), code)
+    
+    def _join_surrogate(self, char, code=None):
+        high, self._high_surrogate = self._high_surrogate, None
+        if high is None:
+            return char
+        if code is not None and 0xDC00 <= code < 0xE000:
+            return chr(0x10000 + ((high - 0xD800) << 10) + (code - 0xDC00))
+        return '\ufffd' + char
+    
+    def _skip_char(self, char):
+        if self._in_nested_string:
+            if self._nested_escape:
+                self._nested_escape = False
+            elif char == '\\':
+                self._nested_escape = True
+            elif char == '"':
+                self._in_nested_string = False
+            return
+        
+        if char == '"':
+            self._in_nested_string = True
+        elif char in '[{':
+            self._depth += 1
+        elif char in ']}':
+            self._depth -= 1
+            if self._depth < 0:
+                # The object itself closed right after a scalar
+                self._state = 'end'
+                self.done = True
+        elif char == ',' and self._depth == 0:
+            self._state = 'key_or_end'
+        
+        if self._state == 'skip' and self._depth == 0 and char in ']}':
+            self._state = 'after_value'
+    
+    def _emit(self, events, text):
+        if text:
+            piece = ''.join(text)
+            self.fields[self._field] += piece
+            events.append((self._field, piece))
+            text.clear()
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+def make_cache_key(model, messages, temperature, slot=0, **params):
+    """
+    Build a stable cache key for a chat completion request
+    """
+    payload = json.dumps({
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "slot": slot,
+        "params": params
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class MemoryCache:
+    """
+    In-memory LRU tier, with the same TTL as the disk tier
+    
+    Entries remember when they were created (for one promoted from disk,
+    when the disk row was), so an entry expires from memory at the moment
+    the disk tier would stop serving it.
+    """
+    
+    def __init__(self, max_entries=1024, ttl_seconds=None, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            created_at, value = entry
+            if self.ttl_seconds and created_at < self.clock() - self.ttl_seconds:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key, value, created_at=None):
+        with self._lock:
+            self._data[key] = (self.clock() if created_at is None else created_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+
+class SQLiteCache:
+    """
+    On-disk tier with TTL and size-bounded (least recently used) eviction
+    """
+    
+    def __init__(self, path, max_entries=50000, ttl_seconds=7 * 24 * 3600, clock=time.time):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._writes = 0
+        
+        with self._lock:
+            self._connect()
+    
+    def _connect(self):
+        # SQLite connections must not cross a fork: reopen in each process
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache (accessed_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache (created_at)")
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+    
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+    
+    def get_entry(self, key):
+        """
+        (value, created_at) for a live entry, or None
+        """
+        now = self.clock()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self.ttl_seconds and created_at < now - self.ttl_seconds:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return value, created_at
+    
+    def touch(self, accessed):
+        """
+        Record reads served elsewhere (e.g. by the memory tier): {key: accessed_at}
+        """
+        if not accessed:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "UPDATE llm_cache SET accessed_at = MAX(accessed_at, ?) WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in accessed.items()]
+            )
+            conn.commit()
+    
+    def set(self, key, value):
+        now = self.clock()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            self._writes += 1
+            # Evicting on every write would scan the index each time
+            if self._writes % 100 == 0:
+                self._evict(now)
+            conn.commit()
+    
+    def evict(self):
+        with self._lock:
+            conn = self._connect()
+            self._evict(self.clock())
+            conn.commit()
+    
+    def _evict(self, now):
+        conn = self._connect()
+        if self.ttl_seconds:
+            conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        
+        count = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        if count > self.max_entries:
+            conn.execute("""
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY accessed_at ASC LIMIT ?
+                )
+            """, (count - self.max_entries,))
+    
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM llm_cache")
+            conn.commit()
+    
+    def __len__(self):
+        with self._lock:
+            conn = self._connect()
+            return conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+class LLMCache:
+    """
+    Two-tier completion cache: memory LRU in front of an optional SQLite store
+    
+    Memory hits are passed on to the disk tier's access times in batches
+    (of TOUCH_BATCH, and before every disk write, which is when the disk
+    tier evicts), so its LRU eviction sees every read.
+    """
+    
+    TOUCH_BATCH = 256
+    
+    def __init__(self, max_entries=1024, path=None, disk_max_entries=50000,
+                 ttl_seconds=7 * 24 * 3600, clock=time.time):
+        self.memory = MemoryCache(max_entries, ttl_seconds, clock)
+        self.disk = SQLiteCache(path, disk_max_entries, ttl_seconds, clock) if path else None
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._touched = {}
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'writes': 0}
+    
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self._count('memory_hits')
+            if self.disk is not None:
+                self._touch(key)
+            return value
+        
+        if self.disk is not None:
+            entry = self.disk.get_entry(key)
+            if entry is not None:
+                # Promote to the memory tier (expiring with the disk row)
+                value, created_at = entry
+                self.memory.set(key, value, created_at)
+                self._count('disk_hits')
+                return value
+        
+        self._count('misses')
+        return None
+    
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.flush()
+            self.disk.set(key, value)
+        self._count('writes')
+    
+    def flush(self):
+        """
+        Write pending memory-hit access times to the disk tier
+        """
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if self.disk is not None:
+            self.disk.touch(touched)
+    
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            with self._lock:
+                self._touched = {}
+            self.disk.clear()
+    
+    def stats(self):
+        """
+        Hit/miss counters and tier sizes
+        """
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = round((lookups - stats['misses']) / lookups, 3) if lookups else 0.0
+        stats['memory_entries'] = len(self.memory)
+        stats['disk_entries'] = len(self.disk) if self.disk is not None else 0
+        return stats
+    
+    def _touch(self, key):
+        with self._lock:
+            self._touched[key] = self.clock()
+            full = len(self._touched) >= self.TOUCH_BATCH
+        if full:
+            self.flush()
+    
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
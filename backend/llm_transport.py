@@ -0,0 +1,571 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from llm_cache import make_cache_key
+from rate_limiter import shared_rate_limiter
+from telemetry import LLM_RETRIES
+
+# Completion tokens assumed for a request that doesn't set max_tokens
+COMPLETION_TOKEN_ESTIMATE = 500
+
+class TransportError(Exception):
+    """
+    A chat completion request failed (HTTP status and Retry-After when known)
+    """
+    
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+# Per-process OpenAI clients, by API key: {api_key: (pid, client)}
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+def openai_client(api_key=None):
+    """
+    The process's shared OpenAI client for api_key, created on first use
+    
+    Connection pool limits come from OPENAI_MAX_CONNECTIONS (default 64),
+    OPENAI_KEEPALIVE_CONNECTIONS (default 32), OPENAI_KEEPALIVE_EXPIRY
+    (seconds, default 30) and OPENAI_TIMEOUT (seconds, default 120). Pooled
+    sockets must not be shared across a fork, so a forked process (e.g. a
+    gunicorn worker) gets a client of its own.
+    """
+    pid = os.getpid()
+    with _CLIENTS_LOCK:
+        entry = _CLIENTS.get(api_key)
+        if entry is not None and entry[0] == pid:
+            return entry[1]
+        
+        import httpx
+        from openai import DefaultHttpxClient, OpenAI
+        
+        http_client = DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=int(os.getenv('OPENAI_MAX_CONNECTIONS', 64)),
+                max_keepalive_connections=int(os.getenv('OPENAI_KEEPALIVE_CONNECTIONS', 32)),
+                keepalive_expiry=float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', 30))
+            ),
+            timeout=httpx.Timeout(float(os.getenv('OPENAI_TIMEOUT', 120)), connect=10.0)
+        )
+        client = OpenAI(api_key=api_key, http_client=http_client)
+        _CLIENTS[api_key] = (pid, client)
+        return client
+
+class OpenAITransport:
+    """
+    Live transport: sends requests to the OpenAI API
+    
+    Without an explicit client, the process's shared client (openai_client)
+    is used, created on the first request rather than at startup.
+    """
+    
+    def __init__(self, api_key=None, client=None):
+        self.api_key = api_key
+        self._client = client
+    
+    @property
+    def client(self):
+        return self._client or openai_client(self.api_key)
+    
+    def complete(self, model, messages, temperature, **params):
+        """
+        Run one chat completion and return {"content", "usage"}
+        """
+        import openai
+        
+        try:
+            response = self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                **params
+            )
+        except openai.APIError as e:
+            raise _transport_error(e) from e
+        
+        usage = response.usage.model_dump() if response.usage is not None else {}
+        return {
+            "content": response.choices[0].message.content.strip(),
+            "usage": usage
+        }
+    
+    def stream(self, model, messages, temperature, on_usage=None, **params):
+        """
+        Run one chat completion as a stream, yielding text deltas
+        
+        Closing the generator early closes the HTTP response, so the model
+        stops generating (and billing for) the rest of the reply. on_usage
+        gets the usage the API reports once the reply is complete.
+        """
+        import openai
+        
+        try:
+            response = self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                stream_options={"include_usage": True},
+                **params
+            )
+        except openai.APIError as e:
+            raise _transport_error(e) from e
+        
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                if chunk.usage is not None and on_usage is not None:
+                    on_usage(chunk.usage.model_dump())
+        except openai.APIError as e:
+            raise _transport_error(e) from e
+        finally:
+            response.close()
+
+def _transport_error(error):
+    """
+    TransportError for an openai exception (status and Retry-After when it has a response)
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return TransportError(str(error))
+    retry_after = response.headers.get('retry-after')
+    return TransportError(str(error), status_code=response.status_code,
+                          retry_after=float(retry_after) if retry_after else None)
+
+class RecordingTransport:
+    """
+    Passes requests to another transport and appends every exchange to a JSONL transcript
+    """
+    
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.path = path
+        self._lock = threading.Lock()
+    
+    def complete(self, model, messages, temperature, **params):
+        result = self.inner.complete(model, messages, temperature, **params)
+        self._record(model, messages, temperature, params, result['content'], result.get('usage', {}))
+        return result
+    
+    def stream(self, model, messages, temperature, on_usage=None, **params):
+        """
+        Stream from the inner transport; only replies read to the end are recorded
+        """
+        pieces = []
+        usage = {}
+        def capture_usage(reported):
+            usage.update(reported)
+            if on_usage is not None:
+                on_usage(reported)
+        for piece in stream_completion(self.inner, model, messages, temperature, on_usage=capture_usage, **params):
+            pieces.append(piece)
+            yield piece
+        self._record(model, messages, temperature, params, ''.join(pieces).strip(), usage)
+    
+    def _record(self, model, messages, temperature, params, content, usage):
+        entry = {
+            "key": make_cache_key(model, messages, temperature, **params),
+            "request": {"model": model, "messages": messages, "temperature": temperature, "params": params},
+            "content": content,
+            "usage": usage
+        }
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+class RateLimitedTransport:
+    """
+    Sends requests through a RateLimiter, retrying throttled and failed ones
+    
+    429s, 5xx and connection errors are retried up to max_retries times with
+    backoff (honoring Retry-After); other errors, such as a bad request, are
+    raised at once. A stream is only retried if it failed before any text.
+    """
+    
+    RETRY_STATUSES = (408, 409, 429)
+    
+    def __init__(self, inner, limiter=None, max_retries=5):
+        self.inner = inner
+        self.limiter = limiter or shared_rate_limiter()
+        self.max_retries = max_retries
+    
+    def complete(self, model, messages, temperature, **params):
+        estimate = estimate_tokens(messages, params)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(estimate)
+            try:
+                result = self.inner.complete(model, messages, temperature, **params)
+            except TransportError as e:
+                self.limiter.release(throttled=e.status_code == 429)
+                if not self.retryable(e) or attempt == self.max_retries:
+                    raise
+                LLM_RETRIES.inc(status=e.status_code or 'connection')
+                self.limiter.backoff(attempt, e.retry_after)
+                continue
+            except BaseException:
+                self.limiter.release()
+                raise
+            
+            self.limiter.release()
+            total_tokens = (result.get('usage') or {}).get('total_tokens')
+            if total_tokens:
+                self.limiter.record_usage(estimate, total_tokens)
+            return result
+    
+    def stream(self, model, messages, temperature, on_usage=None, **params):
+        estimate = estimate_tokens(messages, params)
+        def correct_estimate(usage):
+            if usage.get('total_tokens'):
+                self.limiter.record_usage(estimate, usage['total_tokens'])
+            if on_usage is not None:
+                on_usage(usage)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(estimate)
+            started = False
+            throttled = False
+            try:
+                for piece in stream_completion(self.inner, model, messages, temperature,
+                                               on_usage=correct_estimate, **params):
+                    started = True
+                    yield piece
+                return
+            except TransportError as e:
+                throttled = e.status_code == 429
+                retry_after = e.retry_after
+                if started or not self.retryable(e) or attempt == self.max_retries:
+                    raise
+                LLM_RETRIES.inc(status=e.status_code or 'connection')
+            finally:
+                self.limiter.release(throttled=throttled)
+            self.limiter.backoff(attempt, retry_after)
+    
+    def retryable(self, error):
+        status = error.status_code
+        return status is None or status in self.RETRY_STATUSES or status >= 500
+
+def estimate_tokens(messages, params):
+    """
+    Rough token count of a request (about 4 characters per token) plus its expected reply
+    """
+    prompt_tokens = sum(len(message['content']) for message in messages) // 4
+    return prompt_tokens + params.get('max_tokens', COMPLETION_TOKEN_ESTIMATE)
+
+class ReplayTransport:
+    """
+    Serves responses from a recorded transcript, matched on the exact request
+    
+    Identical requests recorded several times are replayed in recorded order;
+    the last one repeats once they run out.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._responses = {}
+        self._served = {}
+        self._lock = threading.Lock()
+        
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self._responses.setdefault(entry['key'], []).append(
+                    {"content": entry['content'], "usage": entry.get('usage', {})}
+                )
+    
+    def complete(self, model, messages, temperature, **params):
+        key = make_cache_key(model, messages, temperature, **params)
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                raise TransportError(f"No recorded response for request {key[:12]}", status_code=404)
+            index = self._served.get(key, 0)
+            self._served[key] = index + 1
+        return dict(responses[min(index, len(responses) - 1)])
+
+class SyntheticTransport:
+    """
+    Offline fake backend with configurable latency and failure rate
+    
+    Text is derived from a hash of the request, so the same prompt always gets
+    the same reply. Latency and failures come from a seeded RNG.
+    latency_dist is one of 'fixed', 'uniform' (0..2x mean), 'exponential'
+    or 'lognormal' (median = latency, spread = latency_sigma).
+    """
+    
+    LATENCY_DISTS = ('fixed', 'uniform', 'exponential', 'lognormal')
+    
+    OPENERS = ['yeah', 'lol same', 'tbh', 'ngl', '+1', 'honestly', 'imo', 'fwiw', 'same here', 'this']
+    PHRASES = [
+        'been dealing with this for months', 'my team had the same problem',
+        'ended up building a template for it', 'worth trying a couple of tools first',
+        'it depends a lot on your workflow', 'the learning curve is real',
+        'saved me a few hours last week', 'still figuring it out tbh'
+    ]
+    
+    def __init__(self, latency=0.0, latency_dist='fixed', latency_sigma=0.5,
+                 failure_rate=0.0, failure_status=500, seed=None, sleep=time.sleep):
+        if latency_dist not in self.LATENCY_DISTS:
+            raise ValueError(f"Unknown latency_dist: {latency_dist}")
+        
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.sleep = sleep
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+    
+    def complete(self, model, messages, temperature, **params):
+        with self._lock:
+            self.calls += 1
+            delay = self._sample_latency()
+            failed = self._rng.random() < self.failure_rate
+        
+        if delay:
+            self.sleep(delay)
+        if failed:
+            raise TransportError("Synthetic failure", status_code=self.failure_status,
+                                 retry_after=1.0 if self.failure_status == 429 else None)
+        
+        prompt = '\n'.join(message['content'] for message in messages)
+        text_rng = random.Random(hashlib.sha256(
+            json.dumps([model, messages, temperature], sort_keys=True).encode('utf-8')
+        ).hexdigest())
+        
+        if '"comments"' in prompt:
+            content = json.dumps(self._thread(messages[-1]['content'], text_rng))
+        elif '"title"' in prompt:
+            content = json.dumps(self._post(text_rng))
+        else:
+            content = self._comment(text_rng)
+        
+        prompt_tokens = sum(len(m['content']) for m in messages) // 4
+        completion_tokens = len(content) // 4
+        return {
+            "content": content,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+    
+    def _sample_latency(self):
+        if not self.latency:
+            return 0.0
+        if self.latency_dist == 'uniform':
+            return self._rng.uniform(0, 2 * self.latency)
+        if self.latency_dist == 'exponential':
+            return self._rng.expovariate(1 / self.latency)
+        if self.latency_dist == 'lognormal':
+            return self.latency * self._rng.lognormvariate(0, self.latency_sigma)
+        return self.latency
+    
+    def _comment(self, rng):
+        sentences = rng.sample(self.PHRASES, rng.randint(1, 3))
+        return f"{rng.choice(self.OPENERS)} {'. '.join(sentences)}"
+    
+    def _post(self, rng):
+        return {
+            "title": f"anyone else {rng.choice(self.PHRASES)}?",
+            "body": '. '.join(rng.sample(self.PHRASES, 3)) + '. what do you all do?'
+        }
+    
+    def _thread(self, prompt, rng):
+        # Commenters are listed one per line as "<index>. <username> ..."
+        count = len(re.findall(r'^\d+\. ', prompt, flags=re.MULTILINE))
+        thread = self._post(rng)
+        thread['comments'] = [
+            {"index": i, "reply_to": None, "text": self._comment(rng)} for i in range(count)
+        ]
+        return thread
+
+# Batch statuses after which a batch will not change any more
+BATCH_DONE_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+class OpenAIBatchTransport:
+    """
+    Batch transport: runs a JSONL file of chat requests through the OpenAI Batch API
+    
+    Batches finish within 24 hours at half the price of live calls. Result
+    lines keep the API's shape: {"custom_id", "response": {"status_code",
+    "body"}, "error"}.
+    """
+    
+    def __init__(self, api_key=None, client=None, completion_window='24h'):
+        self.api_key = api_key
+        self._client = client
+        self.completion_window = completion_window
+    
+    @property
+    def client(self):
+        return self._client or openai_client(self.api_key)
+    
+    def submit(self, path):
+        """
+        Upload a batch input file and start the batch; returns the batch id
+        """
+        import openai
+        
+        try:
+            with open(path, 'rb') as f:
+                input_file = self.client.files.create(file=f, purpose='batch')
+            batch = self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint='/v1/chat/completions',
+                completion_window=self.completion_window
+            )
+        except openai.APIError as e:
+            raise _transport_error(e) from e
+        return batch.id
+    
+    def poll(self, batch_id):
+        """
+        Current status of a batch (one of BATCH_DONE_STATUSES once it has finished)
+        """
+        import openai
+        
+        try:
+            return self.client.batches.retrieve(batch_id).status
+        except openai.APIError as e:
+            raise _transport_error(e) from e
+    
+    def results(self, batch_id):
+        """
+        Result lines of a finished batch: successes and per-request errors
+        """
+        import openai
+        
+        try:
+            batch = self.client.batches.retrieve(batch_id)
+            lines = []
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    text = self.client.files.content(file_id).text
+                    lines.extend(json.loads(line) for line in text.splitlines() if line.strip())
+        except openai.APIError as e:
+            raise _transport_error(e) from e
+        return lines
+
+class LocalBatchTransport:
+    """
+    Offline stand-in for the Batch API: runs each request of a batch file through a chat transport
+    
+    The batch reports 'in_progress' for the first `pending_polls` polls, then
+    runs every request (through SyntheticTransport unless another transport
+    is given) and reports 'completed'. Failed requests come back as error
+    lines, like the real API's.
+    """
+    
+    def __init__(self, transport=None, pending_polls=1):
+        self.transport = transport or SyntheticTransport()
+        self.pending_polls = pending_polls
+        self.batches = {}
+        self._lock = threading.Lock()
+    
+    def submit(self, path):
+        with open(path, encoding='utf-8') as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        with self._lock:
+            batch_id = f"batch_local_{len(self.batches) + 1}"
+            self.batches[batch_id] = {"requests": requests, "polls": 0, "results": None}
+        return batch_id
+    
+    def poll(self, batch_id):
+        batch = self.batches[batch_id]
+        if batch['results'] is not None:
+            return 'completed'
+        batch['polls'] += 1
+        if batch['polls'] <= self.pending_polls:
+            return 'in_progress'
+        batch['results'] = [self._run(request) for request in batch['requests']]
+        return 'completed'
+    
+    def results(self, batch_id):
+        return list(self.batches[batch_id]['results'] or [])
+    
+    def _run(self, request):
+        body = dict(request['body'])
+        model = body.pop('model')
+        messages = body.pop('messages')
+        temperature = body.pop('temperature')
+        try:
+            result = self.transport.complete(model, messages, temperature, **body)
+        except TransportError as e:
+            return {
+                "custom_id": request['custom_id'],
+                "response": {"status_code": e.status_code or 500, "body": {"error": {"message": str(e)}}},
+                "error": None
+            }
+        return {
+            "custom_id": request['custom_id'],
+            "response": {
+                "status_code": 200,
+                "body": {
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": result['content']}}],
+                    "usage": result.get('usage') or {}
+                }
+            },
+            "error": None
+        }
+
+def stream_completion(transport, model, messages, temperature, chunk_size=16, on_usage=None, **params):
+    """
+    Yield a completion's text in pieces as it is generated
+    
+    Uses the transport's stream() when it has one; otherwise (replay,
+    synthetic, ...) the finished reply is cut into chunk_size pieces, so
+    callers see the same shape of output either way. on_usage(usage) is
+    called once the whole reply has been read.
+    """
+    if hasattr(transport, 'stream'):
+        yield from transport.stream(model, messages, temperature, on_usage=on_usage, **params)
+        return
+    
+    result = transport.complete(model, messages, temperature, **params)
+    content = result['content']
+    for start in range(0, len(content), chunk_size):
+        yield content[start:start + chunk_size]
+    if on_usage is not None and result.get('usage'):
+        on_usage(result['usage'])
+
+def create_transport(mode='live', api_key=None, transcript_path=None, **synthetic_options):
+    """
+    Build a transport by name: live, record, replay or synthetic
+    
+    Everything but replay goes through the process-wide rate limiter.
+    """
+    if mode == 'live':
+        return RateLimitedTransport(OpenAITransport(api_key))
+    if mode == 'record':
+        return RecordingTransport(RateLimitedTransport(OpenAITransport(api_key)), transcript_path)
+    if mode == 'replay':
+        return ReplayTransport(transcript_path)
+    if mode == 'synthetic':
+        return RateLimitedTransport(SyntheticTransport(**synthetic_options))
+    raise ValueError(f"Unknown transport mode: {mode}")
+
+def transport_from_env(api_key=None):
+    """
+    Build the transport selected by LLM_TRANSPORT / LLM_TRANSCRIPT / SYNTHETIC_* settings
+    """
+    mode = os.getenv('LLM_TRANSPORT', 'live')
+    options = {}
+    if mode == 'synthetic':
+        options = {
+            "latency": float(os.getenv('SYNTHETIC_LATENCY', 0.0)),
+            "latency_dist": os.getenv('SYNTHETIC_LATENCY_DIST', 'fixed'),
+            "failure_rate": float(os.getenv('SYNTHETIC_FAILURE_RATE', 0.0))
+        }
+    return create_transport(mode, api_key, os.getenv('LLM_TRANSCRIPT', 'llm_transcript.jsonl'), **options)
@@ -0,0 +1,81 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+from telemetry import LLM_CACHE_HITS, LLM_TOKENS
+
+_current_meter = contextvars.ContextVar('llm_usage_meter', default=None)
+
+class UsageMeter:
+    """
+    Adds up token usage reported by completions (e.g. for one calendar)
+
+    cached_tokens is the part of prompt_tokens served from the provider's
+    prompt cache (billed at a discount); cache_hits counts replies served
+    by our own LLMCache, which cost nothing.
+    """
+
+    FIELDS = ('requests', 'cache_hits', 'prompt_tokens', 'cached_tokens', 'completion_tokens', 'total_tokens')
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, usage=None, cache_hit=False):
+        with self._lock:
+            if cache_hit:
+                self.counts['cache_hits'] += 1
+                return
+
+            usage = usage or {}
+            details = usage.get('prompt_tokens_details') or {}
+            self.counts['requests'] += 1
+            self.counts['prompt_tokens'] += usage.get('prompt_tokens') or 0
+            self.counts['cached_tokens'] += details.get('cached_tokens') or 0
+            self.counts['completion_tokens'] += usage.get('completion_tokens') or 0
+            self.counts['total_tokens'] += usage.get('total_tokens') or 0
+
+    def totals(self):
+        with self._lock:
+            return dict(self.counts)
+
+@contextmanager
+def metered(meter):
+    """
+    Record the usage of completions made inside the block into meter
+
+    The meter follows the context, so work handed to a thread pool is
+    counted too when submitted through contextvars.copy_context().run.
+    """
+    token = _current_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _current_meter.reset(token)
+
+def record_usage(usage=None, cache_hit=False):
+    """
+    Add a completion's usage to the current meter (if any) and the process metrics
+    """
+    if cache_hit:
+        LLM_CACHE_HITS.inc()
+    elif usage:
+        details = usage.get('prompt_tokens_details') or {}
+        LLM_TOKENS.inc(usage.get('prompt_tokens') or 0, kind='prompt')
+        LLM_TOKENS.inc(details.get('cached_tokens') or 0, kind='cached')
+        LLM_TOKENS.inc(usage.get('completion_tokens') or 0, kind='completion')
+    meter = _current_meter.get()
+    if meter is not None:
+        meter.add(usage, cache_hit)
+
+def estimated_usage(messages, reply):
+    """
+    Usage for a completion that reported none (e.g. a stream cut off early),
+    at about 4 characters per token
+    """
+    prompt_tokens = sum(len(message['content']) for message in messages) // 4
+    completion_tokens = len(reply) // 4
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
@@ -0,0 +1,171 @@
+import re
+import zlib
+from array import array
+
+# MinHash signature length (one-permutation hashing: one bin per slot)
+NUM_BINS = 32
+
+# LSH banding: two signatures become candidates if any band of ROWS slots
+# matches, which finds pairs above ~0.6 similarity almost surely
+BANDS = 8
+ROWS = NUM_BINS // BANDS
+
+# Word n-grams compared between texts
+SHINGLE_WORDS = 3
+
+# Texts shorter than this are too generic to call a copy ("same here lol")
+MIN_WORDS = 6
+
+# Estimated Jaccard similarity from which two texts count as near-duplicates
+DEFAULT_THRESHOLD = 0.7
+
+_VALUE_BITS = 32 - (NUM_BINS - 1).bit_length()
+_VALUE_MASK = (1 << _VALUE_BITS) - 1
+_MIX = 0x9E3779B1
+_EMPTY = 0xFFFFFFFF
+
+def signature(text):
+    """
+    MinHash signature of a text's word shingles (None if the text is too short)
+
+    Uses one-permutation hashing: each shingle is hashed once (CRC32 with a
+    multiplicative mix, stable across processes so signatures can be stored)
+    into one of NUM_BINS bins that keep their minimum; empty bins borrow the
+    next filled bin's value, offset by the distance, so the signature stays
+    a valid MinHash.
+    """
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < MIN_WORDS:
+        return None
+    
+    mins = [_EMPTY] * NUM_BINS
+    crc32 = zlib.crc32
+    for i in range(len(words) - SHINGLE_WORDS + 1):
+        h = (crc32(' '.join(words[i:i + SHINGLE_WORDS]).encode()) * _MIX) & 0xFFFFFFFF
+        # The well-mixed high bits pick the bin, the rest is the value
+        slot = h >> _VALUE_BITS
+        value = h & _VALUE_MASK
+        if value < mins[slot]:
+            mins[slot] = value
+    
+    # Densify: fill empty bins from the nearest filled bin to the right
+    if _EMPTY in mins:
+        hashed = mins[:]
+        for slot in range(NUM_BINS):
+            if hashed[slot] == _EMPTY:
+                distance = 1
+                while hashed[(slot + distance) % NUM_BINS] == _EMPTY:
+                    distance += 1
+                mins[slot] = hashed[(slot + distance) % NUM_BINS] + (distance << _VALUE_BITS)
+    return array('I', mins)
+
+def similarity(a, b):
+    """
+    Estimated Jaccard similarity of the texts behind two signatures
+    """
+    return sum(x == y for x, y in zip(a, b)) / NUM_BINS
+
+class NearDuplicateIndex:
+    """
+    MinHash + LSH index of texts for sub-linear near-duplicate lookup
+
+    Each signature is split into BANDS bands and every band is hashed into
+    a bucket, so a lookup only compares against the few items that share a
+    bucket instead of every stored text. Items are stored by label (e.g.
+    "C213 (week 2)"); the texts themselves are not kept.
+    """
+    
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.labels = []
+        self.signatures = []
+        self._positions = {}
+        self._buckets = [{} for _ in range(BANDS)]
+    
+    def __len__(self):
+        return len(self._positions)
+    
+    def add(self, label, sig):
+        """
+        Store a signature (from signature()) under label
+        """
+        index = len(self.labels)
+        self.labels.append(label)
+        self.signatures.append(sig)
+        self._positions[label] = index
+        for band, key in enumerate(self._band_keys(sig)):
+            bucket = self._buckets[band]
+            entry = bucket.get(key)
+            if entry is None:
+                bucket[key] = index
+            elif isinstance(entry, list):
+                entry.append(index)
+            else:
+                bucket[key] = [entry, index]
+    
+    def add_text(self, label, text):
+        """
+        Store a text; returns its signature (None if too short to index)
+        """
+        sig = signature(text)
+        if sig is not None:
+            self.add(label, sig)
+        return sig
+    
+    def remove(self, label):
+        """
+        Drop a stored item; returns its signature (None if label isn't stored)
+        """
+        index = self._positions.pop(label, None)
+        if index is None:
+            return None
+        
+        sig = self.signatures[index]
+        for band, key in enumerate(self._band_keys(sig)):
+            bucket = self._buckets[band]
+            entry = bucket[key]
+            if not isinstance(entry, list):
+                del bucket[key]
+                continue
+            entry.remove(index)
+            if len(entry) == 1:
+                bucket[key] = entry[0]
+        self.labels[index] = self.signatures[index] = None
+        return sig
+    
+    def query(self, sig):
+        """
+        Best match for a signature as (label, similarity), or None below the threshold
+        """
+        if sig is None or not self._positions:
+            return None
+        
+        candidates = set()
+        for band, key in enumerate(self._band_keys(sig)):
+            entry = self._buckets[band].get(key)
+            if entry is None:
+                continue
+            if isinstance(entry, list):
+                candidates.update(entry)
+            else:
+                candidates.add(entry)
+        
+        best = None
+        # Lowest index first so ties go to the earliest item
+        for index in sorted(candidates):
+            score = similarity(sig, self.signatures[index])
+            if score >= self.threshold and (best is None or score > best[1]):
+                best = (self.labels[index], score)
+        return best
+    
+    def _band_keys(self, sig):
+        return [hash(sig[start:start + ROWS].tobytes()) for start in range(0, NUM_BINS, ROWS)]
+
+def calendar_texts(calendar_posts):
+    """
+    (item_id, text) for every post (title and body) and comment
+    """
+    for post in calendar_posts:
+        yield post['post_id'], post['title'] + '\n' + post['body']
+        for comment in post['comments']:
+            yield comment['comment_id'], comment['comment_text']
@@ -0,0 +1,77 @@
+import re
+from functools import lru_cache
+
+class PhraseMatcher:
+    """
+    Finds every lexicon phrase present in a text with one regex scan
+
+    The phrases are compiled into a prefix trie and the trie into a single
+    regex inside a lookahead, so the scan finds every position where some
+    phrase starts without trying each phrase separately. Overlapping phrases
+    ("totally", "totally feel") are all reported, like separate `in` checks.
+    Small lexicons skip the regex: a few C-level substring checks beat it.
+    """
+    
+    SMALL_LEXICON = 64
+    
+    def __init__(self, phrases):
+        self.phrases = tuple(dict.fromkeys(p for p in phrases if p))
+        self._trie = {}
+        for phrase in self.phrases:
+            node = self._trie
+            for char in phrase:
+                node = node.setdefault(char, {})
+            node[''] = phrase
+        
+        self._small = len(self.phrases) <= self.SMALL_LEXICON
+        self._regex = None if self._small else re.compile('(?=' + self._trie_regex(self._trie) + ')')
+    
+    def find(self, text):
+        """
+        Return the set of phrases that occur in text
+        """
+        if self._small:
+            return set(filter(text.__contains__, self.phrases))
+        
+        found = set()
+        for match in self._regex.finditer(text):
+            # Collect every phrase starting here (the regex only proves one does)
+            node = self._trie
+            for char in text[match.start():]:
+                node = node.get(char)
+                if node is None:
+                    break
+                if '' in node:
+                    found.add(node[''])
+        return found
+    
+    def search(self, text):
+        """
+        True if any phrase occurs in text
+        """
+        if self._small:
+            return any(map(text.__contains__, self.phrases))
+        return self._regex.search(text) is not None
+    
+    def _trie_regex(self, node):
+        branches = []
+        terminal = '' in node
+        for char in sorted(k for k in node if k):
+            branches.append(re.escape(char) + self._trie_regex(node[char]))
+        
+        if not branches:
+            return ''
+        if len(branches) == 1 and not terminal:
+            return branches[0]
+        # A phrase ending here makes the rest of the branch optional
+        return '(?:' + '|'.join(branches) + ')' + ('?' if terminal else '')
+
+@lru_cache(maxsize=256)
+def _compile(phrases):
+    return PhraseMatcher(phrases)
+
+def get_matcher(phrases):
+    """
+    Compiled matcher for a lexicon, cached so each lexicon is compiled once
+    """
+    return _compile(tuple(phrases))
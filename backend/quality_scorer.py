@@ -1,5 +1,401 @@
 import re
 from collections import Counter
+from functools import lru_cache
+from near_duplicates import NearDuplicateIndex, signature
+from phrase_matcher import get_matcher
+from telemetry import traced
+
+# Phrases that make content read like an ad or a bot
+UNNATURAL_PHRASES = [
+    'as an ai', 'i am a bot', 'click here', 'buy now',
+    'limited time', 'act now', 'special offer'
+]
+
+FORMAL_WORDS = ['furthermore', 'moreover', 'nevertheless', 'henceforth']
+
+PROMO_WORDS = ['revolutionary', 'game-changer', 'best ever', 'must-have',
+               'life-changing', 'perfect solution', 'amazing tool',
+               'check out', 'click here', 'sign up']
+
+REPETITIVE_OPENERS = ['totally', 'i feel you', 'i totally', 'totally feel',
+                      'totally get', 'i get that', "i've been using",
+                      "i've tried", "i've been trying"]
+
+DISCLAIMER_PHRASES = ['not perfect', "isn't perfect"]
+
+COMMON_TITLE_WORDS = {'the', 'a', 'an', 'for', 'to', 'in', 'on', 'of', 'and', 'or', 'how', 'what', 'best'}
+
+# Lexicons a tenant can override (keys of the lexicons dict)
+DEFAULT_LEXICONS = {
+    'unnatural_phrases': UNNATURAL_PHRASES,
+    'formal_words': FORMAL_WORDS,
+    'promo_words': PROMO_WORDS,
+    'repetitive_openers': REPETITIVE_OPENERS
+}
+
+class Lexicon:
+    """
+    Phrase lists for one tenant, compiled into matchers
+    """
+    
+    def __init__(self, unnatural_phrases, formal_words, promo_words, repetitive_openers,
+                 company_names):
+        self.unnatural_phrases = unnatural_phrases
+        self.formal_words = frozenset(formal_words)
+        self.promo_words = frozenset(promo_words)
+        self.repetitive_openers = repetitive_openers
+        self.company_names = frozenset(company_names)
+        self.disclaimers = frozenset(DISCLAIMER_PHRASES)
+        
+        # One scan per text instead of one substring check per phrase
+        self.natural_matcher = get_matcher(unnatural_phrases + formal_words)
+        self.comment_matcher = get_matcher(promo_words + company_names + tuple(DISCLAIMER_PHRASES))
+        self.opener_matcher = get_matcher(repetitive_openers)
+        self.opener_rank = {opener: i for i, opener in enumerate(repetitive_openers)}
+        
+        # Longest phrase that can straddle two texts, minus one character
+        self.tail_length = max((len(p) for p in unnatural_phrases + formal_words), default=1) - 1
+
+@lru_cache(maxsize=256)
+def _compile_lexicon(unnatural_phrases, formal_words, promo_words, repetitive_openers, company_names):
+    return Lexicon(unnatural_phrases, formal_words, promo_words, repetitive_openers, company_names)
+
+def get_lexicon(lexicons=None, company_names=()):
+    """
+    Compiled lexicon for tenant overrides and company names (cached per combination)
+    """
+    lexicons = lexicons or {}
+    unknown = set(lexicons) - set(DEFAULT_LEXICONS)
+    if unknown:
+        raise ValueError(f"Unknown lexicons: {', '.join(sorted(unknown))}")
+    
+    merged = {**DEFAULT_LEXICONS, **lexicons}
+    lists = [tuple(p.lower() for p in merged[key]) for key in DEFAULT_LEXICONS]
+    return _compile_lexicon(*lists, tuple(name.lower() for name in company_names if name))
+
+class CalendarFeatures:
+    """
+    Compact counters extracted from a calendar in a single pass
+
+    Every text is lowercased and split once; the checks in QualityScorer only
+    read these counters, so no text is kept after it has been added (apart
+    from the few characters at each end of a post). The naturalness phrases
+    are found as if every text of the calendar were joined with spaces: each
+    post's texts are scanned together, and each boundary between two posts
+    through a window just wide enough for a phrase that straddles it.
+
+    Everything is counted (not just collected in sets), so remove_post can
+    take a post back out of its position: after a few posts are regenerated
+    the calendar is re-scored by replacing the old posts with the new ones,
+    rescanning only their texts and the boundaries around them.
+
+    With a near_duplicates index (earlier content, e.g. the campaign's past
+    weeks; it is only read) every post and comment is also checked against
+    it and against the calendar's own other texts.
+    """
+    
+    def __init__(self, lexicon=None, near_duplicates=None):
+        self.lexicon = lexicon or get_lexicon()
+        self.num_posts = 0
+        
+        # Near-duplicates: (item_id, matched label, similarity)
+        self.near_duplicates = near_duplicates
+        self.duplicates = []
+        self._own_texts = None if near_duplicates is None else NearDuplicateIndex(near_duplicates.threshold)
+        
+        # Naturalness: posts and post boundaries containing each unnatural phrase / formal words
+        self.unnatural_counts = Counter()
+        self.formal_count = 0
+        # Per post in calendar order: its first and last tail_length characters,
+        # and the boundary before it (the stream's last characters, phrases found)
+        self._edges = []
+        self._boundaries = []
+        
+        # Persona variety (insertion order = first appearance)
+        self.persona_counts = Counter()
+        
+        # Timing realism
+        self.delay_counts = Counter()
+        self.num_delays = 0
+        self.delay_total = 0
+        
+        # Content diversity
+        self.title_word_counts = Counter()
+        # Non-common words used more than twice (word -> order of first use),
+        # kept up to date so the diversity check doesn't rescan the vocabulary
+        self.repeated_title_words = {}
+        self._title_first_use = {}
+        self.keyword_counts = Counter()
+        self.num_keywords = 0
+        
+        # Anti-spam (comments only)
+        self.num_comments = 0
+        self.promo_count = 0
+        self.opener_counts = {}
+        self.not_perfect_count = 0
+        self.exclamation_count = 0
+        self.company_mentions = 0
+        self.comment_length_counts = Counter()
+        self.comment_word_counts = Counter()
+        self.comment_word_total = 0
+    
+    def add_post(self, post, index=None):
+        """
+        Fold one post and its comments into the counters, at index (appended by default)
+        """
+        self.num_posts += 1
+        
+        title = post['title'].lower()
+        body = post['body'].lower()
+        texts = [title, body]
+        
+        self.persona_counts[post['author_username']] += 1
+        
+        title_word_counts = self.title_word_counts
+        for word in re.findall(r'\w+', title):
+            count = title_word_counts[word] + 1
+            title_word_counts[word] = count
+            if count == 1:
+                self._title_first_use.setdefault(word, len(self._title_first_use))
+            elif count == 3 and word not in COMMON_TITLE_WORDS:
+                self.repeated_title_words[word] = self._title_first_use[word]
+        keywords = post.get('keyword_ids', [])
+        self.keyword_counts.update(keywords)
+        self.num_keywords += len(keywords)
+        
+        if self.near_duplicates is not None:
+            self._check_duplicate(post['post_id'], post['title'] + '\n' + post['body'])
+        
+        for comment in post['comments']:
+            texts.append(self._add_comment(comment))
+        
+        text = ' '.join(texts)
+        self._scan_naturalness(text, 1)
+        self._insert_edges(len(self._edges) if index is None else index, text)
+    
+    def remove_post(self, post, index):
+        """
+        Take the post added at index and its comments back out of the counters
+
+        The scores then match a full re-score of the remaining posts; only
+        the order of some warnings can differ (e.g. a persona that drops out
+        and comes back counts as appearing last).
+        """
+        self.num_posts -= 1
+        
+        title = post['title'].lower()
+        body = post['body'].lower()
+        texts = [title, body]
+        
+        _discount(self.persona_counts, post['author_username'])
+        
+        for word in re.findall(r'\w+', title):
+            if self.title_word_counts[word] == 3:
+                self.repeated_title_words.pop(word, None)
+            _discount(self.title_word_counts, word)
+        keywords = post.get('keyword_ids', [])
+        for keyword in keywords:
+            _discount(self.keyword_counts, keyword)
+        self.num_keywords -= len(keywords)
+        
+        item_ids = [post['post_id']]
+        for comment in post['comments']:
+            texts.append(self._remove_comment(comment))
+            item_ids.append(comment['comment_id'])
+        
+        self._scan_naturalness(' '.join(texts), -1)
+        self._delete_edges(index)
+        
+        if self.near_duplicates is not None:
+            self._forget_duplicates(item_ids)
+    
+    def _add_comment(self, comment):
+        text = comment['comment_text'].lower()
+        words = text.split()
+        
+        delay = comment['delay_minutes']
+        self.persona_counts[comment['username']] += 1
+        self.delay_counts[delay] += 1
+        self.num_delays += 1
+        self.delay_total += delay
+        self.comment_length_counts[len(words)] += 1
+        
+        lexicon = self.lexicon
+        hits = lexicon.comment_matcher.find(text)
+        
+        self.num_comments += 1
+        self.promo_count += len(hits & lexicon.promo_words)
+        
+        first_15_words = ' '.join(words[:15])
+        openers = lexicon.opener_matcher.find(first_15_words)
+        for opener in sorted(openers, key=lexicon.opener_rank.get):
+            self.opener_counts[opener] = self.opener_counts.get(opener, 0) + 1
+        
+        if not hits.isdisjoint(lexicon.disclaimers):
+            self.not_perfect_count += 1
+        if '!' in text:
+            self.exclamation_count += 1
+        if not hits.isdisjoint(lexicon.company_names):
+            self.company_mentions += 1
+        
+        self.comment_word_counts.update(words)
+        self.comment_word_total += len(words)
+        
+        if self.near_duplicates is not None:
+            self._check_duplicate(comment['comment_id'], comment['comment_text'])
+        
+        return text
+    
+    def _remove_comment(self, comment):
+        text = comment['comment_text'].lower()
+        words = text.split()
+        delay = comment['delay_minutes']
+        
+        _discount(self.persona_counts, comment['username'])
+        _discount(self.delay_counts, delay)
+        self.num_delays -= 1
+        self.delay_total -= delay
+        _discount(self.comment_length_counts, len(words))
+        
+        lexicon = self.lexicon
+        hits = lexicon.comment_matcher.find(text)
+        
+        self.num_comments -= 1
+        self.promo_count -= len(hits & lexicon.promo_words)
+        
+        for opener in lexicon.opener_matcher.find(' '.join(words[:15])):
+            _discount(self.opener_counts, opener)
+        
+        if not hits.isdisjoint(lexicon.disclaimers):
+            self.not_perfect_count -= 1
+        if '!' in text:
+            self.exclamation_count -= 1
+        if not hits.isdisjoint(lexicon.company_names):
+            self.company_mentions -= 1
+        
+        for word in words:
+            _discount(self.comment_word_counts, word)
+        self.comment_word_total -= len(words)
+        
+        return text
+    
+    @property
+    def num_unique_delays(self):
+        return len(self.delay_counts)
+    
+    @property
+    def num_unique_lengths(self):
+        return len(self.comment_length_counts)
+    
+    def _scan_naturalness(self, text, sign):
+        """
+        Count (sign=1) or uncount (sign=-1) the naturalness phrases in one post's (or boundary's) text
+        """
+        self._count_naturalness(self.lexicon.natural_matcher.find(text), sign)
+    
+    def _count_naturalness(self, hits, sign):
+        if not hits:
+            return
+        for phrase in hits.intersection(self.lexicon.unnatural_phrases):
+            if sign > 0:
+                self.unnatural_counts[phrase] += 1
+            else:
+                _discount(self.unnatural_counts, phrase)
+        if not hits.isdisjoint(self.lexicon.formal_words):
+            self.formal_count += sign
+    
+    def _insert_edges(self, index, text):
+        tail_length = self.lexicon.tail_length
+        if not tail_length:
+            return
+        self._edges.insert(index, (text[:tail_length], text[-tail_length:]))
+        self._boundaries.insert(index, None)
+        self._rescan_boundaries(index)
+    
+    def _delete_edges(self, index):
+        if not self.lexicon.tail_length:
+            return
+        boundary = self._boundaries.pop(index)
+        if boundary is not None:
+            self._count_naturalness(boundary[1], -1)
+        del self._edges[index]
+        self._rescan_boundaries(index)
+    
+    def _rescan_boundaries(self, start):
+        """
+        Rescan the boundaries from start on after the posts there changed
+
+        A boundary's window is the last tail_length characters of everything
+        before it plus the first tail_length of the post after it. Past
+        start, the scan stops at the first boundary whose preceding
+        characters are unchanged (only posts shorter than a phrase carry a
+        change further).
+        """
+        tail_length = self.lexicon.tail_length
+        edges = self._edges
+        boundaries = self._boundaries
+        if start == 0 and boundaries and boundaries[0] is not None:
+            # The new first post has nothing before it
+            self._count_naturalness(boundaries[0][1], -1)
+            boundaries[0] = None
+        for position in range(max(start, 1), len(edges)):
+            before = boundaries[position - 1]
+            last = edges[position - 1][1]
+            preceding = last if before is None else (before[0] + ' ' + last)[-tail_length:]
+            old = boundaries[position]
+            if position > start and old is not None and old[0] == preceding:
+                break
+            if old is not None:
+                self._count_naturalness(old[1], -1)
+            hits = self.lexicon.natural_matcher.find(preceding + ' ' + edges[position][0])
+            self._count_naturalness(hits, 1)
+            boundaries[position] = (preceding, hits)
+    
+    def _check_duplicate(self, item_id, text):
+        sig = signature(text)
+        if sig is None:
+            return
+        match = self._best_match(sig)
+        if match:
+            self.duplicates.append((item_id, *match))
+        self._own_texts.add(item_id, sig)
+    
+    def _best_match(self, sig):
+        matches = [m for m in (self.near_duplicates.query(sig), self._own_texts.query(sig)) if m]
+        return max(matches, key=lambda m: m[1]) if matches else None
+    
+    def _forget_duplicates(self, item_ids):
+        """
+        Drop removed items from the duplicate checks
+        """
+        removed = set(item_ids)
+        for item_id in item_ids:
+            self._own_texts.remove(item_id)
+        
+        duplicates = []
+        for item_id, label, similarity in self.duplicates:
+            if item_id in removed:
+                continue
+            if label in removed:
+                # What it copied is gone: check it against everything else
+                sig = self._own_texts.remove(item_id)
+                match = self._best_match(sig)
+                self._own_texts.add(item_id, sig)
+                if match is None:
+                    continue
+                label, similarity = match
+            duplicates.append((item_id, label, similarity))
+        self.duplicates = duplicates
+
+def _discount(counter, key):
+    """
+    Decrement a count, dropping the key when it reaches zero
+    """
+    count = counter[key] - 1
+    if count:
+        counter[key] = count
+    else:
+        del counter[key]
 
 class QualityScorer:
     """
@@ -12,39 +408,68 @@ class QualityScorer:
             'persona_variety': 0.15,
             'timing_realism': 0.15,
             'content_diversity': 0.20,
-            'anti_spam_score': 0.20
+            'anti_spam_score': 0.20,
+            # Only scored when a near-duplicate index is given
+            'duplication': 0.10
         }
     
-    def score_calendar(self, posts, personas):
+    @traced('score_calendar')
+    def score_calendar(self, posts, personas, company_names=None, lexicons=None, near_duplicates=None):
         """
         Score the entire calendar and return metrics
+        
+        company_names are the names counted as company mentions; lexicons
+        optionally overrides the phrase lists (see DEFAULT_LEXICONS). Passing
+        a near_duplicates index (even an empty one) adds the duplication score.
+        """
+        features = self.extract_features(posts, get_lexicon(lexicons, company_names or ()), near_duplicates)
+        return self.score_features(features, personas)
+    
+    def extract_features(self, posts, lexicon=None, near_duplicates=None):
+        """
+        Walk every post and comment once and collect the counters all checks use
+        """
+        features = CalendarFeatures(lexicon, near_duplicates)
+        for post in posts:
+            features.add_post(post)
+        return features
+    
+    def score_features(self, features, personas):
+        """
+        Turn extracted features into scores, warnings and the weighted overall score
         """
         scores = {}
         all_warnings = []
         
         # Calculate individual scores
-        naturalness, nat_warnings = self._check_naturalness(posts)
+        naturalness, nat_warnings = self._check_naturalness(features)
         scores['naturalness'] = naturalness
         all_warnings.extend(nat_warnings)
         
-        persona_variety, pers_warnings = self._check_persona_variety(posts, personas)
+        persona_variety, pers_warnings = self._check_persona_variety(features, personas)
         scores['persona_variety'] = persona_variety
         all_warnings.extend(pers_warnings)
         
-        timing_realism, time_warnings = self._check_timing_realism(posts)
+        timing_realism, time_warnings = self._check_timing_realism(features)
         scores['timing_realism'] = timing_realism
         all_warnings.extend(time_warnings)
         
-        content_diversity, cont_warnings = self._check_content_diversity(posts)
+        content_diversity, cont_warnings = self._check_content_diversity(features)
         scores['content_diversity'] = content_diversity
         all_warnings.extend(cont_warnings)
         
-        anti_spam, spam_warnings = self._check_anti_spam(posts)
+        anti_spam, spam_warnings = self._check_anti_spam(features)
         scores['anti_spam_score'] = anti_spam
         all_warnings.extend(spam_warnings)
         
-        # Calculate weighted overall score
+        if features.near_duplicates is not None:
+            duplication, dup_warnings = self._check_duplication(features)
+            scores['duplication'] = duplication
+            all_warnings.extend(dup_warnings)
+        
+        # Calculate weighted overall score (over the dimensions scored)
         overall = sum(scores[key] * self.weights[key] for key in scores)
+        overall /= sum(self.weights[key] for key in scores)
         
         return {
             **scores,
@@ -52,7 +477,7 @@ class QualityScorer:
             'warnings': all_warnings
         }
     
-    def _check_naturalness(self, posts):
+    def _check_naturalness(self, features):
         """
         Check if posts and comments sound natural
         """
@@ -60,45 +485,26 @@ class QualityScorer:
         issues = []
         
         # Check for unnatural phrases
-        unnatural_phrases = [
-            'as an ai', 'i am a bot', 'click here', 'buy now',
-            'limited time', 'act now', 'special offer'
-        ]
-        
-        all_text = []
-        for post in posts:
-            all_text.append(post['title'].lower())
-            all_text.append(post['body'].lower())
-            for comment in post['comments']:
-                all_text.append(comment['comment_text'].lower())
-        
-        combined_text = ' '.join(all_text)
-        
-        for phrase in unnatural_phrases:
-            if phrase in combined_text:
+        for phrase in features.lexicon.unnatural_phrases:
+            if phrase in features.unnatural_counts:
                 score -= 2
                 issues.append(f"Unnatural phrase detected: '{phrase}'")
         
         # Check for overly formal language
-        if any(word in combined_text for word in ['furthermore', 'moreover', 'nevertheless', 'henceforth']):
+        if features.formal_count:
             score -= 1
             issues.append("Language too formal for Reddit")
         
         return max(0, score), issues
     
-    def _check_persona_variety(self, posts, personas):
+    def _check_persona_variety(self, features, personas):
         """
         Check if personas are used with good variety
         """
         score = 10
         issues = []
         
-        # Count persona usage
-        persona_counts = Counter()
-        for post in posts:
-            persona_counts[post['author_username']] += 1
-            for comment in post['comments']:
-                persona_counts[comment['username']] += 1
+        persona_counts = features.persona_counts
         
         # Check for overused personas
         total_interactions = sum(persona_counts.values())
@@ -110,162 +516,168 @@ class QualityScorer:
         
         # Check if all personas are used
         persona_usernames = [p['username'] for p in personas]
-        unused = set(persona_usernames) - set(persona_counts.keys())
+        # In persona order, so the warning is the same in every process (set order depends on the hash seed)
+        unused = [username for username in dict.fromkeys(persona_usernames) if username not in persona_counts]
         if unused:
             score -= 1
             issues.append(f"Personas not used: {', '.join(unused)}")
         
         return max(0, score), issues
     
-    def _check_timing_realism(self, posts):
+    def _check_timing_realism(self, features):
         """
         Check if timing patterns look realistic
         """
         score = 10
         issues = []
         
-        all_delays = []
-        for post in posts:
-            for comment in post['comments']:
-                all_delays.append(comment['delay_minutes'])
-        
-        if not all_delays:
+        num_delays = features.num_delays
+        if not num_delays:
             return score, issues
         
+        unique_delays = features.num_unique_delays
+        
         # Check for suspiciously regular timing
-        if len(set(all_delays)) < len(all_delays) * 0.7:  # Less than 70% unique
+        if unique_delays < num_delays * 0.7:  # Less than 70% unique
             score -= 2
             issues.append("Timing patterns too regular")
         
         # Check for unrealistic patterns (all same delay)
-        if len(set(all_delays)) == 1:
+        if unique_delays == 1:
             score -= 3
             issues.append("All comments have identical delay times")
         
         # Check for reasonable delay ranges
-        if all_delays:
-            avg_delay = sum(all_delays) / len(all_delays)
-            if avg_delay < 10:  # Too fast
-                score -= 1
-                issues.append("Comments posted too quickly on average")
-            if avg_delay > 200:  # Too slow
-                score -= 1
-                issues.append("Comments posted too slowly on average")
+        avg_delay = features.delay_total / num_delays
+        if avg_delay < 10:  # Too fast
+            score -= 1
+            issues.append("Comments posted too quickly on average")
+        if avg_delay > 200:  # Too slow
+            score -= 1
+            issues.append("Comments posted too slowly on average")
         
         return max(0, score), issues
     
-    def _check_content_diversity(self, posts):
+    def _check_content_diversity(self, features):
         """
         Check if content is diverse and not repetitive
         """
         score = 10
         issues = []
         
-        # Check title diversity
-        titles = [post['title'].lower() for post in posts]
-        title_words = []
-        for title in titles:
-            title_words.extend(re.findall(r'\w+', title))
-        
-        # Check for repeated words in titles
-        word_counts = Counter(title_words)
-        common_words = {'the', 'a', 'an', 'for', 'to', 'in', 'on', 'of', 'and', 'or', 'how', 'what', 'best'}
-        
-        for word, count in word_counts.items():
-            if word not in common_words and count > 2:
-                score -= 0.5
-                issues.append(f"Repeated words in titles: {word}")
+        # Check for repeated words in titles (in order of first use)
+        repeated = features.repeated_title_words
+        for word in sorted(repeated, key=repeated.get):
+            score -= 0.5
+            issues.append(f"Repeated words in titles: {word}")
         
         # Check keyword diversity across posts
-        all_keywords = []
-        for post in posts:
-            all_keywords.extend(post.get('keyword_ids', []))
-        
-        if len(set(all_keywords)) < len(all_keywords) * 0.8:  # Less than 80% unique
+        if len(features.keyword_counts) < features.num_keywords * 0.8:  # Less than 80% unique
             score -= 1
             issues.append("Low keyword diversity across posts")
         
         return max(0, score), issues
     
-    def _check_anti_spam(self, posts):
+    def _check_anti_spam(self, features):
         """
         Check for spam indicators and repetitive patterns
         """
         score = 10
         issues = []
         
-        # Collect all comment text
-        all_comments = []
-        for post in posts:
-            for comment in post['comments']:
-                all_comments.append(comment['comment_text'].lower())
-        
-        if not all_comments:
+        num_comments = features.num_comments
+        if not num_comments:
             return score, issues
         
         # Check for promotional words
-        promo_words = ['revolutionary', 'game-changer', 'best ever', 'must-have', 
-                       'life-changing', 'perfect solution', 'amazing tool',
-                       'check out', 'click here', 'sign up']
-        promo_count = sum(1 for comment in all_comments 
-                         for word in promo_words if word in comment)
-        
+        promo_count = features.promo_count
         if promo_count > 2:
             score -= 2
             issues.append(f"Promotional language detected ({promo_count} instances)")
         
-        # Check for repetitive opening phrases
-        repetitive_openers = ['totally', 'i feel you', 'i totally', 'totally feel',
-                             'totally get', 'i get that', "i've been using", 
-                             "i've tried", "i've been trying"]
-        
-        opener_counts = {}
-        for comment in all_comments:
-            first_15_words = ' '.join(comment.split()[:15])
-            for opener in repetitive_openers:
-                if opener in first_15_words:
-                    opener_counts[opener] = opener_counts.get(opener, 0) + 1
-        
         # Flag if any opener used more than twice
-        for opener, count in opener_counts.items():
+        for opener, count in features.opener_counts.items():
             if count > 2:
                 score -= 1.5
                 issues.append(f"Repetitive opener '{opener}' used {count} times")
         
         # Check for "not perfect" overuse
-        not_perfect_count = sum(1 for c in all_comments if 'not perfect' in c or "isn't perfect" in c)
-        if not_perfect_count > len(all_comments) * 0.4:  # More than 40%
+        not_perfect_count = features.not_perfect_count
+        if not_perfect_count > num_comments * 0.4:  # More than 40%
             score -= 1
             issues.append(f"Disclaimer phrase 'not perfect' overused ({not_perfect_count} times)")
         
         # Check for exclamation mark spam
-        exclamation_count = sum(1 for c in all_comments if c.count('!') > 0)
-        if exclamation_count > len(all_comments) * 0.7:  # More than 70%
+        exclamation_count = features.exclamation_count
+        if exclamation_count > num_comments * 0.7:  # More than 70%
             score -= 0.5
-            issues.append(f"Exclamation marks overused ({exclamation_count}/{len(all_comments)} comments)")
+            issues.append(f"Exclamation marks overused ({exclamation_count}/{num_comments} comments)")
         
         # Check for company mention frequency
-        company_mentions = sum(1 for comment in all_comments 
-                              if any(word in comment for word in ['slideforge', 'itinitrip', 'codesnap', 'thumbnailai', 'fitflow', 'outreachiq']))
-        
-        if company_mentions > len(posts) * 2:  # More than 2 mentions per post
+        company_mentions = features.company_mentions
+        if company_mentions > features.num_posts * 2:  # More than 2 mentions per post
             score -= 1
             issues.append(f"Company mentioned too frequently ({company_mentions} times)")
         
         # Check for similar comment lengths (lack of variety)
-        comment_lengths = [len(c.split()) for c in all_comments]
-        if len(comment_lengths) > 3:  # Only check if we have enough comments
-            unique_lengths = len(set(comment_lengths))
-            if unique_lengths < len(comment_lengths) * 0.5:  # Less than 50% unique lengths
+        if num_comments > 3:  # Only check if we have enough comments
+            unique_lengths = features.num_unique_lengths
+            if unique_lengths < num_comments * 0.5:  # Less than 50% unique lengths
                 score -= 0.5
                 issues.append("Comment lengths too similar (lack of variety)")
         
         # Check for word diversity
-        all_words = ' '.join(all_comments).split()
-        unique_ratio = len(set(all_words)) / len(all_words) if all_words else 1
+        total_words = features.comment_word_total
+        unique_ratio = len(features.comment_word_counts) / total_words if total_words else 1
         
         if unique_ratio < 0.5:  # Less than 50% unique words
             score -= 1
             issues.append(f"Low word diversity (unique ratio: {unique_ratio:.2f})")
         
-        return max(0, score), issues
\ No newline at end of file
+        return max(0, score), issues
+    
+    def _check_duplication(self, features):
+        """
+        Check for posts and comments that nearly copy earlier content
+        """
+        score = 10
+        issues = []
+        
+        for item_id, label, similarity in features.duplicates:
+            score -= 2
+            issues.append(f"{item_id} is a near-duplicate of {label} ({similarity:.0%} similar)")
+        
+        return max(0, score), issues
+
+class IncrementalQualityScorer:
+    """
+    Scores a calendar while its posts are still being produced
+    
+    add_post folds a post into running aggregates; metrics() returns the same
+    result score_calendar would give for the posts added so far, without
+    rescanning them. One instance can be kept across weeks to score a whole
+    campaign.
+    """
+    
+    def __init__(self, personas, scorer=None, company_names=None, lexicons=None, near_duplicates=None):
+        self.personas = personas
+        self.scorer = scorer or QualityScorer()
+        self.features = CalendarFeatures(get_lexicon(lexicons, company_names or ()), near_duplicates)
+    
+    @property
+    def num_posts(self):
+        return self.features.num_posts
+    
+    @traced('live_score_add')
+    def add_post(self, post):
+        """
+        Add one finished post (with its comments)
+        """
+        self.features.add_post(post)
+    
+    @traced('live_score')
+    def metrics(self):
+        """
+        Current quality metrics for every post added so far
+        """
+        return self.scorer.score_features(self.features, self.personas)
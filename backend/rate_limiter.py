@@ -0,0 +1,149 @@
+import os
+import random
+import threading
+import time
+from functools import lru_cache
+
+class TokenBucket:
+    """
+    Token bucket refilled at `per_minute` units a minute, holding at most one minute's worth
+
+    take() reserves units right away and returns how long the caller must
+    wait before using them, so concurrent callers queue up in order instead
+    of racing for the next refill.
+    """
+    
+    def __init__(self, per_minute, clock=time.monotonic):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.clock = clock
+        self.level = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+    
+    def take(self, amount):
+        """
+        Reserve amount units; returns seconds to wait (0 if available now)
+        """
+        with self._lock:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+            return -self.level / self.rate if self.level < 0 else 0.0
+    
+    def give_back(self, amount):
+        """
+        Return units reserved but not used (or take more when amount is negative)
+        """
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+    
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+class RateLimiter:
+    """
+    Client-side limit on requests/minute, tokens/minute and requests in flight
+
+    The in-flight limit adapts (AIMD): it halves whenever the API throttles
+    us and grows back by about one slot per limit's worth of successful
+    calls, so we settle just under the rate the API will actually accept.
+    A Retry-After from the API pauses every caller, not just the one that
+    got it.
+    """
+    
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200000, max_concurrency=32,
+                 min_concurrency=1, base_delay=0.5, max_delay=30.0, clock=time.monotonic,
+                 sleep=time.sleep, seed=None):
+        self.requests = TokenBucket(requests_per_minute, clock)
+        self.tokens = TokenBucket(tokens_per_minute, clock)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self._paused_until = 0.0
+        self._rng = random.Random(seed)
+        self._slots = threading.Condition()
+    
+    def acquire(self, estimated_tokens):
+        """
+        Block until a request of about estimated_tokens may be sent
+        """
+        # Step 1: wait out any Retry-After pause
+        wait = self._paused_until - self.clock()
+        if wait > 0:
+            self.sleep(wait)
+        
+        # Step 2: take an in-flight slot
+        with self._slots:
+            while self.in_flight >= int(self.concurrency):
+                self._slots.wait()
+            self.in_flight += 1
+        
+        # Step 3: reserve request and token budget, waiting for whichever refills last
+        wait = max(self.requests.take(1), self.tokens.take(estimated_tokens))
+        if wait > 0:
+            self.sleep(wait)
+    
+    def release(self, throttled=False):
+        """
+        Free the slot taken by acquire(), adapting concurrency to the outcome
+        """
+        with self._slots:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._slots.notify_all()
+    
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """
+        Correct the token bucket once a response reports its real usage
+        """
+        self.tokens.give_back(estimated_tokens - actual_tokens)
+    
+    def backoff(self, attempt, retry_after=None):
+        """
+        Sleep before retry number `attempt` (0-based)
+
+        Exponential backoff with full jitter, but never shorter than the
+        server's Retry-After, which also pauses every other caller.
+        """
+        delay = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after:
+            self._paused_until = max(self._paused_until, self.clock() + retry_after)
+            delay = max(delay, retry_after)
+        self.sleep(delay)
+        return delay
+    
+    def stats(self):
+        return {
+            "concurrency": int(self.concurrency),
+            "in_flight": self.in_flight,
+            "throttled": self.throttled
+        }
+
+@lru_cache(maxsize=None)
+def shared_rate_limiter():
+    """
+    The process-wide limiter (OPENAI_RPM / OPENAI_TPM / OPENAI_MAX_CONCURRENCY)
+
+    Every generator in the process shares it, since they share one API quota.
+    When OPENAI_RATE_SHARES processes share the quota (gunicorn.conf.py sets
+    it to the number of web workers), each gets that fraction of the limits.
+    """
+    shares = max(1, int(os.getenv('OPENAI_RATE_SHARES', 1)))
+    return RateLimiter(
+        requests_per_minute=max(1, int(os.getenv('OPENAI_RPM', 500)) // shares),
+        tokens_per_minute=max(1, int(os.getenv('OPENAI_TPM', 200000)) // shares),
+        max_concurrency=max(1, int(os.getenv('OPENAI_MAX_CONCURRENCY', 32)) // shares)
+    )
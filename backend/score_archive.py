@@ -0,0 +1,272 @@
+"""
+Score archived calendars offline with a process pool
+
+Usage:
+    python score_archive.py exports/                   # every .json/.jsonl file under exports/
+    python score_archive.py calendars.jsonl -o scores.jsonl --workers 8
+    cat calendars.jsonl | python score_archive.py - --personas personas.json
+
+Inputs are JSON-lines files (one record per line), JSON files holding one
+record or an array of records, or stdin as JSON lines. A record is a calendar
+({"posts": [...], ...}) or a campaign result ({"weeks": [calendar, ...]});
+"personas", "company_info" and "lexicons" next to the posts/weeks are used
+when present. Arrays are parsed one element at a time, and only a bounded
+number of chunks is in flight, so memory stays flat however large the archive.
+
+Writes one JSON line per calendar, in input order:
+    {"source", "week", "quality_score", "metrics"}   (metrics include warnings)
+or {"source", "error"} for a record that could not be scored.
+"""
+
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from content_generator import extract_company_name
+from quality_scorer import QualityScorer
+
+# Calendars sent to a worker at a time
+CHUNK_SIZE = 64
+
+READ_SIZE = 1 << 16
+
+def iter_json_values(f, read_size=READ_SIZE):
+    """
+    Yield the elements of a top-level JSON array one at a time (or the single top-level value)
+
+    Only the element being decoded is held in memory, plus one read buffer.
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(read_size)
+    pos = _skip_whitespace(buffer, 0)
+    
+    if not buffer[pos:pos + 1] == '[':
+        rest = buffer[pos:] + f.read()
+        if rest.strip():
+            yield json.loads(rest)
+        return
+    
+    pos += 1
+    eof = False
+    while True:
+        # Separators: whitespace, commas and the closing bracket
+        while True:
+            pos = _skip_whitespace(buffer, pos)
+            if pos < len(buffer) and buffer[pos] == ',':
+                pos += 1
+                continue
+            if pos < len(buffer) or eof:
+                break
+            buffer, pos = buffer[pos:] + f.read(read_size), 0
+            eof = pos == len(buffer)
+        if pos >= len(buffer):
+            raise ValueError("Unterminated JSON array")
+        if buffer[pos] == ']':
+            return
+        
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The element continues past the buffer: read more (doubling, so a
+            # huge element is not re-decoded once per small read)
+            more = f.read(max(read_size, len(buffer) - pos))
+            buffer, pos = buffer[pos:] + more, 0
+            eof = not more
+            continue
+        
+        # A number cut off by the buffer end decodes "successfully": make sure it ended
+        if end == len(buffer) and not eof:
+            more = f.read(read_size)
+            if more:
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            eof = True
+        
+        yield value
+        buffer, pos = buffer[end:], 0
+
+def _skip_whitespace(text, pos):
+    while pos < len(text) and text[pos] in ' \t\r\n':
+        pos += 1
+    return pos
+
+def iter_records(path):
+    """
+    Yield (source, record) for every record in a file, directory ('.json'/'.jsonl' files) or '-' (stdin)
+    """
+    if path == '-':
+        yield from _iter_lines('<stdin>', sys.stdin)
+        return
+    
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(('.json', '.jsonl')):
+                    yield from iter_records(os.path.join(root, name))
+        return
+    
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            yield from _iter_lines(path, f)
+        else:
+            for index, record in enumerate(iter_json_values(f)):
+                yield f"{path}[{index}]", record
+
+def _iter_lines(name, f):
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        source = f"{name}:{number}"
+        try:
+            yield source, json.loads(line)
+        except ValueError as e:
+            # Reported in the output instead of stopping the whole run
+            yield source, ValueError(f"Invalid JSON: {e}")
+
+def iter_calendars(records, personas=None, company_names=None):
+    """
+    Expand records into scoring jobs, one per calendar
+
+    A job is {"source", "week", "posts", "personas", "company_names", "lexicons"},
+    or {"source", "error"} for a record that can't be scored.
+    """
+    for source, record in records:
+        if isinstance(record, Exception):
+            yield {"source": source, "error": str(record)}
+            continue
+        if not isinstance(record, dict):
+            yield {"source": source, "error": "Not a calendar object"}
+            continue
+        
+        if 'weeks' in record and 'posts' not in record:
+            calendars = [(f"{source}#week{c.get('week', i + 1)}", c) for i, c in enumerate(record['weeks'])]
+        else:
+            calendars = [(source, record)]
+        
+        for calendar_source, calendar in calendars:
+            posts = calendar.get('posts')
+            if not isinstance(posts, list):
+                yield {"source": calendar_source, "error": "Missing posts"}
+                continue
+            
+            calendar_personas = personas or calendar.get('personas') or record.get('personas')
+            if not calendar_personas:
+                # Without a persona list only the personas actually used are known
+                usernames = {}
+                for post in posts:
+                    usernames[post.get('author_username')] = True
+                    for comment in post.get('comments', []):
+                        usernames[comment.get('username')] = True
+                calendar_personas = [{"username": name} for name in usernames if name]
+            
+            names = company_names
+            company_info = calendar.get('company_info') or record.get('company_info')
+            if not names and company_info:
+                names = [extract_company_name(company_info)]
+            
+            yield {
+                "source": calendar_source,
+                "week": calendar.get('week'),
+                "posts": posts,
+                "personas": calendar_personas,
+                "company_names": list(names or ()),
+                "lexicons": calendar.get('lexicons') or record.get('lexicons')
+            }
+
+def score_chunk(jobs):
+    """
+    Score a chunk of jobs (in a worker process); returns one output line dict per job
+    """
+    scorer = QualityScorer()
+    results = []
+    for job in jobs:
+        if 'error' in job:
+            results.append(job)
+            continue
+        try:
+            metrics = scorer.score_calendar(job['posts'], job['personas'], job['company_names'], job['lexicons'])
+        except Exception as e:
+            results.append({"source": job['source'], "error": f"{type(e).__name__}: {e}"})
+            continue
+        results.append({"source": job['source'], "week": job['week'],
+                        "quality_score": metrics['overall_score'], "metrics": metrics})
+    return results
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def score_archive(paths, output, workers=None, personas=None, company_names=None, chunk_size=CHUNK_SIZE):
+    """
+    Score every calendar under paths, writing JSON lines to output; returns (scored, errors)
+    """
+    records = (record for path in paths for record in iter_records(path))
+    chunks = _chunks(iter_calendars(records, personas, company_names), chunk_size)
+    scored = errors = 0
+    
+    def write(results):
+        nonlocal scored, errors
+        for result in results:
+            output.write(json.dumps(result, ensure_ascii=False) + '\n')
+            if 'error' in result:
+                errors += 1
+            else:
+                scored += 1
+    
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for chunk in chunks:
+            write(score_chunk(chunk))
+        return scored, errors
+    
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # A bounded window of chunks in flight keeps memory flat and output in order
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(score_chunk, chunk))
+            if len(pending) >= workers * 2:
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
+    return scored, errors
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help="calendar files or directories ('-' for JSON lines on stdin)")
+    parser.add_argument('-o', '--output', default='-', help="JSONL output file ('-' for stdout)")
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--personas', help='JSON file with the persona list to score every calendar against')
+    parser.add_argument('--company-name', action='append', dest='company_names',
+                        help='company name counted as a mention (repeatable)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='calendars per worker task')
+    args = parser.parse_args(argv)
+    
+    personas = None
+    if args.personas:
+        with open(args.personas, encoding='utf-8') as f:
+            personas = json.load(f)
+    
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        scored, errors = score_archive(args.paths, output, args.workers, personas, args.company_names,
+                                       args.chunk_size)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    
+    print(f"📊 Scored {scored} calendars ({errors} errors)", file=sys.stderr)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
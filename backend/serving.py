@@ -0,0 +1,52 @@
+import threading
+from contextlib import contextmanager
+
+class Drain:
+    """
+    Counts in-flight generations so a stopping web worker can let them finish
+    
+    Once start() is called the worker is draining: new generations should be
+    turned away (another worker takes them) and wait() blocks until the
+    running ones are done.
+    """
+    
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.active = 0
+        self.draining = False
+    
+    def enter(self):
+        with self._cond:
+            self.active += 1
+    
+    def exit(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+    
+    @contextmanager
+    def track(self):
+        """
+        Count the enclosed block as an in-flight generation
+        """
+        self.enter()
+        try:
+            yield
+        finally:
+            self.exit()
+    
+    def start(self):
+        """
+        Begin draining (safe to call from a signal handler: it only sets a flag)
+        """
+        self.draining = True
+    
+    def wait(self, timeout=None):
+        """
+        Block until no generation is in flight; returns False on timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.active == 0, timeout)
+    
+    def stats(self):
+        return {"in_flight": self.active, "draining": self.draining}
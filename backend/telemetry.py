@@ -0,0 +1,353 @@
+import contextvars
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_timings = contextvars.ContextVar('stage_timings', default=None)
+
+class Counter:
+    """
+    Monotonic counter with optional labels
+    """
+    
+    kind = 'counter'
+    
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def value(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+    
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in sorted(self.values.items())]
+    
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+    
+    def load(self, snapshot):
+        """
+        Add another process's snapshot() to this counter
+        """
+        for labels, value in snapshot:
+            self.inc(value, **dict(labels))
+
+class Histogram:
+    """
+    Latency histogram with optional labels (cumulative buckets, like Prometheus)
+    """
+    
+    kind = 'histogram'
+    
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+    
+    def count(self, **labels):
+        series = self.series.get(tuple(sorted(labels.items())))
+        return series['count'] if series else 0
+    
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series['buckets']):
+                    samples.append((self.name + '_bucket', labels + (('le', _format_value(bound)),), count))
+                samples.append((self.name + '_bucket', labels + (('le', '+Inf'),), series['count']))
+                samples.append((self.name + '_sum', labels, series['sum']))
+                samples.append((self.name + '_count', labels, series['count']))
+        return samples
+    
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), dict(series, buckets=list(series['buckets']))]
+                    for labels, series in self.series.items()]
+    
+    def load(self, snapshot):
+        """
+        Add another process's snapshot() to this histogram (series with other buckets are skipped)
+        """
+        with self._lock:
+            for labels, other in snapshot:
+                if len(other['buckets']) != len(self.buckets):
+                    continue
+                key = tuple(sorted(tuple(pair) for pair in labels))
+                series = self.series.get(key)
+                if series is None:
+                    series = self.series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                series['buckets'] = [a + b for a, b in zip(series['buckets'], other['buckets'])]
+                series['sum'] += other['sum']
+                series['count'] += other['count']
+
+class Registry:
+    """
+    The process's metrics, rendered in the Prometheus text format
+    """
+    
+    def __init__(self):
+        self.metrics = []
+    
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+    
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+    
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+    
+    def snapshot(self):
+        """
+        Every metric's values as JSON-friendly data: {name: series}
+        """
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+    
+    def merged(self, snapshots):
+        """
+        A registry with the same metrics holding the sum of snapshots (e.g. one per process)
+        """
+        total = Registry()
+        for metric in self.metrics:
+            if metric.kind == 'histogram':
+                copy = total.histogram(metric.name, metric.help_text, metric.buckets)
+            else:
+                copy = total.counter(metric.name, metric.help_text)
+            for snapshot in snapshots:
+                copy.load(snapshot.get(metric.name, []))
+        return total
+    
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+class SharedMetrics:
+    """
+    Metrics summed over the processes of one server (e.g. gunicorn workers) through a directory
+    
+    Each process writes its registry's snapshot to <path>/<pid>.json, every
+    flush_seconds once start() is called and whenever it renders; render()
+    sums every process's file, so /api/metrics reports the whole server
+    whichever worker answers the scrape (the other workers' values are at
+    most flush_seconds old). Files of exited workers are kept, so counters
+    never go backwards while the server runs.
+    """
+    
+    def __init__(self, path, registry=None, flush_seconds=5.0):
+        self.path = path
+        self.registry = registry or REGISTRY
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        os.makedirs(path, exist_ok=True)
+    
+    def write(self):
+        """
+        Save this process's snapshot (written to a temp file and renamed, so readers never see half a file)
+        """
+        target = os.path.join(self.path, f"{os.getpid()}.json")
+        with self._lock:
+            with open(target + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self.registry.snapshot(), f)
+            os.replace(target + '.tmp', target)
+    
+    def start(self):
+        """
+        Write the snapshot every flush_seconds from a daemon thread (call in each worker, after the fork)
+        """
+        def flush():
+            while not self._stop.wait(self.flush_seconds):
+                self.write()
+        
+        self.write()
+        threading.Thread(target=flush, name='shared-metrics', daemon=True).start()
+    
+    def stop(self):
+        self._stop.set()
+        self.write()
+    
+    def render(self):
+        self.write()
+        snapshots = []
+        for path in sorted(glob.glob(os.path.join(self.path, '*.json'))):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # removed or replaced while listing
+        return self.registry.merged(snapshots).render()
+    
+    @staticmethod
+    def clear(path):
+        """
+        Remove the snapshots of an earlier server run
+        """
+        for stale in glob.glob(os.path.join(path, '*.json')):
+            os.remove(stale)
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'mastermind_stage_duration_seconds', 'Time spent in each pipeline stage'
+)
+STAGE_ERRORS = REGISTRY.counter(
+    'mastermind_stage_errors_total', 'Pipeline stages that raised an error'
+)
+STAGE_CANCELLED = REGISTRY.counter(
+    'mastermind_stage_cancelled_total', 'Pipeline stages stopped on purpose (e.g. a client disconnect)'
+)
+FALLBACKS = REGISTRY.counter(
+    'mastermind_fallbacks_total', 'Model replies replaced by a fallback because they could not be parsed'
+)
+STREAM_ABORTS = REGISTRY.counter(
+    'mastermind_stream_aborts_total', 'Streamed generations cut off for breaking a rule'
+)
+LLM_RETRIES = REGISTRY.counter(
+    'mastermind_llm_retries_total', 'LLM requests retried after a throttle or server error'
+)
+LLM_TOKENS = REGISTRY.counter(
+    'mastermind_llm_tokens_total', 'Tokens reported by LLM responses'
+)
+LLM_CACHE_HITS = REGISTRY.counter(
+    'mastermind_llm_cache_hits_total', 'LLM replies served from the local cache'
+)
+RESULT_REQUESTS = REGISTRY.counter(
+    'mastermind_result_requests_total', 'Generation requests by outcome: generated, cached or coalesced'
+)
+
+class Timings:
+    """
+    Per-request breakdown: calls and total seconds per stage
+
+    Stages overlap (LLM requests run inside post rendering, posts run in
+    parallel), so the seconds add up to more than wall_seconds.
+    """
+    
+    def __init__(self):
+        self.stages = {}
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+    
+    def add(self, stage, seconds):
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+    
+    def summary(self):
+        with self._lock:
+            stages = {
+                stage: {"calls": entry['calls'], "seconds": round(entry['seconds'], 4)}
+                for stage, entry in self.stages.items()
+            }
+        return {"wall_seconds": round(time.perf_counter() - self.started, 4), "stages": stages}
+
+@contextmanager
+def collect_timings():
+    """
+    Collect a Timings breakdown of every span inside the block
+
+    Like usage meters, it follows the context into thread pools when tasks
+    are submitted through contextvars.copy_context().run.
+    """
+    timings = Timings()
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+class Cancelled(Exception):
+    """
+    Base of exceptions that stop a stage on purpose rather than on failure
+
+    e.g. a client disconnecting from a stream, or a generation cut off for
+    breaking a rule. Spans count them as cancelled, not as errors.
+    """
+
+@contextmanager
+def span(stage, expected=()):
+    """
+    Time a stage into the latency histogram (and the current Timings)
+
+    Exceptions count as stage errors, except Cancelled ones, which count as
+    cancellations, and the `expected` ones, which count as neither.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except expected:
+        raise
+    except Cancelled:
+        STAGE_CANCELLED.inc(stage=stage)
+        raise
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add(stage, elapsed)
+
+def traced(stage):
+    """
+    Decorator form of span()
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
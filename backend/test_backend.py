@@ -2,9 +2,41 @@
 Test script to verify backend functionality
 """
 
+import io
+import json
 import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import mock
 from dotenv import load_dotenv
+from flask import Flask
 from algorithm import RedditCalendarGenerator
+from batch_generation import BatchCampaignGenerator
+import calendar_model
+from calendar_model import CalendarJSONProvider, Comment, Post, fast_dumps, json_default, packb
+from calendar_repair import repair_calendar
+from calendar_service import CalendarService, RequestError, StreamClosed
+from campaign_store import CampaignStore
+from coalescing import ResultCache, SingleFlight
+from content_generator import COMMENT_SYSTEM_PROMPT, POST_SYSTEM_PROMPT, THREAD_SYSTEM_PROMPT, ContentGenerator, GenerationAborted
+from job_queue import JobQueue
+from json_stream import JSONFieldStream
+from llm_cache import LLMCache
+from llm_usage import UsageMeter, metered
+from near_duplicates import NearDuplicateIndex, signature
+from llm_transport import LocalBatchTransport, OpenAITransport, SyntheticTransport, RecordingTransport, ReplayTransport, RateLimitedTransport, TransportError
+from phrase_matcher import PhraseMatcher
+from quality_scorer import CalendarFeatures, QualityScorer
+from rate_limiter import RateLimiter, shared_rate_limiter
+from score_archive import iter_json_values, score_archive
+from serving import Drain
+from telemetry import FALLBACKS, REGISTRY, STAGE_CANCELLED, STAGE_ERRORS, STAGE_SECONDS, Registry, SharedMetrics, span
+from worker import process_next
 
 load_dotenv()
 
@@ -69,7 +101,7 @@ def test_calendar_generation():
         
         print("\n📋 Quality Metrics:")
         for metric, score in calendar['metrics'].items():
-            if metric != 'warnings' and metric != 'overall_score':
+            if metric not in ('warnings', 'overall_score', 'usage', 'regeneration'):
                 print(f"  • {metric}: {score}/10")
         
         if calendar['metrics']['warnings']:
@@ -86,11 +118,985 @@ def test_calendar_generation():
             print(f"   Comments: {len(post['comments'])}")
         
         print("\n✅ TEST PASSED!")
-        
+    
     except Exception as e:
         print(f"\n❌ ERROR: {str(e)}")
         import traceback
         traceback.print_exc()
 
+def _offline_calendar(transport, seed=7, week_number=1, **options):
+    """Generate the sample calendar without network access"""
+    generator = RedditCalendarGenerator(api_key=None, transport=transport, **options)
+    return generator.generate_calendar(
+        company_info=SAMPLE_DATA['company_info'],
+        personas=SAMPLE_DATA['personas'],
+        subreddits=SAMPLE_DATA['subreddits'],
+        keywords=SAMPLE_DATA['keywords'],
+        posts_per_week=SAMPLE_DATA['posts_per_week'],
+        week_number=week_number,
+        seed=seed
+    )
+
+def _without_timestamps(calendar):
+    """Timestamps depend on the current time, everything else on the seed"""
+    posts = []
+    for post in calendar['posts']:
+        post = {k: v for k, v in post.items() if k != 'timestamp'}
+        post['comments'] = [{k: v for k, v in c.items() if k != 'timestamp'} for c in post['comments']]
+        posts.append(post)
+    return posts
+
+def test_offline_calendar_generation():
+    """Generate a calendar against the synthetic backend"""
+    calendar = _offline_calendar(SyntheticTransport(seed=1))
+    
+    assert [post['post_id'] for post in calendar['posts']] == ['P11', 'P12', 'P13']
+    for post in calendar['posts']:
+        assert post['title'] and post['body']
+        assert len(post['comments']) == 2  # 3 personas: author + 2 commenters
+        assert post['comments'][0]['parent_comment_id'] is None
+    assert 0 <= calendar['quality_score'] <= 10
+
+def test_concurrent_matches_serial():
+    """Parallel generation returns the same calendar as serial generation"""
+    serial = _offline_calendar(SyntheticTransport(seed=1), max_concurrency=1)
+    parallel = _offline_calendar(SyntheticTransport(seed=1), max_concurrency=4)
+    
+    assert _without_timestamps(serial) == _without_timestamps(parallel)
+
+class _InFlightTransport:
+    """Counts the calls running at once (peak in .peak)"""
+    
+    def __init__(self, inner):
+        self.inner = inner
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+    
+    def complete(self, model, messages, temperature, **params):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            return self.inner.complete(model, messages, temperature, **params)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+def test_concurrency_budget_covers_comments():
+    """Posts and their comment threads share max_concurrency calls in flight"""
+    for limit in (2, 3):
+        transport = _InFlightTransport(SyntheticTransport(seed=1, latency=0.02))
+        calendar = _offline_calendar(transport, max_concurrency=limit)
+        assert len(calendar['posts']) == 3
+        assert transport.peak <= limit
+
+def test_comment_waves_share_budget():
+    """Every wave of a comment thread draws on the budget it is given"""
+    personas = [{"username": f"user{i}", "info": "Regular redditor"} for i in range(8)]
+    threads = []
+    for max_concurrency, limit in ((1, 1), (4, 2)):
+        transport = _InFlightTransport(SyntheticTransport(seed=1, latency=0.01))
+        generator = RedditCalendarGenerator(api_key=None, transport=transport)
+        plan = generator._plan_comment_thread(personas, datetime(2025, 1, 6, 9), 1, 1, rng=random.Random(3))
+        assert len(generator._comment_waves(plan)) > 1
+        comments = generator._generate_comment_thread("P11", "Any deck tips?", plan, SAMPLE_DATA['company_info'],
+                                                      max_concurrency=max_concurrency,
+                                                      budget=threading.BoundedSemaphore(limit))
+        assert transport.peak == limit
+        threads.append([comment.as_dict() for comment in comments])
+    
+    assert threads[0] == threads[1]
+
+class _KeyLog:
+    """Cache that stores nothing and logs the keys looked up"""
+    
+    def __init__(self):
+        self.keys = []
+    
+    def get(self, key):
+        self.keys.append(key)
+        return None
+    
+    def set(self, key, value):
+        pass
+
+def test_seeded_cache_keys():
+    """A seeded run looks up the same cache keys, serial or parallel; an unseeded one skips the cache"""
+    runs = []
+    for seed, max_concurrency in ((5, 1), (5, 4), (6, 4), (None, 4)):
+        cache = _KeyLog()
+        _offline_calendar(SyntheticTransport(seed=1), seed=seed, cache=cache, max_concurrency=max_concurrency)
+        runs.append(sorted(cache.keys))
+    
+    assert runs[0] == runs[1]
+    assert runs[0] != runs[2]
+    assert runs[3] == []
+
+class _FreshTransport:
+    """Numbers every prompt, so no two calls get the same synthetic reply"""
+    
+    def __init__(self, inner):
+        self.inner = inner
+        self.calls = 0
+    
+    def complete(self, model, messages, temperature, **params):
+        self.calls += 1
+        last = {**messages[-1], 'content': f"{messages[-1]['content']}\n#{self.calls}"}
+        return self.inner.complete(model, messages[:-1] + [last], temperature, **params)
+
+def test_cache_not_shared_across_weeks():
+    """Consecutive weeks with the same assignments get fresh text; rerunning a week reuses it"""
+    cache = LLMCache()
+    transport = _FreshTransport(SyntheticTransport(seed=1))
+    
+    def week(week_number):
+        calendar = _offline_calendar(transport, week_number=week_number, cache=cache)
+        return [(post['subreddit'], post['keyword_ids']) for post in calendar['posts']], \
+               [post['body'] for post in calendar['posts']]
+    
+    assignments, first = week(1)
+    calls = transport.calls
+    next_assignments, second = week(2)
+    assert next_assignments == assignments
+    assert not set(first) & set(second)
+    
+    assert week(1) == (assignments, first)
+    assert transport.calls == 2 * calls
+
+def test_record_and_replay():
+    """A recorded run replays exactly from its transcript"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'transcript.jsonl')
+        recorded = _offline_calendar(RecordingTransport(SyntheticTransport(seed=1), path), max_concurrency=4)
+        replayed = _offline_calendar(ReplayTransport(path), max_concurrency=4)
+    
+    assert _without_timestamps(recorded) == _without_timestamps(replayed)
+
+def test_llm_cache_tiers():
+    """The memory tier expires with the disk tier and its hits count for disk eviction"""
+    clock = _FakeClock()
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LLMCache(max_entries=2, path=os.path.join(tmp, 'llm.db'), ttl_seconds=60, clock=clock)
+        for key in 'abc':
+            cache.set(key, key.upper())
+        assert (len(cache.memory), len(cache.disk)) == (2, 3)
+        
+        assert cache.get('c') == 'C'  # memory
+        clock.now = 30
+        assert cache.get('a') == 'A'  # disk, promoted to memory
+        assert cache.get('z') is None
+        assert cache.stats() == {'memory_hits': 1, 'disk_hits': 1, 'misses': 1, 'writes': 3, 'hit_rate': 0.667,
+                                 'memory_entries': 2, 'disk_entries': 3}
+        
+        # A promoted entry keeps its disk age: both tiers drop it at the TTL
+        clock.now = 61
+        assert cache.get('a') is None
+        assert cache.get('b') is None
+        assert len(cache.memory) == 1 and len(cache.disk) == 1
+        
+        # Memory hits refresh the disk row, so LRU eviction keeps the entry being read
+        cache = LLMCache(max_entries=10, path=os.path.join(tmp, 'lru.db'), disk_max_entries=2, clock=clock)
+        cache.set('old', 'x')
+        clock.now += 1
+        cache.set('new', 'y')
+        clock.now += 1
+        assert cache.get('old') == 'x'
+        clock.now += 1
+        cache.set('newest', 'z')
+        cache.disk.evict()
+        assert cache.disk.get('old') == 'x'
+        assert cache.disk.get('new') is None
+        
+        cache.clear()
+        assert (len(cache.memory), len(cache.disk)) == (0, 0)
+
+class _ThreadReplyTransport:
+    """Answers thread requests with a fixed reply, everything else synthetically; logs the request kinds"""
+    
+    KINDS = {THREAD_SYSTEM_PROMPT: 'thread', POST_SYSTEM_PROMPT: 'post', COMMENT_SYSTEM_PROMPT: 'comment'}
+    
+    def __init__(self, reply):
+        self.reply = reply
+        self.inner = SyntheticTransport(seed=1)
+        self.kinds = []
+    
+    def complete(self, model, messages, temperature, **params):
+        kind = self.KINDS[messages[0]['content']]
+        self.kinds.append(kind)
+        if kind == 'thread':
+            return {"content": self.reply, "usage": {}}
+        return self.inner.complete(model, messages, temperature, **params)
+
+def test_thread_reply_falls_back_per_field():
+    """Only the fields missing from a single-call thread reply are replaced or regenerated"""
+    thread = {
+        "title": "Deck formatting eats my week",
+        "body": "How do you all keep slides consistent across a team?",
+        "comments": [
+            {"index": 0, "reply_to": None, "text": "Master slides saved us"},
+            {"index": 1, "reply_to": 0, "text": "Same, plus one shared theme file"}
+        ]
+    }
+    assignment = {"subreddit": "r/PowerPoint", "keywords": ["K1"], "post_index": 0}
+    
+    def render(reply):
+        transport = _ThreadReplyTransport(reply)
+        generator = RedditCalendarGenerator(api_key=None, transport=transport, thread_mode='single_call')
+        plan = generator._plan_post(assignment, SAMPLE_DATA['personas'], 1, datetime(2025, 1, 6), 1,
+                                    rng=random.Random(1))
+        assert len(plan['comments']) == 2
+        return generator._render_post(plan, SAMPLE_DATA['company_info']), transport.kinds
+    
+    post, kinds = render(json.dumps(thread))
+    assert kinds == ['thread']
+    assert [c['comment_text'] for c in post['comments']] == [c['text'] for c in thread['comments']]
+    
+    # Truncated JSON: the generic post, and both comments written one call each
+    before = FALLBACKS.value(kind='thread_comment')
+    post, kinds = render(json.dumps(thread)[:70])
+    assert kinds == ['thread', 'comment', 'comment']
+    assert (post['title'], post['body']) == ("Looking for advice on K1",
+                                             "Has anyone had experience with this? Would love to hear your thoughts.")
+    assert all(c['comment_text'] for c in post['comments'])
+    assert FALLBACKS.value(kind='thread_comment') == before + 2
+    
+    # One comment missing: the post and the other comment are kept, only the gap is generated
+    post, kinds = render(json.dumps({**thread, "comments": thread['comments'][:1]}))
+    assert kinds == ['thread', 'comment']
+    assert (post['title'], post['body']) == (thread['title'], thread['body'])
+    assert post['comments'][0]['comment_text'] == thread['comments'][0]['text']
+    assert post['comments'][1]['comment_text'] not in ('', thread['comments'][1]['text'])
+
+def test_phrase_matcher():
+    """Compiled matcher reports the same hits as one `in` check per phrase"""
+    filler = [f"filler phrase {i}" for i in range(200)]  # large enough to use the regex
+    phrases = ['totally', 'totally feel', 'i totally', 'check out', 'c++ (beta)'] + filler
+    matcher = PhraseMatcher(phrases)
+    
+    for text in ['i totally feel you', 'check out c++ (beta)', 'filler phrase 12!', 'nothing here', '']:
+        assert matcher.find(text) == {p for p in phrases if p in text}
+
+def test_company_mentions_use_company_name():
+    """Company mentions are counted for the calendar's own company"""
+    comments = [
+        {"comment_text": text, "username": "jordan_consults", "delay_minutes": delay}
+        for text, delay in [("acme does this", 20), ("tried acme too", 45), ("acme ftw", 70)]
+    ]
+    posts = [{"title": "Deck help", "body": "Any tips?", "author_username": "riley_ops",
+              "keyword_ids": ["K1"], "comments": comments}]
+    
+    scorer = QualityScorer()
+    flagged = scorer.score_calendar(posts, SAMPLE_DATA['personas'], company_names=['Acme'])
+    other = scorer.score_calendar(posts, SAMPLE_DATA['personas'], company_names=['SlideForge'])
+    
+    assert "Company mentioned too frequently (3 times)" in flagged['warnings']
+    assert not any('Company mentioned' in w for w in other['warnings'])
+
+def _parity_calendar(seed):
+    """A fixed-seed calendar of shuffled stock words"""
+    rng = random.Random(seed)
+    words = ['deck', 'slides', 'template', 'client', 'pitch', 'moreover', 'act', 'now',
+             'buy', 'totally', 'feel', 'you', 'check', 'out', 'acme']
+    usernames = [persona['username'] for persona in SAMPLE_DATA['personas']]
+    
+    def text(num_words):
+        return ' '.join(rng.choice(words) for _ in range(num_words))
+    
+    posts = []
+    for p in range(4):
+        comments = [
+            {"comment_id": f"C{p}{c}", "post_id": f"P{p}", "comment_text": text(rng.randint(3, 12)),
+             "username": rng.choice(usernames), "delay_minutes": rng.randint(5, 240)}
+            for c in range(rng.randint(1, 3))
+        ]
+        posts.append({"post_id": f"P{p}", "title": text(4).capitalize(), "body": text(10),
+                      "author_username": rng.choice(usernames[:2]), "keyword_ids": [f"K{rng.randint(1, 3)}"],
+                      "comments": comments})
+    return posts
+
+def test_feature_scores_match_frozen_metrics():
+    """Single-pass feature scoring keeps the metrics of the original per-check scorer"""
+    posts = _parity_calendar(4)
+    # 'buy now' only occurs across a post boundary: last comment of P1, title of P2
+    posts[1]['comments'][-1]['comment_text'] += ' buy'
+    posts[2]['title'] = 'Now ' + posts[2]['title']
+    
+    # Computed with the scorer before feature extraction
+    expected = {
+        'naturalness': 5,
+        'persona_variety': 7,
+        'timing_realism': 10,
+        'content_diversity': 8.5,
+        'anti_spam_score': 9,
+        'overall_score': 7.5,
+        'warnings': [
+            "Unnatural phrase detected: 'buy now'",
+            "Unnatural phrase detected: 'act now'",
+            'Language too formal for Reddit',
+            "Persona 'jordan_consults' overused (60.0% of interactions)",
+            'Personas not used: emily_econ',
+            'Repeated words in titles: pitch',
+            'Low keyword diversity across posts',
+            'Low word diversity (unique ratio: 0.28)'
+        ]
+    }
+    scorer = QualityScorer()
+    assert scorer.score_calendar(posts, SAMPLE_DATA['personas']) == expected
+    assert scorer.score_features(scorer.extract_features(posts), SAMPLE_DATA['personas']) == expected
+    
+    features = CalendarFeatures()
+    for post in posts:
+        features.add_post(post)
+    assert scorer.score_features(features, SAMPLE_DATA['personas']) == expected
+
+def test_live_scores_and_early_stop():
+    """Live metrics match a full re-score, and min_score stops a bad calendar early"""
+    seen = []
+    transport = SyntheticTransport(seed=1)
+    generator = RedditCalendarGenerator(api_key=None, transport=transport, max_concurrency=4)
+    calendar = generator.generate_calendar(
+        company_info=SAMPLE_DATA['company_info'],
+        personas=SAMPLE_DATA['personas'],
+        subreddits=SAMPLE_DATA['subreddits'],
+        keywords=SAMPLE_DATA['keywords'],
+        posts_per_week=6,
+        seed=3,
+        on_post=lambda post, metrics: seen.append(metrics['overall_score'])
+    )
+    
+    assert len(seen) == 6
+    rescored = QualityScorer().score_calendar(calendar['posts'], SAMPLE_DATA['personas'], company_names=['SlideForge'])
+    metrics = dict(calendar['metrics'])
+    usage = metrics.pop('usage')
+    assert metrics == rescored
+    assert usage['requests'] == transport.calls and usage['total_tokens'] > 0
+    
+    stopped = generator.generate_calendar(
+        company_info=SAMPLE_DATA['company_info'],
+        personas=SAMPLE_DATA['personas'],
+        subreddits=SAMPLE_DATA['subreddits'],
+        keywords=SAMPLE_DATA['keywords'],
+        posts_per_week=6,
+        seed=3,
+        max_concurrency=1,
+        min_score=11  # unreachable, so it stops as soon as it may
+    )
+    assert stopped['stopped_early'] is True
+    assert len(stopped['posts']) == RedditCalendarGenerator.MIN_POSTS_BEFORE_STOP
+
+def test_campaign_store_history():
+    """Saved weeks answer keyword and persona history queries"""
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CampaignStore(os.path.join(tmp, 'campaigns.db'))
+        campaign_id = store.create_campaign({k: SAMPLE_DATA[k] for k in SAMPLE_DATA})
+        
+        for week in (1, 2, 3):
+            calendar = _offline_calendar(SyntheticTransport(seed=week), seed=week)
+            calendar['week'] = week
+            store.save_week(campaign_id, calendar)
+        
+        assert store.get_campaign(campaign_id)['posts_per_week'] == 3
+        assert store.latest_week(campaign_id) == 3
+        assert store.recent_keywords(campaign_id, before_week=4, weeks=2) <= set(SAMPLE_DATA['keywords'])
+        assert store.recent_keywords(campaign_id, before_week=1, weeks=4) == set()
+        
+        activity = store.persona_activity(campaign_id)
+        total_posts = sum(user['posts'] for sub in activity.values() for user in sub.values())
+        assert total_posts == 9
+        assert sum(store.subreddit_usage(campaign_id, before_week=3, weeks=1).values()) == 3
+
+def test_job_queue_and_worker():
+    """Jobs survive a lost worker, respect tenant limits and store their result"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'jobs.db')
+        payload = {k: SAMPLE_DATA[k] for k in SAMPLE_DATA}
+        
+        # A lease that expires at once: the job is handed out again, as after a crash
+        crashed = JobQueue(path, lease_seconds=0)
+        lost_id = crashed.submit('generate-calendar', payload, tenant='acme')
+        assert crashed.claim('worker-1')['job_id'] == lost_id
+        
+        queue = JobQueue(path, tenant_limit=1)
+        second_id = queue.submit('generate-calendar', payload, tenant='acme')
+        other_id = queue.submit('generate-calendar', payload, tenant='globex')
+        
+        job = queue.claim('worker-2')
+        assert job['job_id'] == lost_id and job['attempts'] == 2
+        assert job['payload'] == payload
+        assert not crashed.complete(lost_id, 'worker-1', {})  # lease moved to worker-2
+        
+        assert queue.claim('worker-3')['job_id'] == other_id  # acme is at its limit
+        assert queue.claim('worker-4') is None
+        assert queue.fail(other_id, 'worker-3', 'boom')
+        assert queue.get(second_id)['status'] == 'queued'
+        
+        generator = RedditCalendarGenerator(api_key=None, transport=SyntheticTransport(seed=1))
+        service = CalendarService(generator, CampaignStore(os.path.join(tmp, 'campaigns.db')))
+        assert queue.complete(lost_id, 'worker-2', {"posts": []})
+        assert process_next(queue, service, 'worker-5')
+        
+        assert queue.get(second_id)['status'] == 'succeeded'
+        assert len(queue.result(second_id)['posts']) == 3
+        assert queue.counts() == {'queued': 0, 'running': 0, 'succeeded': 2, 'failed': 1}
+
+def test_calendar_stream_events():
+    """Streaming yields each post, then the metrics and the same calendar as a plain request"""
+    data = {**SAMPLE_DATA, "seed": 7}
+    generator = RedditCalendarGenerator(api_key=None, transport=SyntheticTransport(seed=1), max_concurrency=4)
+    with tempfile.TemporaryDirectory() as tmp:
+        service = CalendarService(generator, CampaignStore(os.path.join(tmp, 'campaigns.db')))
+        events = list(service.stream('generate-calendar', data))
+        expected = service.generate('generate-calendar', data)
+        
+        assert [event for event, _ in events] == ['post'] * 3 + ['quality_metrics', 'calendar']
+        calendar = events[-1][1]
+        assert events[-2][1] == calendar['metrics'] == expected['metrics']
+        assert _without_timestamps(calendar) == _without_timestamps(expected)
+        assert {payload['post']['post_id'] for _, payload in events[:3]} == {'P11', 'P12', 'P13'}
+        
+        error = list(service.stream('generate-calendar', {"personas": []}))
+        assert error == [('error', {"error": "Missing required field: company_info", "status": 400})]
+
+class _ScriptedStream:
+    """Streams canned replies four characters at a time"""
+    
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.pieces_sent = 0
+    
+    def stream(self, model, messages, temperature, **params):
+        reply = self.replies.pop(0)
+        for start in range(0, len(reply), 4):
+            self.pieces_sent += 1
+            yield reply[start:start + 4]
+
+def test_streamed_post_generation():
+    """Streamed posts arrive field by field, and a company mention aborts and retries"""
+    parser = JSONFieldStream()
+    raw = '```json\n{"title": "caf\\u00e9 \\"deck\\" \\ud83d\\ude00", "n": [1, {"x": "}"}], "body": "a\\nb"}'
+    pieces = [piece for i in range(0, len(raw), 3) for piece in parser.feed(raw[i:i + 3])]
+    assert parser.fields == {"title": 'café "deck" 😀', "body": "a\nb"} and parser.done
+    assert ''.join(text for field, text in pieces if field == 'title') == parser.fields['title']
+    
+    bad = '{"title": "SlideForge is great", "body": "' + 'padding ' * 50 + '"}'
+    good = '{"title": "deck formatting eats my week", "body": "what do you all use?"}'
+    transport = _ScriptedStream([bad, good])
+    seen = []
+    with metered(UsageMeter()) as meter:
+        post = ContentGenerator(api_key=None, transport=transport).generate_post(
+            "r/startups", ["pitch deck generator"], SAMPLE_DATA['personas'][0], SAMPLE_DATA['company_info'],
+            stream=True, on_text=lambda field, text: seen.append((field, text))
+        )
+    
+    assert post == {"title": "deck formatting eats my week", "body": "what do you all use?"}
+    assert transport.pieces_sent < (len(bad) + len(good)) // 4  # the bad reply was cut off
+    # Neither stream reported usage, and one was cut off: both are still counted (estimated)
+    usage = meter.totals()
+    assert usage['requests'] == 2
+    assert usage['total_tokens'] == usage['prompt_tokens'] + usage['completion_tokens'] > 0
+    retried = seen[seen.index(('restart', '')) + 1:]
+    assert ''.join(text for field, text in retried if field == 'title') == post['title']
+    
+    # A transport without stream() gives the same result either way
+    generator = ContentGenerator(api_key=None, transport=SyntheticTransport(seed=1))
+    args = ("r/startups", ["pitch deck generator"], SAMPLE_DATA['personas'][0], SAMPLE_DATA['company_info'])
+    assert generator.generate_post(*args, stream=True) == generator.generate_post(*args)
+
+def test_campaign_generation():
+    """A pipelined campaign plans each week from the week before and saves every week"""
+    generator = RedditCalendarGenerator(api_key=None, transport=SyntheticTransport(seed=1), max_concurrency=4)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CampaignStore(os.path.join(tmp, 'campaigns.db'))
+        campaign_id = store.create_campaign({k: SAMPLE_DATA[k] for k in SAMPLE_DATA})
+        service = CalendarService(generator, store)
+        
+        completed = []
+        result = service.generate('generate-campaign', {"campaign_id": campaign_id, "weeks": 4, "seed": 5},
+                                  on_week=lambda calendar: completed.append(calendar['week']))
+        
+        assert [calendar['week'] for calendar in result['weeks']] == [1, 2, 3, 4]
+        assert sorted(completed) == [1, 2, 3, 4]
+        assert store.latest_week(campaign_id) == 4
+        for calendar in result['weeks']:
+            assert [post['post_id'] for post in calendar['posts']] == [f"P{calendar['week']}{i}" for i in (1, 2, 3)]
+            metrics = dict(calendar['metrics'])
+            assert metrics.pop('usage')['requests'] == 9  # 3 posts, 6 comments
+            history = store.near_duplicate_index(campaign_id, before_week=calendar['week'])
+            assert metrics == QualityScorer().score_calendar(
+                calendar['posts'], SAMPLE_DATA['personas'], company_names=['SlideForge'], near_duplicates=history)
+        
+        # Same seed, same plan, however the posts were scheduled
+        serial = RedditCalendarGenerator(api_key=None, transport=SyntheticTransport(seed=1))
+        again = CalendarService(serial, store).generate('generate-campaign', {**SAMPLE_DATA, "weeks": 4, "seed": 5})
+        assert [_without_timestamps(c) for c in again['weeks']] == [_without_timestamps(c) for c in result['weeks']]
+        
+        events = list(service.stream('generate-campaign', {"campaign_id": campaign_id, "weeks": 2}))
+        assert [event for event, _ in events] == ['week', 'week', 'campaign']
+        assert [week['week'] for week in events[-1][1]['weeks']] == [5, 6]
+
+def test_batch_api_campaign_generation():
+    """Batch-API generation writes the same campaign as live calls, phase by phase"""
+    campaign = {**SAMPLE_DATA, "weeks": 2, "seed": 5}
+    live_weeks = {}
+    for thread_mode in RedditCalendarGenerator.THREAD_MODES:
+        live = RedditCalendarGenerator(api_key=None, transport=SyntheticTransport(seed=1), thread_mode=thread_mode)
+        expected = live_weeks[thread_mode] = live.generate_campaign(**campaign)
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            generator = RedditCalendarGenerator(api_key=None, transport=SyntheticTransport(seed=1),
+                                                thread_mode=thread_mode)
+            # Flaky batches: failed requests are resubmitted, then sent live
+            batch_transport = LocalBatchTransport(SyntheticTransport(seed=2, failure_rate=0.3), pending_polls=2)
+            sleeps = []
+            batch = BatchCampaignGenerator(generator, batch_transport, work_dir=tmp, max_attempts=2,
+                                           sleep=sleeps.append)
+            calendars = batch.generate_campaign(**campaign)
+            batch_files = os.listdir(tmp)
+        
+        assert [_without_timestamps(c) for c in calendars] == [_without_timestamps(c) for c in expected]
+        assert [c['quality_score'] for c in calendars] == [c['quality_score'] for c in expected]
+        assert sleeps and len(sleeps) == 2 * len(batch_transport.batches)
+        assert len(batch_files) == len(batch_transport.batches)
+        if thread_mode == 'per_call':
+            # Posts, then one batch per comment level
+            assert any('-posts-1' in name for name in batch_files)
+            assert any('-comments2-' in name for name in batch_files)
+            assert sum(c['metrics']['usage']['requests'] for c in calendars) == 18  # 6 posts, 12 comments
+    
+    # Several campaigns share the batches
+    generator = RedditCalendarGenerator(api_key=None, transport=SyntheticTransport(seed=1))
+    with tempfile.TemporaryDirectory() as tmp:
+        batch_transport = LocalBatchTransport(pending_polls=0)
+        batch = BatchCampaignGenerator(generator, batch_transport, work_dir=tmp)
+        both = batch.generate_campaigns([campaign, {**campaign, "seed": 6}])
+        first = batch_transport.batches['batch_local_1']['requests']
+    assert len(first) == 12 and first[0]['url'] == '/v1/chat/completions'
+    assert [_without_timestamps(c) for c in both[0]] == [_without_timestamps(c) for c in live_weeks['per_call']]
+
+def test_partial_regeneration():
+    """Repairs rewrite only the items behind warnings and re-score by delta"""
+    calendar = _offline_calendar(SyntheticTransport(seed=1))
+    posts = calendar['posts']
+    # Four comments open the same way and one title reads like an ad
+    for p, c in [(0, 0), (1, 0), (1, 1), (2, 0)]:
+        posts[p]['comments'][c]['comment_text'] = 'totally agree, ' + posts[p]['comments'][c]['comment_text']
+    posts[2]['title'] += ' click here'
+    original = json.loads(json.dumps(posts, default=json_default))
+    
+    generator = RedditCalendarGenerator(api_key=None, transport=SyntheticTransport(seed=1))
+    repaired = repair_calendar(generator, calendar, SAMPLE_DATA['company_info'], SAMPLE_DATA['personas'],
+                               target_score=10, max_rounds=1, near_duplicates=NearDuplicateIndex())
+    
+    regeneration = repaired['metrics']['regeneration']
+    # The third "totally" comment and the ad-like post (with its thread) are rewritten
+    assert (regeneration['rounds'], regeneration['rewritten_posts'], regeneration['rewritten_comments']) == (1, 1, 3)
+    assert regeneration['usage']['requests'] == 4
+    assert regeneration['score_before'] < repaired['quality_score']
+    assert repaired['posts'][0] == original[0]
+    assert repaired['posts'][1]['comments'][0] == original[1]['comments'][0]
+    assert repaired['posts'][1]['comments'][1]['comment_text'] != original[1]['comments'][1]['comment_text']
+    assert 'click here' not in repaired['posts'][2]['title']
+    
+    # The delta update scores exactly like a full re-score
+    metrics = {k: v for k, v in repaired['metrics'].items() if k not in ('usage', 'regeneration')}
+    assert metrics == QualityScorer().score_calendar(repaired['posts'], SAMPLE_DATA['personas'],
+                                                     company_names=['SlideForge'], near_duplicates=NearDuplicateIndex())
+    
+    # A phrase straddling two posts counts; replacing a post in place rescans its boundaries
+    def post(post_id, title, body):
+        return {"post_id": post_id, "title": title, "body": body, "author_username": "riley_ops", "comments": []}
+    
+    scorer = QualityScorer()
+    posts = [post("P1", "Deck tips", "Act"), post("P2", "Now hiring", "x"), post("P3", "Slides", "ok")]
+    features = scorer.extract_features(posts)
+    assert 'act now' in features.unnatural_counts
+    features.remove_post(posts[1], 1)
+    features.add_post(post("P2", "Later", "x"), 1)
+    assert 'act now' not in features.unnatural_counts
+    features.remove_post(posts[0], 0)
+    features.add_post(post("P1", "Deck tips", "click"), 0)
+    features.remove_post(posts[2], 2)
+    features.add_post(post("P3", "here", "ok"), 2)
+    assert 'click here' not in features.unnatural_counts
+    features.remove_post(post("P2", "Later", "x"), 1)
+    features.add_post(post("P2", "x", "click"), 1)
+    assert sorted(features.unnatural_counts) == ['click here']
+    
+    # An unused persona takes over a comment; a saved campaign week is repaired in place
+    personas = SAMPLE_DATA['personas'] + [{"username": "sam_designs", "info": "Freelance designer"}]
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CampaignStore(os.path.join(tmp, 'campaigns.db'))
+        campaign_id = store.create_campaign({**{k: SAMPLE_DATA[k] for k in SAMPLE_DATA}, "personas": personas})
+        store.save_week(campaign_id, {**calendar, "posts": original})
+        service = CalendarService(generator, store)
+        
+        result = service.regenerate({"campaign_id": campaign_id, "week": 1, "target_score": 10})
+        usernames = [c['username'] for post in result['posts'] for c in post['comments']]
+        assert 'sam_designs' in usernames
+        assert "Personas not used: sam_designs" not in result['metrics']['warnings']
+        assert store.get_week(campaign_id, 1)['quality_score'] == result['quality_score']
+        try:
+            service.regenerate({"company_info": SAMPLE_DATA['company_info']})
+            assert False, "a calendar is required"
+        except RequestError:
+            pass
+
+def test_score_archive():
+    """The archive CLI streams JSON arrays and JSON lines and scores them in input order"""
+    values = [{"a": "x]y,z\\\"", "n": [1, 2.5e3, {"b": None}]}, 12345, "s", [], {}]
+    text = json.dumps(values)
+    assert list(iter_json_values(io.StringIO(text), read_size=3)) == values
+    assert list(iter_json_values(io.StringIO('{"posts": []}'))) == [{"posts": []}]
+    
+    calendars = [_offline_calendar(SyntheticTransport(seed=seed), seed=seed) for seed in range(3)]
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'a.jsonl'), 'w') as f:
+            f.write(json.dumps({**calendars[0], "personas": SAMPLE_DATA['personas'],
+                                "company_info": SAMPLE_DATA['company_info']}, default=json_default) + '\n\nnot json\n')
+        os.makedirs(os.path.join(tmp, 'b'))
+        with open(os.path.join(tmp, 'b', 'campaign.json'), 'w') as f:
+            json.dump([{"weeks": calendars[1:], "personas": SAMPLE_DATA['personas']}, {"title": "no posts"}], f,
+                      default=json_default)
+        
+        outputs = []
+        for workers in (1, 2):
+            output = io.StringIO()
+            assert score_archive([tmp], output, workers=workers, chunk_size=2) == (3, 2)
+            outputs.append(output.getvalue())
+    
+    assert outputs[0] == outputs[1]
+    lines = [json.loads(line) for line in outputs[0].splitlines()]
+    assert [line['source'][len(tmp):] for line in lines] == [
+        '/a.jsonl:1', '/a.jsonl:3', '/b/campaign.json[0]#week1', '/b/campaign.json[0]#week1', '/b/campaign.json[1]'
+    ]
+    assert lines[1]['error'].startswith('Invalid JSON') and lines[4]['error'] == 'Missing posts'
+    assert lines[0]['metrics'] == QualityScorer().score_calendar(
+        calendars[0]['posts'], SAMPLE_DATA['personas'], company_names=['SlideForge'])
+    assert lines[2]['metrics'] == QualityScorer().score_calendar(calendars[1]['posts'], SAMPLE_DATA['personas'])
+
+
+def test_near_duplicate_detection():
+    """Near-copies of earlier weeks' comments are found through the LSH index and scored"""
+    original = "Honestly I spent three hours fighting slide templates before our pitch last week and it still looked off"
+    near_copy = "honestly i spent three hours fighting slide templates before the pitch last week and it still looked off!"
+    unrelated = "Has anyone compared export quality between the big deck tools for printing handouts at conferences"
+    assert signature("same here lol") is None
+    
+    index = NearDuplicateIndex()
+    index.add("C111 (week 1)", signature(original))
+    index.add("C112 (week 1)", signature(unrelated))
+    label, similarity = index.query(signature(near_copy))
+    assert label == "C111 (week 1)" and similarity >= index.threshold
+    assert index.query(signature("Quick question about keyboard shortcuts for aligning shapes in slides")) is None
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CampaignStore(os.path.join(tmp, 'campaigns.db'))
+        campaign_id = store.create_campaign({})
+        week = _offline_calendar(SyntheticTransport(seed=1))
+        week['posts'][0]['comments'][0]['comment_text'] = original
+        store.save_week(campaign_id, week)
+        history = store.near_duplicate_index(campaign_id, before_week=2)
+        assert len(history) == len(store.near_duplicate_index(campaign_id)) > 0
+        assert len(store.near_duplicate_index(campaign_id, before_week=1)) == 0
+    
+    posts = [{
+        "post_id": "P21", "title": "Deck templates", "body": unrelated, "author_username": "riley_ops",
+        "keyword_ids": ["K1"], "comments": [
+            {"comment_id": "C211", "comment_text": near_copy, "username": "jordan_consults", "delay_minutes": 25},
+            {"comment_id": "C212", "comment_text": near_copy, "username": "emily_econ", "delay_minutes": 70}
+        ]
+    }]
+    scorer = QualityScorer()
+    metrics = scorer.score_calendar(posts, SAMPLE_DATA['personas'], near_duplicates=history)
+    assert metrics['duplication'] == 6  # two near-copies of week 1 (one also of C211)
+    assert f"C211 is a near-duplicate of {week['posts'][0]['comments'][0]['comment_id']} (week 1)" in metrics['warnings'][-2]
+    
+    plain = scorer.score_calendar(posts, SAMPLE_DATA['personas'])
+    assert 'duplication' not in plain
+    scores = {key: value for key, value in metrics.items() if key in scorer.weights}
+    assert metrics['overall_score'] == round(sum(v * scorer.weights[k] for k, v in scores.items()) / 1.1, 1)
+
+class _FakeClock:
+    """Clock whose sleep() just moves time forward"""
+    
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+    
+    def __call__(self):
+        return self.now
+    
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def test_rate_limiter_and_retries():
+    """Buckets pace requests, 429s back off (honoring Retry-After) and shrink concurrency"""
+    clock = _FakeClock()
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=600, max_concurrency=8,
+                          clock=clock, sleep=clock.sleep, seed=0)
+    for _ in range(6):
+        limiter.acquire(100)
+        limiter.release()
+    assert clock.sleeps == []
+    limiter.acquire(100)  # token budget spent: wait for 100 tokens at 10/s
+    limiter.release()
+    assert clock.sleeps == [10.0]
+    
+    class Throttled:
+        calls = 0
+        def complete(self, model, messages, temperature, **params):
+            self.calls += 1
+            if self.calls == 1:
+                raise TransportError("slow down", status_code=429, retry_after=7)
+            if self.calls == 2:
+                raise TransportError("bad request", status_code=400)
+            return {"content": "ok", "usage": {}}
+    
+    clock = _FakeClock()
+    limiter = RateLimiter(max_concurrency=8, clock=clock, sleep=clock.sleep, seed=0)
+    transport = RateLimitedTransport(Throttled(), limiter)
+    try:
+        transport.complete("m", [{"role": "user", "content": "hi"}], 0.5)
+        assert False, "a 400 is not retried"
+    except TransportError as e:
+        assert e.status_code == 400
+    assert clock.sleeps and clock.sleeps[0] >= 7
+    assert limiter.throttled == 1 and limiter.concurrency < 5  # halved from 8
+    assert transport.complete("m", [{"role": "user", "content": "hi"}], 0.5)['content'] == 'ok'
+    
+    # A flaky backend still yields the same calendar as a healthy one
+    clock = _FakeClock()
+    flaky = RateLimitedTransport(
+        SyntheticTransport(seed=1, failure_rate=0.3, failure_status=429),
+        RateLimiter(clock=clock, sleep=clock.sleep, seed=0),
+        max_retries=20
+    )
+    assert _without_timestamps(_offline_calendar(flaky)) == _without_timestamps(_offline_calendar(SyntheticTransport(seed=1)))
+    
+    # Generators built without a transport go through the shared limiter too
+    default = ContentGenerator(api_key=None).transport
+    assert isinstance(default, RateLimitedTransport) and default.limiter is shared_rate_limiter()
+    assert isinstance(default.inner, OpenAITransport)
+
+def test_stage_timings_and_metrics():
+    """Spans feed the Prometheus histograms and an optional per-request timing breakdown"""
+    generator = RedditCalendarGenerator(api_key=None, transport=SyntheticTransport(seed=1), max_concurrency=4)
+    assigned = STAGE_SECONDS.count(stage='assign_posts')
+    with tempfile.TemporaryDirectory() as tmp:
+        service = CalendarService(generator, CampaignStore(os.path.join(tmp, 'campaigns.db')))
+        plain = service.generate('generate-calendar', {**SAMPLE_DATA, "seed": 7})
+        timed = service.generate('generate-calendar', {**SAMPLE_DATA, "seed": 7, "include_timing": True})
+    
+    assert 'timing' not in plain
+    stages = timed.pop('timing')['stages']
+    assert _without_timestamps(timed) == _without_timestamps(plain)
+    assert stages['assign_posts']['calls'] == 1
+    assert stages['render_post']['calls'] == stages['comment_thread']['calls'] == 3
+    assert stages['generate_post']['calls'] == 3
+    assert stages['llm_request']['calls'] == 3 + sum(len(post['comments']) for post in timed['posts'])
+    assert STAGE_SECONDS.count(stage='assign_posts') == assigned + 2
+    
+    # An unparseable post reply is counted as a fallback
+    class Garbled:
+        def complete(self, model, messages, temperature, **params):
+            return {"content": "not json", "usage": {"prompt_tokens": 5, "completion_tokens": 2}}
+    fallbacks = FALLBACKS.value(kind='post')
+    post = ContentGenerator(api_key=None, transport=Garbled()).generate_post(
+        "r/startups", ["pitch deck generator"], SAMPLE_DATA['personas'][0], SAMPLE_DATA['company_info']
+    )
+    assert post['title'] and FALLBACKS.value(kind='post') == fallbacks + 1
+    
+    text = REGISTRY.render()
+    assert '# TYPE mastermind_stage_duration_seconds histogram' in text
+    assert 'mastermind_stage_duration_seconds_bucket{stage="live_score",le="+Inf"}' in text
+    assert f'mastermind_fallbacks_total{{kind="post"}} {fallbacks + 1}' in text
+    assert 'mastermind_llm_tokens_total{kind="completion"}' in text
+    
+    # A client disconnect or an aborted generation is a cancellation, not an error
+    for error in (StreamClosed(), GenerationAborted("mentions SlideForge"), RuntimeError("boom")):
+        try:
+            with span('cancel_test'):
+                raise error
+        except Exception:
+            pass
+    assert STAGE_CANCELLED.value(stage='cancel_test') == 2
+    assert STAGE_ERRORS.value(stage='cancel_test') == 1
+
+def test_metrics_shared_across_workers():
+    """Metrics are summed over every worker's snapshot; rate limits are split between workers"""
+    with _web_app() as web, tempfile.TemporaryDirectory() as tmp:
+        other = Registry()
+        other.counter(FALLBACKS.name, FALLBACKS.help_text).inc(3, kind='shared_test')
+        other.histogram(STAGE_SECONDS.name, STAGE_SECONDS.help_text).observe(0.2, stage='shared_test')
+        with open(os.path.join(tmp, '1.json'), 'w') as f:
+            json.dump(other.snapshot(), f)
+        FALLBACKS.inc(2, kind='shared_test')
+        
+        web.shared_metrics = SharedMetrics(tmp)
+        text = web.app.test_client().get('/api/metrics').get_data(as_text=True)
+        assert f'mastermind_fallbacks_total{{kind="shared_test"}} {FALLBACKS.value(kind="shared_test") + 3}' in text
+        assert 'mastermind_stage_duration_seconds_count{stage="shared_test"} 1' in text
+        assert 'mastermind_stage_duration_seconds_bucket{stage="shared_test",le="0.25"} 1' in text
+        assert os.path.exists(os.path.join(tmp, f"{os.getpid()}.json"))
+    
+    with mock.patch.dict(os.environ, {'OPENAI_RATE_SHARES': '4'}):
+        shared_rate_limiter.cache_clear()
+        try:
+            limiter = shared_rate_limiter()
+            assert limiter.max_concurrency == max(1, int(os.getenv('OPENAI_MAX_CONCURRENCY', 32)) // 4)
+            assert limiter.requests.capacity == max(1, int(os.getenv('OPENAI_RPM', 500)) // 4)
+        finally:
+            shared_rate_limiter.cache_clear()
+
+def test_calendar_model_serialization():
+    """Slot-based posts read like the dict schema and serialize to the same bytes"""
+    calendar = _offline_calendar(SyntheticTransport(seed=1))
+    post = calendar['posts'][0]
+    assert isinstance(post, Post) and isinstance(post['comments'][0], Comment)
+    as_dicts = json.loads(json.dumps(calendar, default=json_default))
+    assert calendar['posts'] == as_dicts['posts'] and dict(post)['comments'] == as_dicts['posts'][0]['comments']
+    assert post['timestamp'] == as_dicts['posts'][0]['timestamp'] and isinstance(post.minutes, int)
+    post['timestamp'] = "2025-01-06 09:30"
+    assert post.timestamp == "2025-01-06 09:30" and json.loads(fast_dumps(post))['timestamp'] == "2025-01-06 09:30"
+    
+    # Same bytes as Flask's default provider on the dict schema, whichever encoder runs
+    post['title'] = 'Caf\u00e9 \u201cdeck\u201d \U0001f680 tab\there \x7f \u2028 "quoted" \\ </script>'
+    default_app, app = Flask('plain'), Flask('records')
+    app.json = CalendarJSONProvider(app)
+    extras = ({"ratio": 0.1, "none": None, "flag": True}, {"tiny": 1e-05, "big": 10 ** 20}, {"by_week": {2: 1, 10: 0}})
+    for extra in extras:
+        calendar = {**calendar, **extra}
+        expected = json.dumps(calendar, default=json_default, sort_keys=True, separators=(',', ':'))
+        assert fast_dumps(calendar) == expected
+        assert app.json.response(calendar).get_data() == expected.encode() + b'\n'
+    plain = json.loads(json.dumps(calendar, default=json_default))
+    assert default_app.json.response(plain).get_data() == app.json.response(plain).get_data()
+    
+    if calendar_model.msgpack is not None:
+        del calendar['big'], calendar['by_week'], plain['big'], plain['by_week']
+        assert calendar_model.msgpack.unpackb(packb(calendar)) == plain
+
+def test_drain_and_fork_safety():
+    """Web workers wait for in-flight generations and reopen per-process resources after a fork"""
+    drain = Drain()
+    release = threading.Event()
+    def generation():
+        with drain.track():
+            release.wait()
+    thread = threading.Thread(target=generation)
+    thread.start()
+    drain.start()
+    assert drain.draining and not drain.wait(timeout=0.05)
+    release.set()
+    assert drain.wait(timeout=5) and drain.stats() == {"in_flight": 0, "draining": True}
+    thread.join()
+    
+    # The OpenAI client is created on first use, not at startup
+    assert OpenAITransport(api_key="sk-test")._client is None
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CampaignStore(os.path.join(tmp, 'campaigns.db'))
+        campaign_id = store.create_campaign({"posts_per_week": 3})
+        parent_conn = store._connect()
+        pid = os.fork()
+        if pid == 0:
+            # The child must not touch the parent's connection
+            ok = store._connect() is not parent_conn and store.get_campaign(campaign_id) == {"posts_per_week": 3}
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.WEXITSTATUS(status) == 0
+        assert store._connect() is parent_conn
+
+def test_request_coalescing():
+    """Identical generation requests share one run, and finished ones are cached with a TTL"""
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    runs, results = [], []
+    def generate():
+        runs.append(1)
+        started.set()
+        release.wait()
+        return {"calendar": len(runs)}
+    def call():
+        results.append(flight.do('key', generate))
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=call) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.shared < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+    assert len(runs) == 1 and flight.in_flight() == 0
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+    assert all(result == {"calendar": 1} for result, _ in results)
+    
+    now = [0.0]
+    cache = ResultCache(max_entries=2, ttl_seconds=10, clock=lambda: now[0])
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1
+    now[0] = 10.0
+    assert cache.get('a') is None and cache.stats() == {"entries": 1, "hits": 2, "misses": 2}
+    
+    # Keys ignore field order; campaign requests key on their next week and aren't cacheable
+    with tempfile.TemporaryDirectory() as tmp:
+        service = CalendarService(RedditCalendarGenerator(api_key=None, transport=SyntheticTransport(seed=1)),
+                                  CampaignStore(os.path.join(tmp, 'campaigns.db')))
+        key, cacheable = service.request_key('generate-calendar', {**SAMPLE_DATA, "seed": 3})
+        assert cacheable and key == service.request_key('generate-calendar', dict(reversed({**SAMPLE_DATA, "seed": 3}.items())))[0]
+        assert key != service.request_key('generate-calendar', {**SAMPLE_DATA, "seed": 4})[0]
+        
+        campaign = {"campaign_id": service.campaign_store.create_campaign(SAMPLE_DATA), "seed": 3}
+        key, cacheable = service.request_key('generate-next-week', campaign)
+        assert not cacheable
+        service.generate('generate-next-week', campaign)
+        assert service.request_key('generate-next-week', campaign)[0] != key
+
+@contextmanager
+def _web_app():
+    """The Flask app, imported offline with its stores in a scratch directory
+    
+    The environment is restored, the scratch directory removed and the module
+    forgotten afterwards, so nothing carries over into other tests.
+    """
+    with tempfile.TemporaryDirectory() as scratch, mock.patch.dict(os.environ, {
+        'LLM_TRANSPORT': 'synthetic',
+        'CAMPAIGN_DB_PATH': os.path.join(scratch, 'campaigns.db'),
+        'JOB_DB_PATH': os.path.join(scratch, 'jobs.db')
+    }):
+        os.environ.pop('METRICS_DIR', None)
+        sys.modules.pop('app', None)
+        try:
+            import app
+            yield app
+        finally:
+            sys.modules.pop('app', None)
+
+def test_exhausted_rate_limit_is_503():
+    """A 429 that outlasts every retry reaches clients of the sync endpoints as 503"""
+    clock = _FakeClock()
+    throttled = RateLimitedTransport(
+        SyntheticTransport(seed=1, failure_rate=1.0, failure_status=429),
+        RateLimiter(clock=clock, sleep=clock.sleep, seed=0),
+        max_retries=2
+    )
+    with _web_app() as web, tempfile.TemporaryDirectory() as tmp:
+        web.calendar_service = CalendarService(RedditCalendarGenerator(api_key=None, transport=throttled),
+                                               CampaignStore(os.path.join(tmp, 'campaigns.db')))
+        client = web.app.test_client()
+        for path, extra in (('/api/generate-calendar', {}), ('/api/generate-next-week', {"week_number": 2}),
+                            ('/api/generate-campaign', {"weeks": 2})):
+            response = client.post(path, json={**SAMPLE_DATA, **extra, "seed": 1})
+            assert response.status_code == 503, path
+            assert 'error' in response.json
+
 if __name__ == "__main__":
     test_calendar_generation()
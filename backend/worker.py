@@ -0,0 +1,119 @@
+"""
+Job workers: drain the job queue with a pool of worker processes
+
+Usage:
+    python worker.py              # JOB_WORKERS processes (default 2)
+    python worker.py --workers 8
+
+Each process builds its own generator (and OpenAI client), claims jobs from
+the SQLite queue at JOB_DB_PATH and stores results back in it. SIGTERM/SIGINT
+stop claiming new jobs and let running ones finish; jobs from a worker that
+dies anyway are re-queued once their lease expires.
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
+from dotenv import load_dotenv
+from calendar_service import CalendarService, create_cache, create_generator, create_campaign_store
+from job_queue import queue_from_env
+
+load_dotenv()
+
+# Finished jobs are kept this long for status/result requests
+RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', 7 * 24 * 3600))
+
+# Set by SIGTERM/SIGINT. Signal handlers only flip this flag: setting a
+# multiprocessing.Event from a handler can deadlock against a wait() on it.
+shutdown_requested = threading.Event()
+
+def request_shutdown(signum, frame):
+    shutdown_requested.set()
+
+def process_next(queue, service, worker_id):
+    """
+    Claim and run one job; returns False if there was nothing to run
+    """
+    job = queue.claim(worker_id)
+    if job is None:
+        return False
+    
+    # Keep the lease alive while the job runs
+    done = threading.Event()
+    def renew():
+        while not done.wait(queue.lease_seconds / 3):
+            queue.heartbeat(job['job_id'], worker_id)
+    heartbeat = threading.Thread(target=renew, daemon=True)
+    heartbeat.start()
+    
+    try:
+        calendar = service.generate(job['kind'], job['payload'])
+        queue.complete(job['job_id'], worker_id, calendar)
+    except Exception as e:
+        queue.fail(job['job_id'], worker_id, str(e))
+    finally:
+        done.set()
+        heartbeat.join()
+    return True
+
+def work(stop, poll_interval):
+    """
+    Worker process loop
+    """
+    # The parent handles Ctrl+C; SIGTERM sent straight to a worker stops it gracefully
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, request_shutdown)
+    
+    worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    queue = queue_from_env()
+    service = CalendarService(
+        create_generator(create_cache()),
+        create_campaign_store(),
+        lookback_weeks=int(os.getenv('CAMPAIGN_LOOKBACK_WEEKS', 4))
+    )
+    
+    while not (stop.is_set() or shutdown_requested.is_set()):
+        if not process_next(queue, service, worker_id):
+            time.sleep(poll_interval)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=int(os.getenv('JOB_WORKERS', 2)))
+    parser.add_argument('--poll-interval', type=float, default=float(os.getenv('JOB_POLL_INTERVAL', 0.5)))
+    args = parser.parse_args(argv)
+    
+    stop = multiprocessing.Event()
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    
+    queue = queue_from_env()
+    processes = {}
+    print(f"👷 Starting {args.workers} job workers ({queue.path})")
+    
+    # Supervise: replace workers that die, purge old results
+    last_purge = 0
+    while not shutdown_requested.is_set():
+        for slot in range(args.workers):
+            process = processes.get(slot)
+            if process is None or not process.is_alive():
+                process = multiprocessing.Process(target=work, args=(stop, args.poll_interval), daemon=True)
+                process.start()
+                processes[slot] = process
+        if time.time() - last_purge > 60:
+            queue.purge(RETENTION_SECONDS)
+            last_purge = time.time()
+        time.sleep(0.5)
+    
+    print("⏳ Waiting for running jobs to finish...")
+    stop.set()
+    for process in processes.values():
+        process.join()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
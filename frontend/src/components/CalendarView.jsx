@@ -77,7 +77,7 @@ function CalendarView({ calendar, inputData, onNextWeek, onError, loading, setLo
         {/* Quality Metrics */}
         <div className="grid grid-cols-2 sm:grid-cols-5 gap-3 mb-4">
           {Object.entries(calendar.metrics).map(([key, value]) => {
-            if (key === 'warnings' || key === 'overall_score') return null;
+            if (['warnings', 'overall_score', 'usage', 'regeneration'].includes(key)) return null;
             return (
               <div key={key} className={`p-3 rounded-lg ${getScoreBgColor(value)}`}>
                 <div className={`text-lg font-bold ${getScoreColor(value)}`}>
@@ -91,6 +91,16 @@ function CalendarView({ calendar, inputData, onNextWeek, onError, loading, setLo
           })}
         </div>
 
+        {/* Regeneration summary */}
+        {calendar.metrics.regeneration && (
+          <p className="text-sm text-gray-600 mb-4">
+            🔁 Regenerated in {calendar.metrics.regeneration.rounds} round(s):{' '}
+            {calendar.metrics.regeneration.rewritten_posts} post(s) and{' '}
+            {calendar.metrics.regeneration.rewritten_comments} comment(s) rewritten
+            (score was {calendar.metrics.regeneration.score_before}/10)
+          </p>
+        )}
+
         {/* Warnings */}
         {calendar.metrics.warnings && calendar.metrics.warnings.length > 0 && (
           <div className="bg-yellow-50 border border-yellow-200 rounded-lg p-4 mb-4">